@@ -0,0 +1,198 @@
+from pathlib import Path
+from typing import Callable, Dict, Mapping, Optional, Set
+from starlette.responses import Response
+import gzip
+import hashlib
+import logging
+import mimetypes
+import posixpath
+import re
+import time
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Tipos que vale la pena comprimir (imágenes y videos ya vienen comprimidos)
+COMPRESSIBLE_SUFFIXES = {".js", ".mjs", ".css", ".html", ".svg", ".json", ".txt", ".map"}
+# Archivos de la interfaz que pasan por el pipeline; el resto (p. ej. la media subida) sigue en /static
+ASSET_SUFFIXES = {".js", ".mjs", ".css", ".svg", ".json", ".map", ".woff", ".woff2", ".ttf", ".ico"}
+
+# Un año: el nombre cambia cuando cambia el contenido
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# El HTML se revalida siempre (barato con ETag) para enterarse de los nombres nuevos
+PAGE_CACHE = "no-cache"
+
+# import/export ... from './x.js', import './x.js', import('./x.js') y url(...) en CSS
+_JS_IMPORT = re.compile(r"""(\bfrom\s*|\bimport\s*\(?\s*)(['"])(\.{1,2}/[^'"]+)\2""")
+_CSS_URL = re.compile(r"""(url\(\s*)(['"]?)(?![a-z]+:|/|#)([^'")]+)\2(\s*\))""", re.IGNORECASE)
+
+class EncodedAsset:
+    """Contenido listo para servir en cada codificación disponible"""
+
+    __slots__ = ("content_type", "variants", "etag")
+
+    def __init__(self, content: bytes, content_type: str, compress: bool):
+        self.content_type = content_type
+        self.etag = hashlib.sha256(content).hexdigest()[:16]
+        self.variants: Dict[str, bytes] = {"identity": content}
+        if compress:
+            gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(gzipped) < len(content):
+                self.variants["gzip"] = gzipped
+            if brotli is not None:
+                compressed = brotli.compress(content, quality=11)
+                if len(compressed) < len(content):
+                    self.variants["br"] = compressed
+
+    def response(self, headers: Mapping[str, str], cache_control: str) -> Response:
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""), self.variants)
+        # Un ETag fuerte distinto por codificación
+        etag = f'"{self.etag}-{encoding}"'
+        response_headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+
+        if etag in headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=response_headers)
+        return Response(self.variants[encoding], media_type=self.content_type, headers=response_headers)
+
+def negotiate_encoding(accept_encoding: str, variants: Mapping[str, bytes]) -> str:
+    """Elegir br > gzip > identity según lo que acepta el cliente"""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in variants and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+class AssetPipeline:
+    """Assets estáticos con nombre por contenido y precomprimidos al iniciar.
+
+    `app.a1b2c3d4e5.js` se sirve con caché inmutable: un refresh de OBS solo revalida
+    el HTML. Los imports relativos entre módulos ES y los url() del CSS se reescriben
+    a los nombres con hash, así que cambiar un módulo cambia también el hash de quien lo importa.
+    """
+
+    def __init__(self, static_path: Path, prefix: str = "/assets", exclude: Optional[Set[Path]] = None):
+        self.static_path = Path(static_path)
+        self.prefix = prefix.rstrip("/")
+        self.exclude = {Path(path).resolve() for path in exclude or ()}
+        # ruta original relativa ("js/app.js") -> ruta con hash ("js/app.1a2b3c4d5e.js")
+        self.manifest: Dict[str, str] = {}
+        self.assets: Dict[str, EncodedAsset] = {}
+        self.pages: Dict[str, EncodedAsset] = {}
+        self.stats = {"files": 0, "bytes": 0, "gzip_bytes": 0, "br_bytes": 0, "build_ms": 0.0, "brotli": brotli is not None}
+
+    # ------------------------------------------
+    # Construcción (al iniciar)
+    # ------------------------------------------
+
+    def build(self):
+        start = time.perf_counter()
+        sources = {
+            path.relative_to(self.static_path).as_posix(): path
+            for path in sorted(self.static_path.rglob("*"))
+            if path.is_file() and path.suffix in ASSET_SUFFIXES
+            and not any(parent in self.exclude for parent in path.resolve().parents)
+        }
+        in_progress: Set[str] = set()
+        for relative in sources:
+            self._build_file(relative, sources, in_progress)
+
+        self.stats["build_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(
+            f"📦 Assets: {self.stats['files']} archivos, {self.stats['bytes']} bytes → "
+            f"gzip {self.stats['gzip_bytes']}" + (f", br {self.stats['br_bytes']}" if brotli else "") +
+            f" ({self.stats['build_ms']}ms)"
+        )
+
+    def _build_file(self, relative: str, sources: Dict[str, Path], in_progress: Set[str]) -> Optional[str]:
+        if relative in self.manifest:
+            return self.manifest[relative]
+        if relative not in sources or relative in in_progress:
+            # Inexistente, o import circular: se deja la referencia original
+            return None
+        in_progress.add(relative)
+
+        path = sources[relative]
+        content = path.read_bytes()
+        if path.suffix in (".js", ".mjs"):
+            content = self._rewrite(_JS_IMPORT, content, relative, sources, in_progress, group=3)
+        elif path.suffix == ".css":
+            content = self._rewrite(_CSS_URL, content, relative, sources, in_progress, group=3)
+
+        digest = hashlib.sha256(content).hexdigest()[:10]
+        hashed = posixpath.join(posixpath.dirname(relative), f"{path.stem}.{digest}{path.suffix}")
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        asset = EncodedAsset(content, content_type, compress=path.suffix in COMPRESSIBLE_SUFFIXES)
+
+        self.manifest[relative] = hashed
+        self.assets[hashed] = asset
+        self.stats["files"] += 1
+        self.stats["bytes"] += len(content)
+        self.stats["gzip_bytes"] += len(asset.variants.get("gzip", content))
+        self.stats["br_bytes"] += len(asset.variants.get("br", content))
+        in_progress.discard(relative)
+        return hashed
+
+    def _rewrite(self, pattern: re.Pattern, content: bytes, relative: str, sources: Dict[str, Path],
+                 in_progress: Set[str], group: int) -> bytes:
+        directory = posixpath.dirname(relative)
+        text = content.decode("utf-8")
+
+        def replace(match: re.Match) -> str:
+            reference = match.group(group)
+            path, _, suffix = reference.partition("?")
+            target = posixpath.normpath(posixpath.join(directory, path))
+            hashed = self._build_file(target, sources, in_progress)
+            if hashed is None:
+                # Fuera del pipeline (o import circular): ruta absoluta al original en /static
+                if not (self.static_path / target).is_file():
+                    return match.group(0)
+                new_reference = f"/static/{target}"
+            else:
+                new_reference = posixpath.join(posixpath.dirname(path), posixpath.basename(hashed))
+            if path.startswith("./") and not new_reference.startswith("."):
+                new_reference = "./" + new_reference
+            start, end = match.span(group)
+            whole_start = match.start(0)
+            return match.group(0)[:start - whole_start] + new_reference + match.group(0)[end - whole_start:]
+
+        return pattern.sub(replace, text).encode("utf-8")
+
+    # ------------------------------------------
+    # Uso
+    # ------------------------------------------
+
+    def url(self, path: str) -> str:
+        """URL con hash para una ruta de /static (o la original si no está en el manifiesto)"""
+        relative = path.split("/static/", 1)[-1].lstrip("/")
+        hashed = self.manifest.get(relative)
+        return f"{self.prefix}/{hashed}" if hashed else f"/static/{relative}"
+
+    def asset_response(self, path: str, headers: Mapping[str, str]) -> Optional[Response]:
+        asset = self.assets.get(path)
+        return asset.response(headers, IMMUTABLE_CACHE) if asset else None
+
+    def page_response(self, name: str, render: Callable[[], str], headers: Mapping[str, str]) -> Response:
+        """HTML renderizado una sola vez por plantilla (las páginas no dependen de la petición)"""
+        page = self.pages.get(name)
+        if page is None:
+            page = self.pages[name] = EncodedAsset(render().encode("utf-8"), "text/html; charset=utf-8", compress=True)
+        return page.response(headers, PAGE_CACHE)
+
+    def get_stats(self):
+        """Obtener tamaño de los assets por codificación"""
+        return {"enabled": True, "pages_cached": len(self.pages), **self.stats}
@@ -1,44 +1,185 @@
-from typing import List, Dict, Optional
+from typing import Callable, Iterable, List, Dict, Optional
+from session_recorder import SessionRecorder
+from subscriptions import SubscriptionFilter, SubscriptionIndex
+from models.media import MediaItem
 from fastapi import WebSocket
+import asyncio
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Código de cierre estándar "Try Again Later"
+CLOSE_TRY_AGAIN_LATER = 1013
+
 class ConnectionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        max_connections: int = 50,
+        max_controls: int = 10,
+        max_overlays: int = 45,
+        control_reserved: int = 5,
+        retry_after: float = 5.0,
+        recorder: Optional[SessionRecorder] = None,
+        item_lookup: Optional[Callable[[str], Optional[dict]]] = None
+    ):
         self.active_connections: Dict[str, List[WebSocket]] = {
             "control": [],
             "overlay": []
         }
+        # Último envío exitoso por conexión (para heartbeats solo en inactividad)
+        self.last_sent: Dict[WebSocket, float] = {}
+        # Último mensaje recibido por conexión (para liberar overlays inactivos)
+        self.last_seen: Dict[WebSocket, float] = {}
+        
+        # Control de admisión
+        self.max_connections = max_connections
+        self.budgets = {"control": max_controls, "overlay": max_overlays}
+        self.control_reserved = control_reserved
+        self.retry_after = retry_after
+        self.admission_stats = {
+            "accepted": {"control": 0, "overlay": 0},
+            "rejected": {"control": 0, "overlay": 0},
+            "shed_overlays": 0
+        }
+        
+        # Grabación opcional de broadcasts para reproducir sesiones
+        self.recorder = recorder
+        
+        # Suscripciones selectivas de overlays; item_lookup da el item completo (formato wire)
+        # cuando un cambio lo hace entrar en una suscripción
+        self.subscriptions = SubscriptionIndex()
+        self.item_lookup = item_lookup or (lambda media_id: None)
     
-    async def connect(self, websocket: WebSocket, client_type: str):
-        """Conectar un nuevo cliente"""
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, client_type: str) -> bool:
+        """Conectar un nuevo cliente respetando los límites de conexiones"""
+        admitted, victim = self._admit(client_type)
+        
+        if not admitted:
+            self.admission_stats["rejected"][client_type] += 1
+            logger.warning(f"🚫 Conexión {client_type} rechazada - {self.get_connection_count()}")
+            await self.reject(websocket, "server_full")
+            return False
+        
+        # Reservar el lugar antes del primer await para que la decisión sea atómica
+        now = time.monotonic()
         self.active_connections[client_type].append(websocket)
+        self.last_sent[websocket] = now
+        self.last_seen[websocket] = now
+        self.admission_stats["accepted"][client_type] += 1
+        
+        if victim:
+            self.disconnect(victim, "overlay")
+            self.admission_stats["shed_overlays"] += 1
+            logger.warning("♻️ Overlay liberado para admitir un panel de control")
+            asyncio.create_task(self.reject(victim, "shed", accepted=True))
+        
+        try:
+            await websocket.accept()
+        except Exception:
+            self.disconnect(websocket, client_type)
+            raise
+        
         logger.info(f"Nueva conexión {client_type} - Total: {len(self.active_connections[client_type])}")
+        return True
+    
+    def _admit(self, client_type: str):
+        """Decidir admisión; retorna (admitido, overlay a liberar o None)"""
+        controls = len(self.active_connections["control"])
+        overlays = len(self.active_connections["overlay"])
+        total = controls + overlays
+        
+        if client_type == "control":
+            if controls >= self.budgets["control"]:
+                return False, None
+            if total < self.max_connections:
+                return True, None
+            # Los paneles de control tienen prioridad: liberar el overlay menos activo
+            victim = self._least_recently_active_overlay()
+            return (victim is not None), victim
+        
+        # Los overlays no pueden ocupar los lugares reservados a controles. Un overlay sano
+        # no envía nada en régimen estable, así que con el cupo lleno se rechaza al nuevo:
+        # desalojar a uno establecido solo provocaría un ciclo de reconexiones
+        overlay_limit = min(self.budgets["overlay"], self.max_connections - self.control_reserved)
+        if overlays < overlay_limit and total < self.max_connections:
+            return True, None
+        return False, None
+    
+    def _least_recently_active_overlay(self) -> Optional[WebSocket]:
+        """Overlay con la actividad entrante más antigua"""
+        overlays = self.active_connections["overlay"]
+        if not overlays:
+            return None
+        return min(overlays, key=lambda conn: self.last_seen.get(conn, 0))
+    
+    async def reject(self, websocket: WebSocket, reason: str, accepted: bool = False):
+        """Cerrar la conexión con código 1013 y sugerencia de reintento"""
+        try:
+            if not accepted:
+                await websocket.accept()
+            await asyncio.wait_for(websocket.send_json({
+                "action": "connection_rejected",
+                "reason": reason,
+                "retry_after": self.retry_after
+            }), timeout=self.retry_after)
+            await asyncio.wait_for(
+                websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason=reason),
+                timeout=self.retry_after
+            )
+        except Exception as e:
+            logger.debug(f"Error cerrando conexión rechazada: {e!r}")
+    
+    def subscribe(self, websocket: WebSocket, subscription: SubscriptionFilter, items: Iterable[MediaItem]):
+        """Limitar los broadcasts que recibe un overlay a los items de su filtro"""
+        self.subscriptions.subscribe(websocket, subscription, items)
+        logger.info(f"🎯 Overlay suscrito a {subscription.describe()}: {len(self.subscriptions.item_ids(subscription))} items")
+    
+    def touch(self, websocket: WebSocket):
+        """Registrar actividad entrante de un cliente"""
+        if websocket in self.last_seen:
+            self.last_seen[websocket] = time.monotonic()
     
     def disconnect(self, websocket: WebSocket, client_type: str):
         """Desconectar un cliente"""
         if websocket in self.active_connections[client_type]:
             self.active_connections[client_type].remove(websocket)
+            self.last_sent.pop(websocket, None)
+            self.last_seen.pop(websocket, None)
+            self.subscriptions.unsubscribe(websocket)
             logger.info(f"Conexión {client_type} desconectada - Total: {len(self.active_connections[client_type])}")
     
     async def broadcast_to_overlays(self, message: dict, exclude: Optional[WebSocket] = None):
-        """Enviar mensaje a todos los overlays (excluyendo opcionalmente uno)"""
+        """Enviar mensaje a todos los overlays (excluyendo opcionalmente uno).
+
+        Los overlays con suscripción solo reciben los cambios de sus items, según el índice.
+        """
+        if self.recorder:
+            self.recorder.record_broadcast("overlay", message)
+        
+        overlays = self.active_connections["overlay"]
+        if self.subscriptions.active:
+            unfiltered = [conn for conn in overlays if not self.subscriptions.is_filtered(conn)]
+            deliveries = [(message, unfiltered)] + self.subscriptions.route(message, self.item_lookup)
+        else:
+            deliveries = [(message, overlays)]
+        
         disconnected = []
         sent_count = 0
         
-        for connection in self.active_connections["overlay"]:
-            if exclude and connection == exclude:
-                continue
-                
-            try:
-                await connection.send_json(message)
-                sent_count += 1
-            except Exception as e:
-                logger.warning(f"Error enviando a overlay: {e}")
-                disconnected.append(connection)
+        for payload, connections in deliveries:
+            for connection in connections:
+                if exclude and connection == exclude:
+                    continue
+                    
+                try:
+                    await connection.send_json(payload)
+                    self.last_sent[connection] = time.monotonic()
+                    sent_count += 1
+                except Exception as e:
+                    logger.warning(f"Error enviando a overlay: {e}")
+                    disconnected.append(connection)
         
         # Limpiar conexiones muertas
         for conn in disconnected:
@@ -48,6 +189,9 @@ class ConnectionManager:
     
     async def broadcast_to_controls(self, message: dict, exclude: Optional[WebSocket] = None):
         """Enviar mensaje a todos los paneles de control (excluyendo opcionalmente uno)"""
+        if self.recorder:
+            self.recorder.record_broadcast("control", message)
+        
         disconnected = []
         sent_count = 0
         
@@ -57,6 +201,7 @@ class ConnectionManager:
                 
             try:
                 await connection.send_json(message)
+                self.last_sent[connection] = time.monotonic()
                 sent_count += 1
             except Exception as e:
                 logger.warning(f"Error enviando a control: {e}")
@@ -68,10 +213,60 @@ class ConnectionManager:
         
         logger.debug(f"Mensaje broadcast a {sent_count} controles: {message.get('action', 'unknown')}")
     
+    async def send_heartbeats(
+        self,
+        message: dict,
+        idle_seconds: float,
+        send_timeout: float,
+        per_subscription: Optional[Dict[SubscriptionFilter, dict]] = None
+    ) -> int:
+        """Enviar heartbeat solo a conexiones inactivas y cerrar las que no respondan a tiempo.
+
+        `per_subscription` reemplaza el mensaje para los overlays suscritos (checksum de su subconjunto).
+        """
+        per_subscription = per_subscription or {}
+        now = time.monotonic()
+        targets = [
+            (connection, client_type)
+            for client_type, connections in self.active_connections.items()
+            for connection in connections
+            if now - self.last_sent.get(connection, 0) >= idle_seconds
+        ]
+        
+        if not targets:
+            return 0
+        
+        async def send_one(connection: WebSocket) -> bool:
+            payload = per_subscription.get(self.subscriptions.filter_for(connection), message)
+            try:
+                await asyncio.wait_for(connection.send_json(payload), timeout=send_timeout)
+                self.last_sent[connection] = time.monotonic()
+                return True
+            except Exception as e:
+                logger.warning(f"Heartbeat fallido, cerrando conexión: {e!r}")
+                return False
+        
+        results = await asyncio.gather(*(send_one(conn) for conn, _ in targets))
+        
+        # Cerrar y limpiar conexiones muertas
+        for (conn, client_type), ok in zip(targets, results):
+            if ok:
+                continue
+            self.disconnect(conn, client_type)
+            try:
+                await asyncio.wait_for(conn.close(code=1011), timeout=send_timeout)
+            except Exception:
+                pass
+        
+        sent_count = sum(results)
+        logger.debug(f"Heartbeat enviado a {sent_count}/{len(targets)} conexiones inactivas")
+        return sent_count
+    
     async def send_personal_message(self, message: dict, websocket: WebSocket):
         """Enviar mensaje a un cliente específico"""
         try:
             await websocket.send_json(message)
+            self.last_sent[websocket] = time.monotonic()
             return True
         except Exception as e:
             logger.error(f"Error enviando mensaje personal: {e}")
@@ -85,6 +280,16 @@ class ConnectionManager:
             "total": len(self.active_connections["control"]) + len(self.active_connections["overlay"])
         }
     
+    def get_admission_stats(self):
+        """Obtener presupuestos y contadores del control de admisión"""
+        return {
+            "max_connections": self.max_connections,
+            "budgets": dict(self.budgets),
+            "control_reserved": self.control_reserved,
+            "retry_after": self.retry_after,
+            **self.admission_stats
+        }
+    
     def has_overlays(self):
         """Verificar si hay overlays conectados"""
         return len(self.active_connections["overlay"]) > 0
@@ -5,15 +5,25 @@ import uuid
 import time
 from pathlib import Path
 from fastapi import FastAPI, WebSocket, Request, UploadFile, File, WebSocketDisconnect, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from models.media import MediaItem, MediaState, OperationRequest, OperationResponse
+from models.media import MediaItem, MediaState, create_media_item, subset_root, DIGEST_BUCKETS, OperationRequest, OperationResponse
 from connection_manager import ConnectionManager
+from rate_limiter import RateLimiter, ALLOW, COALESCE
+from models.history import EditHistory
+from session_recorder import SessionRecorder
+from relay import UpstreamRelay, MUTATING_ACTIONS
+from subscriptions import SubscriptionFilter, RoutingAttrs
+from uploads import UploadManager, UploadCreate, UploadFinalize, UploadError, ALLOWED_MEDIA_TYPES
+from media_probe import LibraryIndex, fit_size
+from preload import PreloadTracker, PreloadAsset
+from asset_pipeline import AssetPipeline
+from collections import deque
 import json
 import asyncio
-from typing import Dict, Optional
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
 # ==========================================
 # CONFIGURACIÓN PARA RAILWAY
@@ -25,14 +35,67 @@ class Config:
     DEBUG = os.getenv("DEBUG", "false").lower() == "true"
     MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 50 * 1024 * 1024))
     MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 50))
+    # Control de admisión: presupuestos separados por tipo de cliente
+    MAX_CONTROL_CONNECTIONS = int(os.getenv("MAX_CONTROL_CONNECTIONS", 10))
+    CONTROL_RESERVED_SLOTS = int(os.getenv("CONTROL_RESERVED_SLOTS", 5))
+    MAX_OVERLAY_CONNECTIONS = int(os.getenv("MAX_OVERLAY_CONNECTIONS", MAX_CONNECTIONS - CONTROL_RESERVED_SLOTS))
+    ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", 5))
+    # Rate limiting de mensajes entrantes por conexión (mensajes/s, 0 = desactivado)
+    RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", 60))
+    RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 120))
+    # Límites por acción: "accion:rate:burst,..."
+    RATE_LIMIT_ACTIONS = os.getenv(
+        "RATE_LIMIT_ACTIONS",
+        "update_property:30:60,add_media:5:10,clear_all:1:3,request_sync:2:5,verify_version:2:5,verify_digest:2:5,resync_buckets:2:5,undo:10:20,redo:10:20"
+    )
+    # Historial de deshacer/rehacer
+    UNDO_MAX_STEPS = int(os.getenv("UNDO_MAX_STEPS", 500))
+    UNDO_MAX_BYTES = int(os.getenv("UNDO_MAX_BYTES", 2 * 1024 * 1024))
+    # Actualizaciones de la misma propiedad dentro de esta ventana forman un solo paso
+    UNDO_GROUP_WINDOW = float(os.getenv("UNDO_GROUP_WINDOW", 0.5))
+    # Heartbeat de versión enviado por el servidor (segundos, 0 = desactivado)
+    HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 15))
+    # Ping/pong de protocolo WebSocket para detectar conexiones muertas
+    WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", 20))
+    WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", 20))
+    # Grabación opt-in del tráfico WebSocket (ver replay_session.py)
+    SESSION_RECORDING = os.getenv("SESSION_RECORDING", "false").lower() == "true"
+    SESSION_RECORDING_PATH = Path(os.getenv("SESSION_RECORDING_PATH", "./recordings"))
+    SESSION_RECORDING_MAX_BYTES = int(os.getenv("SESSION_RECORDING_MAX_BYTES", 20 * 1024 * 1024))
+    SESSION_RECORDING_MAX_FILES = int(os.getenv("SESSION_RECORDING_MAX_FILES", 10))
+    SESSION_RECORDING_FLUSH_INTERVAL = float(os.getenv("SESSION_RECORDING_FLUSH_INTERVAL", 1.0))
+    # Modo relay: espejo de solo lectura de otro servidor (p. ej. ws://principal:8000)
+    RELAY_UPSTREAM = os.getenv("RELAY_UPSTREAM", "")
+    RELAY_RECONNECT_DELAY = float(os.getenv("RELAY_RECONNECT_DELAY", 2))
+    RELAY_MAX_RECONNECT_DELAY = float(os.getenv("RELAY_MAX_RECONNECT_DELAY", 30))
     MEDIA_PATH = Path(os.getenv("MEDIA_PATH", "./static/media"))
+    # Subidas reanudables por trozos (fuera de /static: los archivos parciales no se sirven)
+    UPLOAD_STAGING_PATH = Path(os.getenv("UPLOAD_STAGING_PATH", "./uploads"))
+    UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024))
+    UPLOAD_STALE_AFTER = float(os.getenv("UPLOAD_STALE_AFTER", 24 * 3600))
+    UPLOAD_GC_INTERVAL = float(os.getenv("UPLOAD_GC_INTERVAL", 600))
+    UPLOAD_MAX_ACTIVE = int(os.getenv("UPLOAD_MAX_ACTIVE", 20))
+    # Pistas de precarga a overlays: bytes sugeridos como máximo por overlay (0 = desactivado)
+    PRELOAD_MAX_BYTES = int(os.getenv("PRELOAD_MAX_BYTES", 256 * 1024 * 1024))
+    # Subidas recientes que se sugieren a los overlays al conectarse
+    PRELOAD_RECENT_UPLOADS = int(os.getenv("PRELOAD_RECENT_UPLOADS", 5))
     TEMPLATES_PATH = Path("./templates")
+    # CSS/JS con hash en el nombre, precomprimidos y con caché inmutable; HTML renderizado en caché
+    ASSET_PIPELINE = os.getenv("ASSET_PIPELINE", "false" if DEBUG else "true").lower() == "true"
     STATIC_PATH = Path("./static")
     RAILWAY_ENV = os.getenv("RAILWAY_ENVIRONMENT_NAME", "development")
     RAILWAY_PROJECT = os.getenv("RAILWAY_PROJECT_NAME", "obs-control")
 
 config = Config()
 
+def parse_action_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """Convertir "accion:rate:burst,..." en un diccionario de límites"""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        action, rate, burst = entry.split(":")
+        limits[action] = (float(rate), float(burst))
+    return limits
+
 # ==========================================
 # LOGGING CONFIGURACIÓN
 # ==========================================
@@ -63,6 +126,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def relay_media_fallback(request: Request, call_next):
+    """En modo relay, los archivos de media que no existen localmente se sirven desde el principal"""
+    path = request.url.path
+    if relay and path.startswith("/static/media/") and not (config.MEDIA_PATH / Path(path).name).is_file():
+        return RedirectResponse(f"{relay.http_base}{path}", status_code=307)
+    return await call_next(request)
+
 # Crear directorios necesarios
 config.MEDIA_PATH.mkdir(parents=True, exist_ok=True)
 
@@ -70,33 +141,256 @@ config.MEDIA_PATH.mkdir(parents=True, exist_ok=True)
 templates = Jinja2Templates(directory=str(config.TEMPLATES_PATH))
 app.mount("/static", StaticFiles(directory=str(config.STATIC_PATH)), name="static")
 
+# Se construye en el startup; las plantillas piden sus assets con asset_url('/static/...')
+assets = AssetPipeline(config.STATIC_PATH, exclude={config.MEDIA_PATH}) if config.ASSET_PIPELINE else None
+templates.env.globals["asset_url"] = assets.url if assets else (lambda path: path)
+
 # Estado global mejorado
 media_state = MediaState()
-manager = ConnectionManager()
+recorder = SessionRecorder(
+    config.SESSION_RECORDING_PATH,
+    max_file_bytes=config.SESSION_RECORDING_MAX_BYTES,
+    max_files=config.SESSION_RECORDING_MAX_FILES,
+    flush_interval=config.SESSION_RECORDING_FLUSH_INTERVAL
+) if config.SESSION_RECORDING else None
+manager = ConnectionManager(
+    max_connections=config.MAX_CONNECTIONS,
+    max_controls=config.MAX_CONTROL_CONNECTIONS,
+    max_overlays=config.MAX_OVERLAY_CONNECTIONS,
+    control_reserved=config.CONTROL_RESERVED_SLOTS,
+    retry_after=config.ADMISSION_RETRY_AFTER,
+    recorder=recorder,
+    item_lookup=lambda media_id: media_state.items[media_id].to_wire() if media_id in media_state.items else None
+)
+relay = UpstreamRelay(
+    config.RELAY_UPSTREAM,
+    media_state,
+    manager,
+    reconnect_delay=config.RELAY_RECONNECT_DELAY,
+    max_reconnect_delay=config.RELAY_MAX_RECONNECT_DELAY
+) if config.RELAY_UPSTREAM else None
+rate_limiter = RateLimiter(
+    rate=config.RATE_LIMIT_RATE,
+    burst=config.RATE_LIMIT_BURST,
+    action_limits=parse_action_limits(config.RATE_LIMIT_ACTIONS)
+)
+uploads = UploadManager(
+    config.UPLOAD_STAGING_PATH,
+    config.MEDIA_PATH,
+    max_file_size=config.MAX_FILE_SIZE,
+    chunk_size=config.UPLOAD_CHUNK_SIZE,
+    stale_after=config.UPLOAD_STALE_AFTER,
+    max_active=config.UPLOAD_MAX_ACTIVE
+)
+library = LibraryIndex(config.MEDIA_PATH)
+preloads = PreloadTracker(max_bytes=config.PRELOAD_MAX_BYTES)
+recent_uploads: Deque[PreloadAsset] = deque(maxlen=config.PRELOAD_RECENT_UPLOADS)
+history = EditHistory(
+    max_steps=config.UNDO_MAX_STEPS,
+    max_bytes=config.UNDO_MAX_BYTES,
+    group_window=config.UNDO_GROUP_WINDOW
+)
 
 # Cola de operaciones pendientes para confirmación
 pending_operations: Dict[str, OperationRequest] = {}
 
+# Tarea de heartbeat en segundo plano
+heartbeat_task: Optional[asyncio.Task] = None
+
+# Limpieza de subidas abandonadas
+upload_gc_task: Optional[asyncio.Task] = None
+
 # ==========================================
 # FUNCIONES DE UTILIDAD
 # ==========================================
 
 async def validate_media_state():
     """Validar y limpiar elementos inválidos del estado"""
-    invalid_items = []
+    # Verificar cada archivo distinto una sola vez, sin bloquear el event loop
+    urls = media_state.referenced_urls()
+    exists = await asyncio.gather(*(asyncio.to_thread(Path(f".{url}").exists) for url in urls))
     
-    for media_id, item in media_state.items.items():
-        file_path = Path(f".{item.url}")
-        if not file_path.exists():
-            invalid_items.append(media_id)
-            logger.warning(f"⚠️ Archivo no encontrado para media {media_id}: {item.url}")
+    invalid_items = []
+    for url, found in zip(urls, exists):
+        if not found:
+            media_ids = media_state.items_for_url(url)
+            invalid_items.extend(media_ids)
+            logger.warning(f"⚠️ Archivo no encontrado para {len(media_ids)} media: {url}")
     
-    for media_id in invalid_items:
-        media_state.remove_item(media_id)
-        logger.info(f"🗑️ Elemento inválido eliminado: {media_id}")
+    for removed in media_state.remove_items(invalid_items):
+        logger.info(f"🗑️ Elemento inválido eliminado: {removed.id}")
     
     return len(invalid_items)
 
+async def heartbeat_loop():
+    """Enviar versión/checksum a los clientes inactivos en cada intervalo"""
+    while True:
+        await asyncio.sleep(config.HEARTBEAT_INTERVAL)
+        try:
+            message = {
+                "action": "heartbeat",
+                "version": media_state.version,
+                "checksum": media_state.checksum or media_state.calculate_checksum()
+            }
+            # Los overlays suscritos comparan contra la raíz de su subconjunto
+            per_subscription = {
+                subscription: {**message, "checksum": subset_root(media_state.subset_hashes(manager.subscriptions.item_ids(subscription)))}
+                for subscription in manager.subscriptions.members
+            }
+            await manager.send_heartbeats(
+                message,
+                idle_seconds=config.HEARTBEAT_INTERVAL,
+                send_timeout=config.WS_PING_TIMEOUT,
+                per_subscription=per_subscription
+            )
+        except Exception as e:
+            logger.error(f"❌ Error en heartbeat: {e}")
+
+def build_media_item(media: dict, media_id: str) -> MediaItem:
+    """Crear un MediaItem desde el payload de add_media; los campos omitidos toman su valor por defecto"""
+    fields = {k: v for k, v in media.items() if v is not None}
+    fields.update(
+        id=media_id,
+        type=media.get("type", "image"),
+        # Un item agregado oculto se precarga en los overlays (ver hint_hidden_item)
+        visible=media.get("visible") is not False,
+        z_index=media.get("z_index", len(media_state.items))
+    )
+    return create_media_item(**fields)
+
+def subscribed_ids(websocket: Optional[WebSocket]) -> Optional[Set[str]]:
+    """Items visibles para una conexión (None = todos)"""
+    subscription = manager.subscriptions.filter_for(websocket) if websocket else None
+    return manager.subscriptions.item_ids(subscription) if subscription else None
+
+def state_root(websocket: Optional[WebSocket] = None) -> str:
+    """Raíz del árbol de digests tal como la ve la conexión"""
+    ids = subscribed_ids(websocket)
+    if ids is None:
+        return media_state.checksum or media_state.calculate_checksum()
+    return subset_root(media_state.subset_hashes(ids))
+
+def property_error(media_id: str, property_name: str) -> Optional[str]:
+    """Error si el item no tiene esa propiedad (cada tipo declara las suyas)"""
+    item = media_state.items.get(media_id)
+    if item is not None and property_name not in type(item).model_fields:
+        return f"Propiedad '{property_name}' no válida para items de tipo {item.type}"
+    return None
+
+def build_sync_state(websocket: Optional[WebSocket] = None) -> dict:
+    """Mensaje sync_state compacto con los hashes de items (hojas del árbol de digests)"""
+    ids = subscribed_ids(websocket)
+    return {
+        "action": "sync_state",
+        "state": media_state.to_wire(ids),  # Compacto: el cliente completa los valores por defecto
+        "hashes": media_state.item_hashes() if ids is None else media_state.subset_hashes(ids),
+        "version": media_state.version,
+        "checksum": state_root(websocket),
+        # El cliente ajusta su watchdog a este intervalo (0 = sin heartbeats)
+        "heartbeat_interval": config.HEARTBEAT_INTERVAL
+    }
+
+def preload_asset(url: str, media_type: str) -> Optional[PreloadAsset]:
+    """Asset precargable de la carpeta de media (None si no es un archivo local)"""
+    if not url.startswith("/static/media/"):
+        return None
+    try:
+        size = (config.MEDIA_PATH / Path(url).name).stat().st_size
+    except OSError:
+        return None
+    return PreloadAsset(url, media_type, size)
+
+async def send_preload_hints(websocket: WebSocket, assets: Iterable[PreloadAsset], reason: str):
+    """Sugerir a un overlay descargar assets que probablemente se muestren pronto"""
+    selected = preloads.plan(websocket, assets)
+    if selected:
+        await manager.send_personal_message({
+            "action": "preload",
+            "reason": reason,
+            "assets": [asset._asdict() for asset in selected]
+        }, websocket)
+
+async def send_initial_preload_hints(websocket: WebSocket):
+    """Al conectarse: items ocultos de su suscripción y, sin filtro, las subidas recientes"""
+    ids = subscribed_ids(websocket)
+    assets = [
+        preload_asset(item.url, item.type)
+        for item in media_state.items.values()
+        if not item.visible and (ids is None or item.id in ids)
+    ]
+    if ids is None:
+        assets += recent_uploads
+    await send_preload_hints(websocket, [asset for asset in assets if asset], "connect")
+
+async def hint_hidden_item(media_item: MediaItem):
+    """Un item agregado oculto se mostrará pronto: precargarlo donde está suscrito.
+
+    Se llama antes de difundir el add_media, así que la suscripción se evalúa con su filtro
+    (el índice todavía no enrutó el item).
+    """
+    if media_item.visible or not preloads.connections:
+        return
+    asset = preload_asset(media_item.url, media_item.type)
+    if asset is None:
+        return
+    attrs = RoutingAttrs.from_item(media_item)
+    for websocket in list(preloads.connections):
+        subscription = manager.subscriptions.filter_for(websocket)
+        if subscription is None or subscription.matches(attrs, media_item.id):
+            await send_preload_hints(websocket, [asset], "hidden")
+
+async def hint_recent_upload(item: dict):
+    """Un archivo recién subido suele agregarse enseguida"""
+    asset = preload_asset(item["url"], item["type"])
+    if asset is None:
+        return
+    recent_uploads.appendleft(asset)
+    for websocket in list(preloads.connections):
+        # Los overlays con filtro solo muestran sus items: no adivinar
+        if subscribed_ids(websocket) is None:
+            await send_preload_hints(websocket, [asset], "upload")
+
+async def send_digest_buckets(websocket: WebSocket, message: dict):
+    """Responder verify_digest: la raíz coincide o se envían los digests de cada bucket"""
+    root = state_root(websocket)
+    
+    if message.get("root") == root:
+        await websocket.send_json({
+            "action": "digest_match",
+            "version": media_state.version,
+            "checksum": root
+        })
+        return
+    
+    # Sin version/checksum: el cliente aún no está sincronizado con ellos
+    ids = subscribed_ids(websocket)
+    await websocket.send_json({
+        "action": "digest_buckets",
+        "buckets": media_state.bucket_digests() if ids is None else media_state.subset_bucket_digests(ids),
+        "server_version": media_state.version,
+        "server_checksum": root
+    })
+
+async def send_partial_sync(websocket: WebSocket, message: dict):
+    """Enviar solo los items que difieren en los buckets indicados por el cliente"""
+    client_buckets = {
+        int(bucket): hashes
+        for bucket, hashes in message.get("buckets", {}).items()
+        if 0 <= int(bucket) < DIGEST_BUCKETS
+    }
+    changed, removed = media_state.diff_buckets(client_buckets, only=subscribed_ids(websocket))
+    
+    await websocket.send_json({
+        "action": "partial_sync",
+        "items": {item.id: item.to_wire() for item in changed},
+        "hashes": {item.id: media_state.item_hash(item.id) for item in changed},
+        "removed": removed,
+        "version": media_state.version,
+        "checksum": state_root(websocket)
+    })
+    
+    logger.info(f"🌳 Resincronización parcial v{media_state.version}: {len(changed)} items, {len(removed)} eliminados ({len(client_buckets)}/{DIGEST_BUCKETS} buckets)")
+
 async def send_operation_response(websocket: WebSocket, operation: OperationRequest, success: bool, error: Optional[str] = None, data: Optional[dict] = None):
     """Enviar respuesta de confirmación para una operación"""
     response = OperationResponse(
@@ -108,414 +402,512 @@ async def send_operation_response(websocket: WebSocket, operation: OperationRequ
         error=error,
         data=data
     )
+    pending_operations.pop(operation.request_id, None)
     
     await websocket.send_json({
         "action": "operation_response",
         "response": response.model_dump()
     })
 
+# ==========================================
+# PROCESAMIENTO DE MENSAJES
+# ==========================================
+
+async def apply_rate_limit(
+    websocket: WebSocket,
+    message: dict,
+    process: Callable[[WebSocket, dict], Awaitable[None]]
+) -> bool:
+    """Aplicar rate limiting; retorna True si el mensaje debe procesarse ahora"""
+    decision = rate_limiter.check(websocket, message)
+    if decision == ALLOW:
+        return True
+    
+    if decision == COALESCE:
+        # Solo el último valor de la propiedad se aplicará cuando haya tokens
+        superseded = rate_limiter.defer(websocket, message, lambda latest: process(websocket, latest))
+        if superseded and "request_id" in superseded:
+            operation = OperationRequest(
+                request_id=superseded["request_id"],
+                action=superseded["action"],
+                data=superseded
+            )
+            await send_operation_response(websocket, operation, True, data={"coalesced": True})
+        return False
+    
+    if "request_id" in message:
+        operation = OperationRequest(
+            request_id=message["request_id"],
+            action=message.get("action", ""),
+            data=None
+        )
+        await send_operation_response(
+            websocket, operation, False,
+            error="rate_limited",
+            data={"retry_after": rate_limiter.retry_after(websocket, operation.action)}
+        )
+    return False
+
+async def apply_history(websocket: WebSocket, operation: Optional[OperationRequest], action: str):
+    """Deshacer o rehacer un paso y difundir solo los cambios resultantes"""
+    changes = history.undo(media_state) if action == "undo" else history.redo(media_state)
+    hashes = {}
+    
+    for change in changes:
+        kind = change[0]
+        if kind == "add":
+            item = change[1]
+            media_dict = item.to_wire()
+            hashes[item.id] = media_state.item_hash(item.id)
+            overlay_message = {"action": "add_media", "media": media_dict, "item_hash": hashes[item.id]}
+            control_message = {"action": "media_added", "media": media_dict, "item_hash": hashes[item.id]}
+        elif kind == "remove":
+            hashes[change[1]] = None
+            overlay_message = {"action": "remove_media", "media_id": change[1]}
+            control_message = {"action": "media_removed", "media_id": change[1]}
+        elif kind == "update":
+            _, media_id, property_name, value = change
+            hashes[media_id] = media_state.item_hash(media_id)
+            overlay_message = {"action": "update_property", "media_id": media_id, "property": property_name, "value": value, "item_hash": hashes[media_id]}
+            control_message = {**overlay_message, "action": "property_updated"}
+        else:
+            overlay_message = {"action": "clear_all"}
+            control_message = {"action": "overlay_cleared"}
+        
+        stamp = {"version": media_state.version, "checksum": media_state.checksum}
+        await manager.broadcast_to_overlays({**overlay_message, **stamp})
+        await manager.broadcast_to_controls({**control_message, **stamp})
+    
+    if operation:
+        await send_operation_response(websocket, operation, True, data={
+            "applied": len(changes) > 0,
+            "hashes": hashes,
+            "can_undo": history.can_undo(),
+            "can_redo": history.can_redo()
+        })
+    
+    icon = "↩️" if action == "undo" else "↪️"
+    logger.info(f"{icon} {action} v{media_state.version}: {len(changes)} cambios")
+
+async def process_control_message(websocket: WebSocket, message: dict):
+    """Procesar un mensaje de un panel de control"""
+    # Crear operación si tiene request_id
+    operation = None
+    if "request_id" in message:
+        operation = OperationRequest(
+            request_id=message["request_id"],
+            action=message["action"],
+            data=message
+        )
+        pending_operations[operation.request_id] = operation
+    
+    try:
+        if message["action"] == "add_media":
+            media = message["media"]
+            media_id = media.get("id", str(uuid.uuid4()))
+            
+            media_item = build_media_item(media, media_id)
+            history.record_add(media_item, media_state.items.get(media_id))
+            
+            # Actualizar estado con versionado
+            media_state.add_item(media_item)
+            media_dict = media_item.to_wire()
+            # Las pistas van antes del add_media para adelantarse al montaje del elemento
+            await hint_hidden_item(media_item)
+            
+            # Enviar a overlays
+            await manager.broadcast_to_overlays({
+                "action": "add_media",
+                "media": media_dict,
+                "item_hash": media_state.item_hash(media_id),
+                "version": media_state.version,
+                "checksum": media_state.checksum
+            })
+            
+            # Confirmar operación
+            if operation:
+                await send_operation_response(websocket, operation, True, data={"media": media_dict, "hashes": {media_id: media_state.item_hash(media_id)}})
+            
+            logger.info(f"➕ Media agregada v{media_state.version}: {media.get('filename', 'unknown')}")
+        
+        elif message["action"] == "remove_media":
+            media_id = message["media_id"]
+            removed = media_state.remove_item(media_id)
+            
+            if removed:
+                history.record_remove(removed)
+                await manager.broadcast_to_overlays({
+                    "action": "remove_media",
+                    "media_id": media_id,
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
+                
+                if operation:
+                    await send_operation_response(websocket, operation, True, data={"hashes": {media_id: None}})
+                
+                logger.info(f"➖ Media eliminada v{media_state.version}: {removed.filename}")
+            else:
+                if operation:
+                    await send_operation_response(websocket, operation, False, error="Media no encontrada")
+        
+        elif message["action"] == "update_property":
+            media_id = message["media_id"]
+            property_name = message["property"]
+            value = message["value"]
+            error = property_error(media_id, property_name)
+            
+            if error:
+                if operation:
+                    await send_operation_response(websocket, operation, False, error=error)
+                logger.warning(f"⚠️ {error}")
+            elif media_id in media_state.items:
+                before = media_state.items[media_id].model_dump(mode='json', include={property_name}).get(property_name)
+                media_state.update_item(media_id, {property_name: value})
+                history.record_update(media_id, property_name, before, value)
+                
+                await manager.broadcast_to_overlays({
+                    "action": "update_property",
+                    "media_id": media_id,
+                    "property": property_name,
+                    "value": value,
+                    "item_hash": media_state.item_hash(media_id),
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
+                
+                if operation:
+                    await send_operation_response(websocket, operation, True, data={"hashes": {media_id: media_state.item_hash(media_id)}})
+                
+                logger.info(f"🔧 Propiedad actualizada v{media_state.version}: {media_id}.{property_name}")
+            else:
+                if operation:
+                    await send_operation_response(websocket, operation, False, error="Media no encontrada")
+        
+        elif message["action"] == "clear_all":
+            cleared_count = len(media_state.items)
+            history.record_clear(list(media_state.items.values()))
+            media_state.clear()
+            
+            await manager.broadcast_to_overlays({
+                "action": "clear_all",
+                "version": media_state.version,
+                "checksum": media_state.checksum
+            })
+            
+            if operation:
+                await send_operation_response(websocket, operation, True, data={"cleared_count": cleared_count})
+            
+            logger.info(f"🧹 Overlay limpiado v{media_state.version}: {cleared_count} elementos")
+        
+        elif message["action"] == "verify_version":
+            client_version = message.get("client_version", 0)
+            client_checksum = message.get("client_checksum", "")
+            
+            current_checksum = state_root(websocket)
+            needs_sync = (client_version != media_state.version or 
+                        client_checksum != current_checksum)
+            
+            await websocket.send_json({
+                "action": "version_check",
+                "needs_sync": needs_sync,
+                "server_version": media_state.version,
+                "server_checksum": current_checksum
+            })
+            
+            if needs_sync:
+                await websocket.send_json(build_sync_state(websocket))
+        
+        elif message["action"] == "request_sync":
+            await websocket.send_json(build_sync_state(websocket))
+        
+        elif message["action"] == "verify_digest":
+            await send_digest_buckets(websocket, message)
+        
+        elif message["action"] == "resync_buckets":
+            await send_partial_sync(websocket, message)
+        
+        elif message["action"] in ("undo", "redo"):
+            await apply_history(websocket, operation, message["action"])
+            
+    except Exception as e:
+        logger.error(f"❌ Error procesando mensaje: {e}")
+        if operation:
+            await send_operation_response(websocket, operation, False, error=str(e))
+
+async def process_overlay_message(websocket: WebSocket, message: dict):
+    """Procesar un mensaje de un overlay"""
+    # Crear operación si tiene request_id
+    operation = None
+    if "request_id" in message:
+        operation = OperationRequest(
+            request_id=message["request_id"],
+            action=message["action"],
+            data=message
+        )
+    
+    try:
+        if relay and message["action"] in MUTATING_ACTIONS:
+            if operation:
+                await send_operation_response(websocket, operation, False, error="relay_read_only")
+        
+        elif message["action"] == "request_sync":
+            await websocket.send_json(build_sync_state(websocket))
+            
+            logger.info(f"🔄 Estado sincronizado enviado a overlay: v{media_state.version}")
+        
+        elif message["action"] == "verify_digest":
+            await send_digest_buckets(websocket, message)
+        
+        elif message["action"] == "resync_buckets":
+            await send_partial_sync(websocket, message)
+        
+        elif message["action"] == "preload_ack":
+            preloads.acknowledge(websocket, message.get("cached", []), message.get("failed", []))
+        
+        elif message["action"] == "verify_version":
+            client_version = message.get("client_version", 0)
+            client_checksum = message.get("client_checksum", "")
+            
+            current_checksum = state_root(websocket)
+            needs_sync = (client_version != media_state.version or 
+                        client_checksum != current_checksum)
+            
+            await websocket.send_json({
+                "action": "version_check",
+                "needs_sync": needs_sync,
+                "server_version": media_state.version,
+                "server_checksum": current_checksum
+            })
+            
+            if needs_sync:
+                logger.info(f"⚠️ Overlay desincronizado: cliente v{client_version} vs servidor v{media_state.version}")
+                await websocket.send_json(build_sync_state(websocket))
+        
+        elif message["action"] == "add_media":
+            media = message["media"]
+            media_id = media.get("id", str(uuid.uuid4()))
+            
+            media_item = build_media_item(media, media_id)
+            history.record_add(media_item, media_state.items.get(media_id))
+            
+            media_state.add_item(media_item)
+            media_dict = media_item.to_wire()
+            # Las pistas van antes del add_media para adelantarse al montaje del elemento
+            await hint_hidden_item(media_item)
+            
+            # Notificar a TODOS los overlays
+            await manager.broadcast_to_overlays({
+                "action": "add_media",
+                "media": media_dict,
+                "item_hash": media_state.item_hash(media_id),
+                "version": media_state.version,
+                "checksum": media_state.checksum
+            })
+            
+            await manager.broadcast_to_controls({
+                "action": "media_added",
+                "media": media_dict,
+                "item_hash": media_state.item_hash(media_id),
+                "version": media_state.version,
+                "checksum": media_state.checksum
+            })
+            
+            # <<<--- AÑADIR ESTA LÍNEA ---<<<
+            if operation:
+                await send_operation_response(websocket, operation, True, data={"media": media_dict, "hashes": {media_id: media_state.item_hash(media_id)}})
+            
+            logger.info(f"➕ Media agregada desde overlay v{media_state.version}: {media.get('filename', 'unknown')}")
+        
+        elif message["action"] == "remove_media":
+            media_id = message["media_id"]
+            removed = media_state.remove_item(media_id)
+            
+            if removed:
+                history.record_remove(removed)
+                # Notificar a TODOS los overlays (sin exclude)
+                await manager.broadcast_to_overlays({
+                    "action": "remove_media",
+                    "media_id": media_id,
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
+                
+                await manager.broadcast_to_controls({
+                    "action": "media_removed",
+                    "media_id": media_id,
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
+                
+                # <<<--- ESTA PARTE YA ESTABA CORRECTA ---<<<
+                if operation:
+                    await send_operation_response(websocket, operation, True, data={"hashes": {media_id: None}})
+                
+                logger.info(f"➖ Media eliminada desde overlay v{media_state.version}: {removed.filename}")
+            else:
+                if operation:
+                    await send_operation_response(websocket, operation, False, error="Media no encontrada")
+                logger.warning(f"⚠️ Intento de eliminar media inexistente desde overlay: {media_id}")
+        
+        elif message["action"] == "update_property":
+            media_id = message["media_id"]
+            property_name = message["property"]
+            value = message["value"]
+            error = property_error(media_id, property_name)
+            
+            if error:
+                if operation:
+                    await send_operation_response(websocket, operation, False, error=error)
+                logger.warning(f"⚠️ {error}")
+            elif media_id in media_state.items:
+                before = media_state.items[media_id].model_dump(mode='json', include={property_name}).get(property_name)
+                media_state.update_item(media_id, {property_name: value})
+                history.record_update(media_id, property_name, before, value)
+                
+                await manager.broadcast_to_overlays({
+                    "action": "update_property",
+                    "media_id": media_id,
+                    "property": property_name,
+                    "value": value,
+                    "item_hash": media_state.item_hash(media_id),
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                }, exclude=websocket) # exclude=websocket es correcto aquí
+                
+                await manager.broadcast_to_controls({
+                    "action": "property_updated",
+                    "media_id": media_id,
+                    "property": property_name,
+                    "value": value,
+                    "item_hash": media_state.item_hash(media_id),
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
+                
+                # <<<--- AÑADIR ESTA LÍNEA ---<<<
+                if operation:
+                    await send_operation_response(websocket, operation, True, data={"hashes": {media_id: media_state.item_hash(media_id)}})
+                
+                logger.info(f"🔧 Propiedad actualizada desde overlay v{media_state.version}: {media_id}.{property_name}")
+            else:
+                if operation:
+                    await send_operation_response(websocket, operation, False, error="Media no encontrada")
+        
+        elif message["action"] == "clear_all":
+            cleared_count = len(media_state.items)
+            history.record_clear(list(media_state.items.values()))
+            media_state.clear()
+            
+            # Notificar a TODOS (sin exclude)
+            await manager.broadcast_to_overlays({
+                "action": "clear_all",
+                "version": media_state.version,
+                "checksum": media_state.checksum
+            })
+            
+            await manager.broadcast_to_controls({
+                "action": "overlay_cleared",
+                "version": media_state.version,
+                "checksum": media_state.checksum
+            })
+            
+            if operation:
+                await send_operation_response(websocket, operation, True, data={"cleared_count": cleared_count})
+            
+            logger.info(f"🧹 Overlay limpiado desde overlay v{media_state.version}: {cleared_count} elementos")
+        
+        elif message["action"] in ("undo", "redo"):
+            await apply_history(websocket, operation, message["action"])
+            
+    except Exception as e:
+        logger.error(f"❌ Error procesando mensaje del overlay: {e}")
+        if operation:
+            await send_operation_response(websocket, operation, False, error=str(e))
+
 # ==========================================
 # WEBSOCKET ENDPOINTS MEJORADOS
 # ==========================================
 
 @app.websocket("/ws/control")
 async def websocket_control(websocket: WebSocket):
-    await manager.connect(websocket, "control")
+    if relay:
+        # Las escrituras solo se aceptan en el servidor principal
+        await manager.reject(websocket, "relay_read_only")
+        return
+    if not await manager.connect(websocket, "control"):
+        return
     client_ip = websocket.client.host if websocket.client else "unknown"
     logger.info(f"🔌 Control conectado desde {client_ip}")
+    rate_limiter.register(websocket, "control", client_ip)
+    if recorder:
+        recorder.open(websocket, "control")
     
     try:
-        # Enviar estado inicial con versión - USAR model_dump con mode='json'
-        state_dict = media_state.model_dump(mode='json')  # IMPORTANTE: mode='json' serializa datetime
-        
-        await websocket.send_json({
-            "action": "sync_state",
-            "state": state_dict,
-            "version": media_state.version,
-            "checksum": media_state.checksum or media_state.calculate_checksum()
-        })
+        # Enviar estado inicial con versión
+        await websocket.send_json(build_sync_state(websocket))
         
         while True:
             data = await websocket.receive_text()
+            manager.touch(websocket)
             message = json.loads(data)
+            if recorder:
+                recorder.record_inbound(websocket, message)
             
-            # Crear operación si tiene request_id
-            operation = None
-            if "request_id" in message:
-                operation = OperationRequest(
-                    request_id=message["request_id"],
-                    action=message["action"],
-                    data=message
-                )
-                pending_operations[operation.request_id] = operation
-            
-            try:
-                if message["action"] == "add_media":
-                    media = message["media"]
-                    media_id = media.get("id", str(uuid.uuid4()))
-                    
-                    media_item = MediaItem(
-                        id=media_id,
-                        type=media.get("type", "image"),
-                        filename=media.get("filename", ""),
-                        url=media.get("url", ""),
-                        position=media.get("position", {"x": 100, "y": 100}),
-                        size=media.get("size", {"width": 200, "height": 200}),
-                        opacity=media.get("opacity", 1.0),
-                        volume=media.get("volume", 1.0),
-                        visible=True,
-                        z_index=media.get("z_index", len(media_state.items)),
-                        # Propiedades de texto
-                        text_content=media.get("text_content"),
-                        font_family=media.get("font_family", "Arial"),
-                        font_size=media.get("font_size", 48),
-                        font_weight=media.get("font_weight", "normal"),
-                        font_style=media.get("font_style", "normal"),
-                        text_align=media.get("text_align", "left"),
-                        text_color=media.get("text_color", "#ffffff"),
-                        text_shadow=media.get("text_shadow", False),
-                        text_shadow_color=media.get("text_shadow_color", "#000000"),
-                        text_shadow_blur=media.get("text_shadow_blur", 2),
-                        text_shadow_offset=media.get("text_shadow_offset", {"x": 1, "y": 1}),
-                        background_color=media.get("background_color"),
-                        padding=media.get("padding", {"top": 10, "right": 10, "bottom": 10, "left": 10})
-                    )
-                    
-                    # Actualizar estado con versionado
-                    media_state.add_item(media_item)
-                    media_dict = media_item.model_dump(mode='json')
-                    
-                    # Enviar a overlays
-                    await manager.broadcast_to_overlays({
-                        "action": "add_media",
-                        "media": media_dict,
-                        "version": media_state.version,
-                        "checksum": media_state.checksum
-                    })
-                    
-                    # Confirmar operación
-                    if operation:
-                        await send_operation_response(websocket, operation, True, data={"media": media_dict})
-                    
-                    logger.info(f"➕ Media agregada v{media_state.version}: {media.get('filename', 'unknown')}")
-                
-                elif message["action"] == "remove_media":
-                    media_id = message["media_id"]
-                    removed = media_state.remove_item(media_id)
-                    
-                    if removed:
-                        await manager.broadcast_to_overlays({
-                            "action": "remove_media",
-                            "media_id": media_id,
-                            "version": media_state.version,
-                            "checksum": media_state.checksum
-                        })
-                        
-                        if operation:
-                            await send_operation_response(websocket, operation, True)
-                        
-                        logger.info(f"➖ Media eliminada v{media_state.version}: {removed.filename}")
-                    else:
-                        if operation:
-                            await send_operation_response(websocket, operation, False, error="Media no encontrada")
-                
-                elif message["action"] == "update_property":
-                    media_id = message["media_id"]
-                    property_name = message["property"]
-                    value = message["value"]
-                    
-                    if media_id in media_state.items:
-                        media_state.update_item(media_id, {property_name: value})
-                        
-                        await manager.broadcast_to_overlays({
-                            "action": "update_property",
-                            "media_id": media_id,
-                            "property": property_name,
-                            "value": value,
-                            "version": media_state.version,
-                            "checksum": media_state.checksum
-                        })
-                        
-                        if operation:
-                            await send_operation_response(websocket, operation, True)
-                        
-                        logger.info(f"🔧 Propiedad actualizada v{media_state.version}: {media_id}.{property_name}")
-                    else:
-                        if operation:
-                            await send_operation_response(websocket, operation, False, error="Media no encontrada")
-                
-                elif message["action"] == "clear_all":
-                    cleared_count = len(media_state.items)
-                    media_state.clear()
-                    
-                    await manager.broadcast_to_overlays({
-                        "action": "clear_all",
-                        "version": media_state.version,
-                        "checksum": media_state.checksum
-                    })
-                    
-                    if operation:
-                        await send_operation_response(websocket, operation, True, data={"cleared_count": cleared_count})
-                    
-                    logger.info(f"🧹 Overlay limpiado v{media_state.version}: {cleared_count} elementos")
-                
-                elif message["action"] == "verify_version":
-                    client_version = message.get("client_version", 0)
-                    client_checksum = message.get("client_checksum", "")
-                    
-                    current_checksum = media_state.checksum or media_state.calculate_checksum()
-                    needs_sync = (client_version != media_state.version or 
-                                client_checksum != current_checksum)
-                    
-                    await websocket.send_json({
-                        "action": "version_check",
-                        "needs_sync": needs_sync,
-                        "server_version": media_state.version,
-                        "server_checksum": current_checksum
-                    })
-                    
-                    if needs_sync:
-                        state_dict = media_state.model_dump(mode='json')  # IMPORTANTE: mode='json'
-                        await websocket.send_json({
-                            "action": "sync_state",
-                            "state": state_dict,
-                            "version": media_state.version,
-                            "checksum": current_checksum
-                        })
-                
-                elif message["action"] == "request_sync":
-                    current_checksum = media_state.checksum or media_state.calculate_checksum()
-                    await websocket.send_json({
-                        "action": "sync_state",
-                        "state": media_state.model_dump(),
-                        "version": media_state.version,
-                        "checksum": current_checksum
-                    })
-                    
-            except Exception as e:
-                logger.error(f"❌ Error procesando mensaje: {e}")
-                if operation:
-                    await send_operation_response(websocket, operation, False, error=str(e))
+            if await apply_rate_limit(websocket, message, process_control_message):
+                await process_control_message(websocket, message)
     
     except WebSocketDisconnect:
         manager.disconnect(websocket, "control")
         logger.info(f"🔌 Control desconectado desde {client_ip}")
+    except Exception as e:
+        logger.error(f"❌ Error en WebSocket control: {e}")
+        manager.disconnect(websocket, "control")
+    finally:
+        rate_limiter.unregister(websocket)
+        if recorder:
+            recorder.close(websocket)
 
 @app.websocket("/ws/overlay")
 async def websocket_overlay(websocket: WebSocket):
-    await manager.connect(websocket, "overlay")
+    # Suscripción selectiva opcional: /ws/overlay?groups=webcam&tags=a,b&z=0:10&ids=x,y
+    try:
+        subscription = SubscriptionFilter.from_params(websocket.query_params)
+    except ValueError:
+        logger.warning(f"⚠️ Suscripción inválida: {websocket.url.query}")
+        await manager.reject(websocket, "invalid_subscription")
+        return
+    
+    if not await manager.connect(websocket, "overlay"):
+        return
+    if subscription:
+        manager.subscribe(websocket, subscription, media_state.items.values())
+    # Los overlays que confirman lo que precargan lo piden con ?preload=1
+    if websocket.query_params.get("preload") == "1":
+        preloads.enable(websocket)
     client_ip = websocket.client.host if websocket.client else "unknown"
     logger.info(f"🎬 Overlay conectado desde {client_ip}")
+    rate_limiter.register(websocket, "overlay", client_ip)
+    if recorder:
+        recorder.open(websocket, "overlay")
     
     try:
-        # Enviar estado inicial con versión - USAR model_dump con mode='json' para serializar datetime
+        # Enviar estado inicial con versión
         current_checksum = media_state.checksum or media_state.calculate_checksum()
-        state_dict = media_state.model_dump(mode='json')  # IMPORTANTE: mode='json' serializa datetime
-        
-        await websocket.send_json({
-            "action": "sync_state",
-            "state": state_dict,
-            "version": media_state.version,
-            "checksum": current_checksum
-        })
+        await websocket.send_json(build_sync_state(websocket))
         
         logger.info(f"🔄 Estado inicial enviado a overlay: v{media_state.version} checksum:{current_checksum}")
+        await send_initial_preload_hints(websocket)
         
         while True:
             data = await websocket.receive_text()
+            manager.touch(websocket)
             message = json.loads(data)
+            if recorder:
+                recorder.record_inbound(websocket, message)
             
-            # Crear operación si tiene request_id
-            operation = None
-            if "request_id" in message:
-                operation = OperationRequest(
-                    request_id=message["request_id"],
-                    action=message["action"],
-                    data=message
-                )
-            
-            try:
-                if message["action"] == "request_sync":
-                    current_checksum = media_state.checksum or media_state.calculate_checksum()
-                    state_dict = media_state.model_dump(mode='json')  # IMPORTANTE: mode='json'
-                    
-                    await websocket.send_json({
-                        "action": "sync_state",
-                        "state": state_dict,
-                        "version": media_state.version,
-                        "checksum": current_checksum
-                    })
-                    
-                    logger.info(f"🔄 Estado sincronizado enviado a overlay: v{media_state.version}")
-                
-                elif message["action"] == "verify_version":
-                    client_version = message.get("client_version", 0)
-                    client_checksum = message.get("client_checksum", "")
-                    
-                    current_checksum = media_state.checksum or media_state.calculate_checksum()
-                    needs_sync = (client_version != media_state.version or 
-                                client_checksum != current_checksum)
-                    
-                    await websocket.send_json({
-                        "action": "version_check",
-                        "needs_sync": needs_sync,
-                        "server_version": media_state.version,
-                        "server_checksum": current_checksum
-                    })
-                    
-                    if needs_sync:
-                        logger.info(f"⚠️ Overlay desincronizado: cliente v{client_version} vs servidor v{media_state.version}")
-                        state_dict = media_state.model_dump(mode='json')  # IMPORTANTE: mode='json'
-                        
-                        await websocket.send_json({
-                            "action": "sync_state",
-                            "state": state_dict,
-                            "version": media_state.version,
-                            "checksum": current_checksum
-                        })
-                
-                elif message["action"] == "add_media":
-                    media = message["media"]
-                    media_id = media.get("id", str(uuid.uuid4()))
-                    
-                    media_item = MediaItem(
-                        id=media_id,
-                        type=media.get("type", "image"),
-                        filename=media.get("filename", ""),
-                        url=media.get("url", ""),
-                        position=media.get("position", {"x": 100, "y": 100}),
-                        size=media.get("size", {"width": 200, "height": 200}),
-                        opacity=media.get("opacity", 1.0),
-                        volume=media.get("volume", 1.0),
-                        visible=True,
-                        z_index=media.get("z_index", len(media_state.items)),
-                        # Propiedades de texto
-                        text_content=media.get("text_content"),
-                        font_family=media.get("font_family", "Arial"),
-                        font_size=media.get("font_size", 48),
-                        font_weight=media.get("font_weight", "normal"),
-                        font_style=media.get("font_style", "normal"),
-                        text_align=media.get("text_align", "left"),
-                        text_color=media.get("text_color", "#ffffff"),
-                        text_shadow=media.get("text_shadow", False),
-                        text_shadow_color=media.get("text_shadow_color", "#000000"),
-                        text_shadow_blur=media.get("text_shadow_blur", 2),
-                        text_shadow_offset=media.get("text_shadow_offset", {"x": 1, "y": 1}),
-                        background_color=media.get("background_color"),
-                        padding=media.get("padding", {"top": 10, "right": 10, "bottom": 10, "left": 10})
-                    )
-                    
-                    media_state.add_item(media_item)
-                    media_dict = media_item.model_dump(mode='json')
-                    
-                    # Notificar a TODOS los overlays
-                    await manager.broadcast_to_overlays({
-                        "action": "add_media",
-                        "media": media_dict,
-                        "version": media_state.version,
-                        "checksum": media_state.checksum
-                    })
-                    
-                    await manager.broadcast_to_controls({
-                        "action": "media_added",
-                        "media": media_dict,
-                        "version": media_state.version
-                    })
-                    
-                    # <<<--- AÑADIR ESTA LÍNEA ---<<<
-                    if operation:
-                        await send_operation_response(websocket, operation, True, data={"media": media_dict})
-                    
-                    logger.info(f"➕ Media agregada desde overlay v{media_state.version}: {media.get('filename', 'unknown')}")
-                
-                elif message["action"] == "remove_media":
-                    media_id = message["media_id"]
-                    removed = media_state.remove_item(media_id)
-                    
-                    if removed:
-                        # Notificar a TODOS los overlays (sin exclude)
-                        await manager.broadcast_to_overlays({
-                            "action": "remove_media",
-                            "media_id": media_id,
-                            "version": media_state.version,
-                            "checksum": media_state.checksum
-                        })
-                        
-                        await manager.broadcast_to_controls({
-                            "action": "media_removed",
-                            "media_id": media_id,
-                            "version": media_state.version
-                        })
-                        
-                        # <<<--- ESTA PARTE YA ESTABA CORRECTA ---<<<
-                        if operation:
-                            await send_operation_response(websocket, operation, True)
-                        
-                        logger.info(f"➖ Media eliminada desde overlay v{media_state.version}: {removed.filename}")
-                    else:
-                        if operation:
-                            await send_operation_response(websocket, operation, False, error="Media no encontrada")
-                        logger.warning(f"⚠️ Intento de eliminar media inexistente desde overlay: {media_id}")
-                
-                elif message["action"] == "update_property":
-                    media_id = message["media_id"]
-                    property_name = message["property"]
-                    value = message["value"]
-                    
-                    if media_id in media_state.items:
-                        media_state.update_item(media_id, {property_name: value})
-                        
-                        await manager.broadcast_to_overlays({
-                            "action": "update_property",
-                            "media_id": media_id,
-                            "property": property_name,
-                            "value": value,
-                            "version": media_state.version,
-                            "checksum": media_state.checksum
-                        }, exclude=websocket) # exclude=websocket es correcto aquí
-                        
-                        await manager.broadcast_to_controls({
-                            "action": "property_updated",
-                            "media_id": media_id,
-                            "property": property_name,
-                            "value": value,
-                            "version": media_state.version
-                        })
-                        
-                        # <<<--- AÑADIR ESTA LÍNEA ---<<<
-                        if operation:
-                            await send_operation_response(websocket, operation, True)
-                        
-                        logger.info(f"🔧 Propiedad actualizada desde overlay v{media_state.version}: {media_id}.{property_name}")
-                    else:
-                        if operation:
-                            await send_operation_response(websocket, operation, False, error="Media no encontrada")
-                
-                elif message["action"] == "clear_all":
-                    cleared_count = len(media_state.items)
-                    media_state.clear()
-                    
-                    # Notificar a TODOS (sin exclude)
-                    await manager.broadcast_to_overlays({
-                        "action": "clear_all",
-                        "version": media_state.version,
-                        "checksum": media_state.checksum
-                    })
-                    
-                    await manager.broadcast_to_controls({
-                        "action": "overlay_cleared",
-                        "version": media_state.version
-                    })
-                    
-                    if operation:
-                        await send_operation_response(websocket, operation, True, data={"cleared_count": cleared_count})
-                    
-                    logger.info(f"🧹 Overlay limpiado desde overlay v{media_state.version}: {cleared_count} elementos")
-                    
-            except Exception as e:
-                logger.error(f"❌ Error procesando mensaje del overlay: {e}")
-                if operation:
-                    await send_operation_response(websocket, operation, False, error=str(e))
+            if await apply_rate_limit(websocket, message, process_overlay_message):
+                await process_overlay_message(websocket, message)
     
     except WebSocketDisconnect:
         manager.disconnect(websocket, "overlay")
@@ -523,26 +915,49 @@ async def websocket_overlay(websocket: WebSocket):
     except Exception as e:
         logger.error(f"❌ Error en WebSocket overlay: {e}")
         manager.disconnect(websocket, "overlay")
+    finally:
+        rate_limiter.unregister(websocket)
+        preloads.forget(websocket)
+        if recorder:
+            recorder.close(websocket)
 
 # ==========================================
 # RUTAS PRINCIPALES
 # ==========================================
 
+def render_page(request: Request, name: str):
+    """Página de plantilla; con el pipeline de assets se renderiza una vez y se sirve comprimida"""
+    if assets is None:
+        return templates.TemplateResponse(name, {"request": request})
+    return assets.page_response(
+        name,
+        lambda: templates.get_template(name).render(request=request),
+        request.headers
+    )
+
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return render_page(request, "index.html")
 
 @app.get("/control", response_class=HTMLResponse)
 async def control_panel(request: Request):
-    return templates.TemplateResponse("control.html", {"request": request})
+    return render_page(request, "control.html")
 
 @app.get("/overlay", response_class=HTMLResponse)
 async def obs_overlay(request: Request):
-    return templates.TemplateResponse("overlay.html", {"request": request})
+    return render_page(request, "overlay.html")
 
 @app.get("/obs-output", response_class=HTMLResponse)
 async def obs_output(request: Request):
-    return templates.TemplateResponse("obs-output.html", {"request": request})
+    return render_page(request, "obs-output.html")
+
+@app.get("/assets/{path:path}")
+async def hashed_asset(path: str, request: Request):
+    """CSS/JS con hash en el nombre: precomprimidos y con caché inmutable"""
+    response = assets.asset_response(path, request.headers) if assets else None
+    if response is None:
+        raise HTTPException(status_code=404, detail="Asset no encontrado")
+    return response
 
 # ==========================================
 # API ENDPOINTS
@@ -557,6 +972,16 @@ async def health_check():
         "timestamp": time.time(),
         "environment": config.RAILWAY_ENV,
         "connections": manager.get_connection_count(),
+        "admission": manager.get_admission_stats(),
+        "subscriptions": manager.subscriptions.get_stats(),
+        "rate_limits": rate_limiter.get_stats(),
+        "history": history.get_stats(),
+        "uploads": uploads.get_stats(),
+        "library": library.get_stats(),
+        "preload": preloads.get_stats(),
+        "assets": assets.get_stats() if assets else {"enabled": False},
+        "recording": recorder.get_stats() if recorder else {"enabled": False},
+        "relay": relay.get_stats() if relay else {"enabled": False},
         "media_count": len(media_state.items),
         "state_version": media_state.version,
         "state_checksum": current_checksum
@@ -573,27 +998,38 @@ async def get_state_version():
         "last_modified": media_state.last_modified
     }
 
+# Extensiones que se listan en la biblioteca
+LIBRARY_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.webm', '.ogg'}
+VIDEO_EXTENSIONS = {'.mp4', '.webm', '.ogg'}
+
+def library_item(filename: str, stored_filename: str, media_type: str, info: Optional[dict]) -> dict:
+    """Item de biblioteca con el tamaño inicial ajustado a la proporción real del archivo"""
+    media_item = create_media_item(
+        id=str(uuid.uuid4()),
+        type=media_type,
+        filename=filename,
+        url=f"/static/media/{stored_filename}",
+        size=fit_size(info)
+    )
+    # `info` (ancho, alto y duración originales) solo viaja en la biblioteca, no en el estado
+    return {**media_item.model_dump(), "info": info}
+
+def scan_library() -> List[dict]:
+    """Listar la carpeta de media leyendo solo las cabeceras que cambiaron (se ejecuta en un hilo)"""
+    items = []
+    if not config.MEDIA_PATH.exists():
+        return items
+    for file_path in config.MEDIA_PATH.iterdir():
+        if file_path.is_file() and file_path.suffix.lower() in LIBRARY_EXTENSIONS:
+            media_type = "video" if file_path.suffix.lower() in VIDEO_EXTENSIONS else "image"
+            items.append(library_item(file_path.name, file_path.name, media_type, library.info(file_path.name)))
+    return items
+
 @app.get("/api/media")
 async def get_all_media():
     """Obtener todos los items de media disponibles en la biblioteca"""
-    items = []
-    
     try:
-        if config.MEDIA_PATH.exists():
-            for file_path in config.MEDIA_PATH.iterdir():
-                if file_path.is_file() and file_path.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.mp4', '.webm', '.ogg']:
-                    media_id = str(uuid.uuid4())
-                    media_type = "video" if file_path.suffix.lower() in ['.mp4', '.webm', '.ogg'] else "image"
-                    
-                    media_item = MediaItem(
-                        id=media_id,
-                        type=media_type,
-                        filename=file_path.name,
-                        url=f"/static/media/{file_path.name}"
-                    )
-                    items.append(media_item.model_dump())
-        
-        return {"items": items}
+        return {"items": await asyncio.to_thread(scan_library)}
     
     except Exception as e:
         logger.error(f"❌ Error al obtener biblioteca de medios: {e}")
@@ -602,28 +1038,10 @@ async def get_all_media():
 @app.get("/api/media/scan")
 async def scan_media_folder():
     """Escanear carpeta de media y retornar archivos disponibles"""
-    items = []
-    
     try:
-        if not config.MEDIA_PATH.exists():
-            return {"scanned": 0, "items": []}
-        
-        for file_path in config.MEDIA_PATH.iterdir():
-            if file_path.is_file() and file_path.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.mp4', '.webm', '.ogg']:
-                media_id = str(uuid.uuid4())
-                media_type = "video" if file_path.suffix.lower() in ['.mp4', '.webm', '.ogg'] else "image"
-                
-                media_item = MediaItem(
-                    id=media_id,
-                    type=media_type,
-                    filename=file_path.name,
-                    url=f"/static/media/{file_path.name}"
-                )
-                
-                items.append(media_item)
-        
+        items = await asyncio.to_thread(scan_library)
         logger.info(f"🔍 Escaneados {len(items)} archivos")
-        return {"scanned": len(items), "items": [item.model_dump() for item in items]}
+        return {"scanned": len(items), "items": items}
     
     except Exception as e:
         logger.error(f"❌ Error al escanear: {e}")
@@ -632,9 +1050,13 @@ async def scan_media_folder():
 @app.delete("/api/media/{media_id}")
 async def delete_media(media_id: str):
     """Eliminar un item de media del estado activo"""
+    if relay:
+        raise HTTPException(status_code=403, detail="Servidor relay de solo lectura")
+    
     removed = media_state.remove_item(media_id)
     
     if removed:
+        history.record_remove(removed)
         # Notificar a overlays
         await manager.broadcast_to_overlays({
             "action": "remove_media",
@@ -651,6 +1073,9 @@ async def delete_media(media_id: str):
 @app.delete("/api/media/library/{filename}")
 async def delete_from_library(filename: str):
     """Eliminar archivo de la biblioteca y sistema de archivos"""
+    if relay:
+        raise HTTPException(status_code=403, detail="Servidor relay de solo lectura")
+    
     try:
         # Buscar el archivo por nombre
         file_path = config.MEDIA_PATH / filename
@@ -663,41 +1088,46 @@ async def delete_from_library(filename: str):
         try:
             file_path.unlink()  # Eliminar archivo
             deleted_file = file_path.name
+            library.discard(deleted_file)
             logger.info(f"🗑️ Archivo eliminado de biblioteca: {deleted_file}")
         except Exception as e:
             logger.error(f"Error eliminando archivo {file_path}: {e}")
             raise HTTPException(status_code=500, detail=f"Error eliminando archivo: {e}")
         
         if deleted_file:
-            # Buscar medios activos que usen este archivo para eliminarlos también
-            items_to_remove = []
-            for media_id, item in media_state.items.items():
-                if item.filename == filename or filename in item.url:
-                    items_to_remove.append(media_id)
-            
-            # Remover todos los elementos activos que usan este archivo
-            for media_id in items_to_remove:
-                removed_from_overlay = media_state.remove_item(media_id)
+            # Medios activos que usan exactamente este archivo (índice inverso)
+            deleted_url = f"/static/media/{deleted_file}"
+            items_to_remove = media_state.items_for_url(deleted_url)
+            removed_items = media_state.remove_items(items_to_remove)
+            # Deshacer/rehacer no debe volver a poner un item cuyo archivo ya no existe
+            forgotten = history.forget_url(deleted_url)
+            if forgotten:
+                logger.info(f"🕘 {forgotten} pasos del historial descartados por {deleted_file}")
+            # Ni sugerir su precarga a los overlays que se conecten
+            kept_uploads = [asset for asset in recent_uploads if asset.url != deleted_url]
+            recent_uploads.clear()
+            recent_uploads.extend(kept_uploads)
+            
+            # Notificar cada elemento eliminado
+            for removed_from_overlay in removed_items:
+                await manager.broadcast_to_overlays({
+                    "action": "remove_media",
+                    "media_id": removed_from_overlay.id,
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
                 
-                if removed_from_overlay:
-                    # Notificar a overlays que se eliminó
-                    await manager.broadcast_to_overlays({
-                        "action": "remove_media",
-                        "media_id": media_id,
-                        "version": media_state.version,
-                        "checksum": media_state.checksum
-                    })
-                    
-                    await manager.broadcast_to_controls({
-                        "action": "media_removed",
-                        "media_id": media_id,
-                        "version": media_state.version
-                    })
+                await manager.broadcast_to_controls({
+                    "action": "media_removed",
+                    "media_id": removed_from_overlay.id,
+                    "version": media_state.version,
+                    "checksum": media_state.checksum
+                })
             
             return {
                 "status": "deleted", 
                 "filename": deleted_file,
-                "removed_from_overlay_count": len(items_to_remove)
+                "removed_from_overlay_count": len(removed_items)
             }
         else:
             raise HTTPException(status_code=404, detail="Archivo no encontrado")
@@ -711,6 +1141,9 @@ async def delete_from_library(filename: str):
 @app.post("/api/media/upload")
 async def upload_media(file: UploadFile = File(...)):
     """Subir archivo de media con validación"""
+    if relay:
+        raise HTTPException(status_code=403, detail="Servidor relay de solo lectura")
+    
     try:
         if file.size and file.size > config.MAX_FILE_SIZE:
             raise HTTPException(
@@ -718,12 +1151,7 @@ async def upload_media(file: UploadFile = File(...)):
                 detail=f"Archivo demasiado grande. Máximo: {config.MAX_FILE_SIZE // (1024*1024)}MB"
             )
         
-        allowed_types = [
-            'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp',
-            'video/mp4', 'video/webm', 'video/ogg'
-        ]
-        
-        if file.content_type not in allowed_types:
+        if file.content_type not in ALLOWED_MEDIA_TYPES:
             raise HTTPException(
                 status_code=400,
                 detail=f"Tipo de archivo no permitido: {file.content_type}"
@@ -737,25 +1165,11 @@ async def upload_media(file: UploadFile = File(...)):
         with open(file_path, "wb") as f:
             f.write(content)
         
-        media_id = str(uuid.uuid4())
-        media_type = "video" if file.content_type.startswith('video/') else "image"
-        
-        media_item = MediaItem(
-            id=media_id,
-            type=media_type,
-            filename=file.filename,
-            url=f"/static/media/{unique_filename}"
-        )
-        
-        # NO agregar al estado aquí, solo a la biblioteca
-        
         logger.info(f"📁 Archivo subido: {file.filename} ({file.content_type})")
         
-        return {
-            "id": media_id,
-            "url": media_item.url,
-            "item": media_item.model_dump()
-        }
+        response = await library_upload_response(file.filename, unique_filename, file.content_type)
+        await hint_recent_upload(response["item"])
+        return response
     
     except HTTPException:
         raise
@@ -763,6 +1177,84 @@ async def upload_media(file: UploadFile = File(...)):
         logger.error(f"❌ Error al subir archivo: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
 
+async def library_upload_response(original_filename: str, stored_filename: str, content_type: str) -> dict:
+    """Item de biblioteca para un archivo recién subido (NO se agrega al estado)"""
+    # Probe al ingresar: el índice queda listo para /api/media
+    info = await asyncio.to_thread(library.info, stored_filename)
+    media_type = "video" if content_type.startswith('video/') else "image"
+    item = library_item(original_filename, stored_filename, media_type, info)
+    return {
+        "id": item["id"],
+        "url": item["url"],
+        "item": item
+    }
+
+def upload_error_response(error: UploadError) -> JSONResponse:
+    """Errores del protocolo de subida; los conflictos incluyen el offset para retomar"""
+    content = {"detail": error.detail}
+    headers = {}
+    if error.offset is not None:
+        content["offset"] = error.offset
+        headers["Upload-Offset"] = str(error.offset)
+    return JSONResponse(status_code=error.status_code, content=content, headers=headers)
+
+# Subida reanudable: POST crea, PATCH agrega un trozo en Upload-Offset,
+# GET consulta el offset, POST .../finalize verifica el SHA-256 y publica el archivo
+
+@app.post("/api/media/uploads", status_code=201)
+async def create_upload(request: UploadCreate):
+    """Iniciar una subida reanudable"""
+    if relay:
+        raise HTTPException(status_code=403, detail="Servidor relay de solo lectura")
+    try:
+        session = await uploads.create(request)
+    except UploadError as e:
+        return upload_error_response(e)
+    return {**session.describe(), "chunk_size": uploads.chunk_size, "expires_in": uploads.stale_after}
+
+@app.get("/api/media/uploads/{upload_id}")
+async def get_upload_offset(upload_id: str):
+    """Consultar cuántos bytes tiene el servidor (para retomar tras un corte)"""
+    try:
+        session = uploads.get(upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return JSONResponse(session.describe(), headers={"Upload-Offset": str(session.offset), "Cache-Control": "no-store"})
+
+@app.patch("/api/media/uploads/{upload_id}")
+async def append_upload_chunk(upload_id: str, request: Request):
+    """Agregar un trozo; el cuerpo crudo se escribe en staging a medida que llega"""
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Falta la cabecera Upload-Offset")
+    try:
+        session = await uploads.append(upload_id, offset, request.stream())
+    except UploadError as e:
+        return upload_error_response(e)
+    return JSONResponse(session.describe(), headers={"Upload-Offset": str(session.offset)})
+
+@app.post("/api/media/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, request: UploadFinalize):
+    """Verificar la subida completa y agregarla a la biblioteca"""
+    try:
+        session = uploads.get(upload_id)
+        stored_filename = await uploads.finalize(upload_id, request.sha256)
+    except UploadError as e:
+        return upload_error_response(e)
+    response = await library_upload_response(session.filename, stored_filename, session.content_type)
+    await hint_recent_upload(response["item"])
+    return response
+
+@app.delete("/api/media/uploads/{upload_id}")
+async def cancel_upload(upload_id: str):
+    """Cancelar una subida y liberar el staging"""
+    try:
+        await uploads.cancel(upload_id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return {"status": "cancelled", "upload_id": upload_id}
+
 # ==========================================
 # STARTUP EVENT
 # ==========================================
@@ -777,14 +1269,52 @@ async def startup_event():
     if invalid_count > 0:
         logger.info(f"🧹 {invalid_count} elementos inválidos limpiados al inicio")
     
+    if assets:
+        await asyncio.to_thread(assets.build)
+    
     # Inicializar checksum
     if not media_state.checksum:
         media_state.checksum = media_state.calculate_checksum()
     
     logger.info(f"   Estado inicial: v{media_state.version} checksum:{media_state.checksum}")
     logger.info(f"   Media path: {config.MEDIA_PATH}")
+    
+    # Iniciar heartbeat de versión
+    global heartbeat_task, upload_gc_task
+    if config.HEARTBEAT_INTERVAL > 0:
+        heartbeat_task = asyncio.create_task(heartbeat_loop())
+        logger.info(f"   Heartbeat cada {config.HEARTBEAT_INTERVAL}s")
+    
+    if recorder:
+        recorder.start()
+    
+    if relay:
+        relay.start()
+    else:
+        uploads.load()
+        await uploads.collect_stale()
+        upload_gc_task = asyncio.create_task(uploads.gc_loop(config.UPLOAD_GC_INTERVAL))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Detener tareas en segundo plano"""
+    if heartbeat_task:
+        heartbeat_task.cancel()
+    if upload_gc_task:
+        upload_gc_task.cancel()
+    if relay:
+        await relay.stop()
+    if recorder:
+        await recorder.stop()
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("main:app", host="localhost", port=port, log_level="info")
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="localhost",
+        port=port,
+        log_level="info",
+        ws_ping_interval=config.WS_PING_INTERVAL,
+        ws_ping_timeout=config.WS_PING_TIMEOUT
+    )
\ No newline at end of file
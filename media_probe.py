@@ -0,0 +1,339 @@
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+# Lectura de cabeceras sin herramientas externas: solo se leen los bytes necesarios
+# (las cajas/elementos grandes como mdat o los clusters se saltan con seek)
+MAX_METADATA_BYTES = 16 * 1024 * 1024
+MAX_ELEMENTS = 1024
+
+# Tamaño por defecto de un item nuevo (models/media.py); se ajusta a la proporción real
+DEFAULT_BOX = (200, 200)
+
+def probe_media(path: Path) -> Optional[dict]:
+    """Dimensiones (y duración de videos) leyendo solo la cabecera; None si no se reconoce"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(32)
+            f.seek(0)
+            if head.startswith(b"\x89PNG\r\n\x1a\n"):
+                return _probe_png(head)
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                return _probe_gif(head)
+            if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                return _probe_webp(head)
+            if head.startswith(b"\xff\xd8"):
+                return _probe_jpeg(f)
+            if head[4:8] in (b"ftyp", b"moov", b"mdat", b"free", b"wide"):
+                return _probe_mp4(f)
+            if head.startswith(b"\x1a\x45\xdf\xa3"):
+                return _probe_matroska(f)
+    except (OSError, ValueError, struct.error, IndexError) as e:
+        logger.debug(f"Cabecera ilegible en {path}: {e}")
+    return None
+
+def fit_size(info: Optional[dict], box: Tuple[int, int] = DEFAULT_BOX) -> Dict[str, int]:
+    """Tamaño inicial dentro de `box` con la proporción real del archivo"""
+    if not info or not info.get("width") or not info.get("height"):
+        return {"width": box[0], "height": box[1]}
+    scale = min(box[0] / info["width"], box[1] / info["height"])
+    return {"width": max(1, round(info["width"] * scale)), "height": max(1, round(info["height"] * scale))}
+
+def _dimensions(width: int, height: int, duration: Optional[float] = None) -> Optional[dict]:
+    if width <= 0 or height <= 0:
+        return {"duration": duration} if duration else None
+    info = {"width": width, "height": height}
+    if duration is not None:
+        info["duration"] = round(duration, 3)
+    return info
+
+# ------------------------------------------
+# Imágenes
+# ------------------------------------------
+
+def _probe_png(head: bytes) -> Optional[dict]:
+    if head[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", head[16:24])
+    return _dimensions(width, height)
+
+def _probe_gif(head: bytes) -> Optional[dict]:
+    width, height = struct.unpack("<HH", head[6:10])
+    return _dimensions(width, height)
+
+def _probe_webp(head: bytes) -> Optional[dict]:
+    chunk = head[12:16]
+    if chunk == b"VP8 " and head[23:26] == b"\x9d\x01\x2a":
+        width, height = struct.unpack("<HH", head[26:30])
+        return _dimensions(width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L" and head[20] == 0x2F:
+        bits = int.from_bytes(head[21:25], "little")
+        return _dimensions((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b"VP8X":
+        return _dimensions(int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1)
+    return None
+
+# Marcadores SOF (sin DHT, JPG ni DAC, que comparten el rango C0-CF)
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def _probe_jpeg(f: BinaryIO) -> Optional[dict]:
+    f.seek(2)
+    orientation = 1
+    for _ in range(MAX_ELEMENTS):
+        byte = f.read(1)
+        if byte != b"\xff":
+            return None
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        if marker in (0xD9, 0xDA):
+            # Fin de imagen o inicio de datos comprimidos sin SOF
+            return None
+        length = struct.unpack(">H", f.read(2))[0]
+        if marker in _JPEG_SOF:
+            height, width = struct.unpack(">xHH", f.read(5))
+            # El navegador aplica la orientación EXIF: 5-8 giran 90°
+            if orientation >= 5:
+                width, height = height, width
+            return _dimensions(width, height)
+        if marker == 0xE1:
+            segment = f.read(length - 2)
+            if segment.startswith(b"Exif\x00\x00"):
+                orientation = _exif_orientation(segment[6:]) or orientation
+        else:
+            f.seek(length - 2, 1)
+    return None
+
+def _exif_orientation(tiff: bytes) -> Optional[int]:
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        return None
+    ifd = struct.unpack(order + "I", tiff[4:8])[0]
+    count = struct.unpack(order + "H", tiff[ifd:ifd + 2])[0]
+    for index in range(count):
+        entry = ifd + 2 + index * 12
+        if struct.unpack(order + "H", tiff[entry:entry + 2])[0] == 0x0112:
+            return struct.unpack(order + "H", tiff[entry + 8:entry + 10])[0]
+    return None
+
+# ------------------------------------------
+# MP4 / MOV (ISO BMFF)
+# ------------------------------------------
+
+def _read_box_header(f: BinaryIO) -> Optional[Tuple[bytes, int, int]]:
+    """(tipo, tamaño del contenido, tamaño de la cabecera); tamaño -1 = hasta el final"""
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack(">I4s", header)
+    if size == 1:
+        return box_type, struct.unpack(">Q", f.read(8))[0] - 16, 16
+    if size == 0:
+        return box_type, -1, 8
+    return box_type, size - 8, 8
+
+def _iter_boxes(data: bytes) -> Iterator[Tuple[bytes, bytes]]:
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack(">I4s", data[offset:offset + 8])
+        start = offset + 8
+        if size == 1:
+            size = struct.unpack(">Q", data[start:start + 8])[0]
+            start += 8
+        elif size == 0:
+            size = len(data) - offset
+        if size < start - offset:
+            return
+        yield box_type, data[start:offset + size]
+        offset += size
+
+def _probe_mp4(f: BinaryIO) -> Optional[dict]:
+    # moov puede estar después de mdat (archivos sin "faststart"): saltar cajas hasta encontrarlo
+    for _ in range(MAX_ELEMENTS):
+        box = _read_box_header(f)
+        if box is None:
+            return None
+        box_type, size, _ = box
+        if box_type == b"moov":
+            if size < 0 or size > MAX_METADATA_BYTES:
+                return None
+            return _parse_moov(f.read(size))
+        if size < 0:
+            return None
+        f.seek(size, 1)
+    return None
+
+def _parse_moov(moov: bytes) -> Optional[dict]:
+    duration = None
+    width = height = 0
+    for box_type, payload in _iter_boxes(moov):
+        if box_type == b"mvhd":
+            if payload[0] == 1:
+                timescale, length = struct.unpack(">IQ", payload[20:32])
+            else:
+                timescale, length = struct.unpack(">II", payload[12:20])
+            if timescale:
+                duration = length / timescale
+        elif box_type == b"trak" and not width:
+            for child_type, child in _iter_boxes(payload):
+                if child_type == b"tkhd":
+                    width, height = _tkhd_dimensions(child)
+    return _dimensions(width, height, duration)
+
+def _tkhd_dimensions(tkhd: bytes) -> Tuple[int, int]:
+    # Tras la cabecera de versión: matriz 3x3 y ancho/alto en punto fijo 16.16
+    base = 4 + (32 if tkhd[0] == 1 else 20) + 16
+    matrix = struct.unpack(">9i", tkhd[base:base + 36])
+    width, height = struct.unpack(">II", tkhd[base + 36:base + 44])
+    width, height = width >> 16, height >> 16
+    # Videos grabados en vertical: la matriz gira 90° o 270°
+    if matrix[0] == 0 and abs(matrix[1]) == 0x10000:
+        width, height = height, width
+    return width, height
+
+# ------------------------------------------
+# WebM / Matroska (EBML)
+# ------------------------------------------
+
+_EBML_SEGMENT = 0x18538067
+_EBML_INFO = 0x1549A966
+_EBML_TRACKS = 0x1654AE6B
+_EBML_CLUSTER = 0x1F43B675
+_EBML_TRACK_ENTRY = 0xAE
+_EBML_TRACK_TYPE = 0x83
+_EBML_VIDEO = 0xE0
+_EBML_PIXEL_WIDTH = 0xB0
+_EBML_PIXEL_HEIGHT = 0xBA
+_EBML_TIMECODE_SCALE = 0x2AD7B1
+_EBML_DURATION = 0x4489
+
+def _vint_length(first: int) -> int:
+    for length in range(1, 9):
+        if first & (0x80 >> (length - 1)):
+            return length
+    raise ValueError("vint inválido")
+
+def _parse_vint(data: bytes, offset: int, keep_marker: bool) -> Tuple[int, int]:
+    """(valor, offset siguiente); un tamaño con todos los bits en 1 es desconocido (-1)"""
+    length = _vint_length(data[offset])
+    raw = int.from_bytes(data[offset:offset + length], "big")
+    if keep_marker:
+        return raw, offset + length
+    value = raw & ((1 << (7 * length)) - 1)
+    return (-1 if value == (1 << (7 * length)) - 1 else value), offset + length
+
+def _read_element_header(f: BinaryIO) -> Optional[Tuple[int, int]]:
+    first = f.read(1)
+    if not first:
+        return None
+    id_bytes = first + f.read(_vint_length(first[0]) - 1)
+    element_id = int.from_bytes(id_bytes, "big")
+    size_first = f.read(1)
+    size_bytes = size_first + f.read(_vint_length(size_first[0]) - 1)
+    size, _ = _parse_vint(size_bytes, 0, keep_marker=False)
+    return element_id, size
+
+def _iter_elements(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    offset = 0
+    while offset < len(data):
+        element_id, offset = _parse_vint(data, offset, keep_marker=True)
+        size, offset = _parse_vint(data, offset, keep_marker=False)
+        if size < 0:
+            return
+        yield element_id, data[offset:offset + size]
+        offset += size
+
+def _probe_matroska(f: BinaryIO) -> Optional[dict]:
+    header = _read_element_header(f)
+    if header is None:
+        return None
+    f.seek(header[1], 1)
+    segment = _read_element_header(f)
+    if segment is None or segment[0] != _EBML_SEGMENT:
+        return None
+
+    duration = None
+    width = height = 0
+    for _ in range(MAX_ELEMENTS):
+        element = _read_element_header(f)
+        if element is None:
+            break
+        element_id, size = element
+        if element_id == _EBML_CLUSTER or size < 0:
+            # Info y Tracks van antes de los clusters
+            break
+        if element_id in (_EBML_INFO, _EBML_TRACKS):
+            if size > MAX_METADATA_BYTES:
+                return None
+            payload = f.read(size)
+            if element_id == _EBML_INFO:
+                duration = _matroska_duration(payload)
+            else:
+                width, height = _matroska_video_size(payload)
+                if duration is not None:
+                    break
+        else:
+            f.seek(size, 1)
+    return _dimensions(width, height, duration)
+
+def _matroska_duration(info: bytes) -> Optional[float]:
+    scale = 1_000_000
+    duration = None
+    for element_id, payload in _iter_elements(info):
+        if element_id == _EBML_TIMECODE_SCALE:
+            scale = int.from_bytes(payload, "big")
+        elif element_id == _EBML_DURATION:
+            duration = struct.unpack(">f" if len(payload) == 4 else ">d", payload)[0]
+    # Las grabaciones de MediaRecorder no incluyen duración
+    return duration * scale / 1e9 if duration else None
+
+def _matroska_video_size(tracks: bytes) -> Tuple[int, int]:
+    for element_id, entry in _iter_elements(tracks):
+        if element_id != _EBML_TRACK_ENTRY:
+            continue
+        fields = dict(_iter_elements(entry))
+        if int.from_bytes(fields.get(_EBML_TRACK_TYPE, b""), "big") != 1 or _EBML_VIDEO not in fields:
+            continue
+        video = dict(_iter_elements(fields[_EBML_VIDEO]))
+        return (int.from_bytes(video.get(_EBML_PIXEL_WIDTH, b""), "big"),
+                int.from_bytes(video.get(_EBML_PIXEL_HEIGHT, b""), "big"))
+    return 0, 0
+
+# ------------------------------------------
+# Índice de la biblioteca
+# ------------------------------------------
+
+class LibraryIndex:
+    """Resultados del probe por archivo, válidos mientras no cambien tamaño ni fecha"""
+
+    def __init__(self, media_path: Path):
+        self.media_path = Path(media_path)
+        self._entries: Dict[str, Tuple[int, int, Optional[dict]]] = {}
+        self.stats = {"probes": 0, "hits": 0}
+
+    def info(self, filename: str) -> Optional[dict]:
+        """Metadatos de un archivo de la biblioteca (lee la cabecera solo si cambió)"""
+        path = self.media_path / filename
+        stat = path.stat()
+        cached = self._entries.get(filename)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            self.stats["hits"] += 1
+            return cached[2]
+        info = probe_media(path)
+        self._entries[filename] = (stat.st_mtime_ns, stat.st_size, info)
+        self.stats["probes"] += 1
+        return info
+
+    def discard(self, filename: str):
+        self._entries.pop(filename, None)
+
+    def get_stats(self):
+        return {"entries": len(self._entries), **self.stats}
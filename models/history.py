@@ -0,0 +1,221 @@
+# models/history.py
+from collections import deque
+from typing import Any, Deque, List, Optional, Tuple
+import json
+import sys
+import time
+
+from models.media import MediaItem, MediaState
+
+# Cambio mínimo resultante de deshacer/rehacer, listo para difundir:
+# ("add", MediaItem) | ("remove", media_id) | ("update", media_id, propiedad, valor) | ("clear",)
+Change = Tuple[Any, ...]
+
+# Costo fijo estimado por entrada (objeto con __slots__, timestamp y referencias)
+ENTRY_OVERHEAD = 120
+
+def value_size(value: Any) -> int:
+    """Tamaño aproximado en memoria de un valor JSON (dict/list/escalares)"""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(value_size(k) + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_size(v) for v in value)
+    return sys.getsizeof(value)
+
+class HistoryEntry:
+    """Operación inversa de un cambio.
+
+    No copia el estado: guarda referencias a los MediaItem (inmutables, se reemplazan
+    al actualizarse) o solo el valor anterior/nuevo de la propiedad modificada.
+    """
+
+    __slots__ = ("kind", "media_id", "property", "before", "after", "items", "size", "updated")
+
+    def __init__(self, kind: str, media_id: Optional[str] = None, property: Optional[str] = None,
+                 before: Any = None, after: Any = None, items: Optional[List[MediaItem]] = None):
+        self.kind = kind
+        self.media_id = media_id
+        self.property = property
+        self.before = before
+        self.after = after
+        self.items = tuple(items) if items else ()
+        self.updated = time.monotonic()
+        self.size = self._estimate_size()
+
+    def _estimate_size(self) -> int:
+        size = ENTRY_OVERHEAD
+        if self.kind == "update":
+            size += value_size(self.before) + value_size(self.after)
+        for item in self.items:
+            size += len(json.dumps(item.to_wire()))
+        if isinstance(self.before, MediaItem):
+            size += len(json.dumps(self.before.to_wire()))
+        return size
+
+class EditHistory:
+    """Pila de deshacer/rehacer con límite de memoria y agrupación de gestos"""
+
+    def __init__(self, max_steps: int = 500, max_bytes: int = 2 * 1024 * 1024, group_window: float = 0.5):
+        self.max_steps = max_steps
+        self.max_bytes = max_bytes
+        self.group_window = group_window
+        self.undo_stack: Deque[HistoryEntry] = deque()
+        self.redo_stack: List[HistoryEntry] = []
+        self.bytes_used = 0
+        self.evicted = 0
+
+    # ------------------------------------------
+    # Registro de cambios
+    # ------------------------------------------
+
+    def record_add(self, item: MediaItem, previous: Optional[MediaItem] = None):
+        self._push(HistoryEntry("add", media_id=item.id, items=[item], before=previous))
+
+    def record_remove(self, item: MediaItem):
+        self._push(HistoryEntry("remove", media_id=item.id, items=[item]))
+
+    def record_clear(self, items: List[MediaItem]):
+        if items:
+            self._push(HistoryEntry("clear", items=items))
+
+    def record_update(self, media_id: str, property_name: str, before: Any, after: Any):
+        """Registrar una actualización; las consecutivas de la misma propiedad forman un solo paso"""
+        last = self.undo_stack[-1] if self.undo_stack else None
+        now = time.monotonic()
+
+        if (last is not None and last.kind == "update" and last.media_id == media_id
+                and last.property == property_name and now - last.updated <= self.group_window):
+            # Mismo gesto (p. ej. un arrastre): conservar el valor original, actualizar el final
+            self.bytes_used -= last.size
+            last.after = after
+            last.updated = now
+            last.size = last._estimate_size()
+            self.bytes_used += last.size
+            self._clear_redo()
+            self._enforce_limits()
+            return
+
+        self._push(HistoryEntry("update", media_id=media_id, property=property_name, before=before, after=after))
+
+    def _push(self, entry: HistoryEntry):
+        self.undo_stack.append(entry)
+        self.bytes_used += entry.size
+        self._clear_redo()
+        self._enforce_limits()
+
+    def _clear_redo(self):
+        # Un cambio nuevo invalida lo que se podía rehacer
+        for entry in self.redo_stack:
+            self.bytes_used -= entry.size
+        self.redo_stack.clear()
+
+    def forget_url(self, url: str) -> int:
+        """Olvidar lo que volvería a poner un archivo eliminado de la biblioteca; retorna pasos descartados"""
+        dropped = 0
+        for stack in (self.undo_stack, self.redo_stack):
+            kept = [entry for entry in stack if not self._drop_url(entry, url)]
+            dropped += len(stack) - len(kept)
+            stack.clear()
+            stack.extend(kept)
+        return dropped
+
+    def _drop_url(self, entry: HistoryEntry, url: str) -> bool:
+        """Quitar de un paso los items con `url`; True si el paso entero debe descartarse"""
+        if entry.kind == "update":
+            drop = entry.property == "url" and url in (entry.before, entry.after)
+        else:
+            if isinstance(entry.before, MediaItem) and entry.before.url == url:
+                entry.before = None
+            entry.items = tuple(item for item in entry.items if item.url != url)
+            drop = not entry.items
+
+        self.bytes_used -= entry.size
+        if drop:
+            return True
+        entry.size = entry._estimate_size()
+        self.bytes_used += entry.size
+        return False
+
+    def _enforce_limits(self):
+        while self.undo_stack and (len(self.undo_stack) > self.max_steps or self.bytes_used > self.max_bytes):
+            self.bytes_used -= self.undo_stack.popleft().size
+            self.evicted += 1
+
+    # ------------------------------------------
+    # Deshacer / rehacer
+    # ------------------------------------------
+
+    def undo(self, state: MediaState) -> List[Change]:
+        """Aplicar la inversa del último paso; retorna los cambios a difundir.
+
+        Los pasos que ya no cambian nada (su item fue eliminado fuera del historial) se saltan.
+        """
+        while self.undo_stack:
+            entry = self.undo_stack.pop()
+            self.redo_stack.append(entry)
+            changes = self._apply(entry, state, reverse=True)
+            if changes:
+                return changes
+        return []
+
+    def redo(self, state: MediaState) -> List[Change]:
+        """Volver a aplicar el último paso deshecho"""
+        while self.redo_stack:
+            entry = self.redo_stack.pop()
+            self.undo_stack.append(entry)
+            # Un paso rehecho no debe fusionarse con la siguiente actualización
+            entry.updated = float("-inf")
+            changes = self._apply(entry, state, reverse=False)
+            if changes:
+                return changes
+        return []
+
+    def _apply(self, entry: HistoryEntry, state: MediaState, reverse: bool) -> List[Change]:
+        changes: List[Change] = []
+
+        if entry.kind == "update":
+            if entry.media_id not in state.items:
+                return changes
+            value = entry.before if reverse else entry.after
+            state.update_item(entry.media_id, {entry.property: value})
+            changes.append(("update", entry.media_id, entry.property, value))
+
+        elif entry.kind == "clear":
+            if reverse:
+                state.restore_items(entry.items)
+                changes.extend(("add", item) for item in entry.items)
+            else:
+                state.clear()
+                changes.append(("clear",))
+
+        elif (entry.kind == "add") == reverse:
+            # Deshacer un add o rehacer un remove: quitar el item
+            if state.remove_item(entry.media_id):
+                changes.append(("remove", entry.media_id))
+            if reverse and isinstance(entry.before, MediaItem):
+                state.restore_items([entry.before])
+                changes.append(("add", entry.before))
+
+        else:
+            # Rehacer un add o deshacer un remove: volver a poner el item
+            state.restore_items(entry.items)
+            changes.extend(("add", item) for item in entry.items)
+
+        return changes
+
+    def can_undo(self) -> bool:
+        return bool(self.undo_stack)
+
+    def can_redo(self) -> bool:
+        return bool(self.redo_stack)
+
+    def get_stats(self):
+        """Obtener tamaño y límites del historial"""
+        return {
+            "undo_steps": len(self.undo_stack),
+            "redo_steps": len(self.redo_stack),
+            "bytes_used": self.bytes_used,
+            "max_steps": self.max_steps,
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted
+        }
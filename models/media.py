@@ -1,11 +1,49 @@
 # models/media.py
-from pydantic import BaseModel, ConfigDict
-from typing import Optional, Dict, List
+from pydantic import BaseModel, ConfigDict, PrivateAttr, BeforeValidator, PlainSerializer, SerializeAsAny, field_validator
+from typing import Optional, Dict, List, Set, Iterable, NamedTuple, Tuple, Type
+from typing_extensions import Annotated
 from datetime import datetime
 import hashlib
 import json
 
+# Tuplas fijas en memoria; en el protocolo se siguen enviando como objetos {"x": .., "y": ..}
+class Point(NamedTuple):
+    x: float
+    y: float
+
+class Size(NamedTuple):
+    width: float
+    height: float
+
+class Offset(NamedTuple):
+    x: int = 1
+    y: int = 1
+
+class Padding(NamedTuple):
+    top: int = 10
+    right: int = 10
+    bottom: int = 10
+    left: int = 10
+
+def _compact(cls):
+    """Tipo anotado que valida desde dict y serializa de vuelta a dict"""
+    def from_dict(value):
+        if not isinstance(value, dict):
+            return value
+        try:
+            return cls(**value)
+        except TypeError as e:
+            # Campos faltantes o desconocidos: ValueError para que pydantic lo informe como ValidationError
+            raise ValueError(f"{cls.__name__} inválido: {e}") from e
+
+    return Annotated[
+        cls,
+        BeforeValidator(from_dict),
+        PlainSerializer(lambda v: v._asdict(), return_type=dict)
+    ]
+
 class MediaItem(BaseModel):
+    """Elemento de media (imagen); los tipos con propiedades propias extienden esta clase"""
     model_config = ConfigDict(
         json_encoders={
             datetime: lambda v: v.isoformat() if v else None
@@ -16,14 +54,29 @@ class MediaItem(BaseModel):
     type: str  # "image", "video", "text"
     filename: str = ""
     url: str = ""
-    position: Dict[str, float] = {"x": 100, "y": 100}
-    size: Dict[str, float] = {"width": 200, "height": 200}
+    position: _compact(Point) = Point(100, 100)
+    size: _compact(Size) = Size(200, 200)
     opacity: float = 1.0
-    volume: float = 1.0
     visible: bool = True
     z_index: int = 0
+    # Para suscripciones selectivas de overlays (ver subscriptions.py)
+    group: Optional[str] = None
+    tags: Tuple[str, ...] = ()
     created_at: Optional[datetime] = None
     
+    def __init__(self, **data):
+        if 'created_at' not in data or data['created_at'] is None:
+            data['created_at'] = datetime.now()
+        super().__init__(**data)
+    
+    def to_wire(self) -> dict:
+        """Representación compacta: se omiten los valores por defecto (el cliente los completa)"""
+        return self.model_dump(mode='json', exclude_defaults=True)
+
+class VideoMediaItem(MediaItem):
+    volume: float = 1.0
+
+class TextMediaItem(MediaItem):
     # Propiedades específicas para texto
     text_content: Optional[str] = None
     font_family: str = "Arial"
@@ -35,32 +88,151 @@ class MediaItem(BaseModel):
     text_shadow: bool = False
     text_shadow_color: str = "#000000"
     text_shadow_blur: int = 2
-    text_shadow_offset: Dict[str, int] = {"x": 1, "y": 1}
+    text_shadow_offset: _compact(Offset) = Offset()
     background_color: Optional[str] = None  # Color de fondo opcional
-    padding: Dict[str, int] = {"top": 10, "right": 10, "bottom": 10, "left": 10}
-    
-    def __init__(self, **data):
-        if 'created_at' not in data or data['created_at'] is None:
-            data['created_at'] = datetime.now()
-        super().__init__(**data)
+    padding: _compact(Padding) = Padding()
+
+MEDIA_ITEM_TYPES: Dict[str, Type[MediaItem]] = {
+    "video": VideoMediaItem,
+    "text": TextMediaItem,
+}
+
+# Número de ramas del árbol de digests (raíz -> buckets -> items)
+DIGEST_BUCKETS = 16
+
+def fnv1a(text: str) -> str:
+    """FNV-1a de 32 bits en hex; el cliente usa la misma función para combinar hashes"""
+    h = 0x811c9dc5
+    for byte in text.encode():
+        h = ((h ^ byte) * 0x01000193) & 0xffffffff
+    return f"{h:08x}"
+
+def digest_bucket(media_id: str) -> int:
+    """Bucket del árbol de digests al que pertenece un item"""
+    return int(fnv1a(media_id), 16) % DIGEST_BUCKETS
+
+def subset_root(hashes: Dict[str, str]) -> str:
+    """Raíz del árbol de digests de un subconjunto de items (misma construcción que MediaState)"""
+    members: List[List[str]] = [[] for _ in range(DIGEST_BUCKETS)]
+    for item_id in hashes:
+        members[digest_bucket(item_id)].append(item_id)
+    return fnv1a("".join(
+        fnv1a("".join(f"{i}:{hashes[i]};" for i in sorted(ids)))
+        for ids in members
+    ))
+
+def create_media_item(**data) -> MediaItem:
+    """Crear el item con la clase correspondiente a su tipo (las propiedades ajenas se ignoran)"""
+    return MEDIA_ITEM_TYPES.get(data.get("type"), MediaItem)(**data)
 
 class MediaState(BaseModel):
-    items: Dict[str, MediaItem] = {}
+    items: Dict[str, SerializeAsAny[MediaItem]] = {}
     version: int = 0
     checksum: Optional[str] = None
     last_modified: Optional[datetime] = None
     
-    def calculate_checksum(self) -> str:
-        """Calcular checksum del estado actual"""
-        # Crear una representación ordenada del estado
-        state_dict = {
-            'items': {
-                k: v.model_dump(exclude={'created_at'}) 
-                for k, v in sorted(self.items.items())
+    # Índice inverso: URL de archivo -> IDs de media que la usan
+    _file_index: Dict[str, Set[str]] = PrivateAttr(default_factory=dict)
+    
+    # Árbol de digests: hash por item, miembros y digest (None = pendiente) por bucket
+    _item_hashes: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _bucket_members: List[Set[str]] = PrivateAttr(default_factory=lambda: [set() for _ in range(DIGEST_BUCKETS)])
+    _bucket_digests: List[Optional[str]] = PrivateAttr(default_factory=lambda: [None] * DIGEST_BUCKETS)
+    
+    @field_validator('items', mode='before')
+    @classmethod
+    def _build_items(cls, items):
+        if isinstance(items, dict):
+            return {
+                k: create_media_item(**v) if isinstance(v, dict) else v
+                for k, v in items.items()
             }
-        }
-        state_str = json.dumps(state_dict, sort_keys=True)
-        return hashlib.md5(state_str.encode()).hexdigest()[:8]
+        return items
+    
+    def model_post_init(self, __context) -> None:
+        for item in self.items.values():
+            self._index_item(item)
+    
+    def _index_item(self, item: MediaItem):
+        if item.url:
+            self._file_index.setdefault(item.url, set()).add(item.id)
+        
+        content = json.dumps(item.model_dump(exclude={'created_at'}, exclude_defaults=True), sort_keys=True)
+        self._item_hashes[item.id] = hashlib.md5(content.encode()).hexdigest()[:8]
+        bucket = digest_bucket(item.id)
+        self._bucket_members[bucket].add(item.id)
+        self._bucket_digests[bucket] = None
+    
+    def _unindex_item(self, item: MediaItem):
+        ids = self._file_index.get(item.url)
+        if ids is not None:
+            ids.discard(item.id)
+            if not ids:
+                del self._file_index[item.url]
+        
+        self._item_hashes.pop(item.id, None)
+        bucket = digest_bucket(item.id)
+        self._bucket_members[bucket].discard(item.id)
+        self._bucket_digests[bucket] = None
+    
+    def items_for_url(self, url: str) -> Set[str]:
+        """IDs de media que referencian exactamente esta URL"""
+        return set(self._file_index.get(url, ()))
+    
+    def referenced_urls(self) -> List[str]:
+        """URLs distintas referenciadas por el estado"""
+        return list(self._file_index)
+    
+    def item_hash(self, item_id: str) -> Optional[str]:
+        """Hash del contenido de un item (hoja del árbol de digests)"""
+        return self._item_hashes.get(item_id)
+    
+    def item_hashes(self) -> Dict[str, str]:
+        """Hashes de todos los items, para que el cliente construya su árbol"""
+        return dict(self._item_hashes)
+    
+    def subset_hashes(self, item_ids: Iterable[str]) -> Dict[str, str]:
+        """Hashes de un subconjunto de items (suscripciones selectivas)"""
+        return {i: self._item_hashes[i] for i in item_ids if i in self._item_hashes}
+    
+    def subset_bucket_digests(self, item_ids: Set[str]) -> List[str]:
+        """Digests de bucket calculados solo sobre un subconjunto de items"""
+        return [
+            fnv1a("".join(f"{i}:{self._item_hashes[i]};" for i in sorted(members & item_ids)))
+            for members in self._bucket_members
+        ]
+    
+    def bucket_digests(self) -> List[str]:
+        """Digest de cada bucket; solo se recalculan los buckets modificados"""
+        for bucket, digest in enumerate(self._bucket_digests):
+            if digest is None:
+                members = sorted(self._bucket_members[bucket])
+                self._bucket_digests[bucket] = fnv1a("".join(f"{i}:{self._item_hashes[i]};" for i in members))
+        return list(self._bucket_digests)
+    
+    def diff_buckets(self, client_buckets: Dict[int, Dict[str, str]], only: Optional[Set[str]] = None):
+        """Comparar los hashes del cliente en los buckets indicados.
+
+        Retorna (items que el cliente no tiene o tiene desactualizados, IDs que ya no existen).
+        Con `only`, los items fuera del subconjunto se consideran inexistentes.
+        """
+        changed: List[MediaItem] = []
+        removed: List[str] = []
+        for bucket, client_hashes in client_buckets.items():
+            members = self._bucket_members[bucket] if only is None else self._bucket_members[bucket] & only
+            for item_id in members:
+                if client_hashes.get(item_id) != self._item_hashes[item_id]:
+                    changed.append(self.items[item_id])
+            removed.extend(item_id for item_id in client_hashes if item_id not in members)
+        return changed, removed
+    
+    def bucket_hashes(self, bucket: int) -> Dict[str, str]:
+        """Hashes de los items de un bucket (para pedir resincronización a otro servidor)"""
+        return {item_id: self._item_hashes[item_id] for item_id in self._bucket_members[bucket]}
+    
+    def calculate_checksum(self) -> str:
+        """Calcular checksum del estado actual (raíz del árbol de digests)"""
+        return fnv1a("".join(self.bucket_digests()))
     
     def update_version(self):
         """Incrementar versión y actualizar checksum"""
@@ -68,30 +240,82 @@ class MediaState(BaseModel):
         self.checksum = self.calculate_checksum()
         self.last_modified = datetime.now()
     
+    def adopt_version(self, version: int):
+        """Tomar la versión de otro servidor (espejo de un relay)"""
+        self.version = version
+        self.checksum = self.calculate_checksum()
+        self.last_modified = datetime.now()
+    
     def add_item(self, item: MediaItem):
         """Agregar item y actualizar versión"""
+        previous = self.items.get(item.id)
+        if previous:
+            self._unindex_item(previous)
         self.items[item.id] = item
+        self._index_item(item)
         self.update_version()
     
     def remove_item(self, item_id: str) -> Optional[MediaItem]:
         """Remover item y actualizar versión"""
         if item_id in self.items:
             removed = self.items.pop(item_id)
+            self._unindex_item(removed)
             self.update_version()
             return removed
         return None
     
+    def remove_items(self, item_ids: Iterable[str]) -> List[MediaItem]:
+        """Remover varios items con un solo incremento de versión"""
+        removed = []
+        for item_id in item_ids:
+            item = self.items.pop(item_id, None)
+            if item:
+                self._unindex_item(item)
+                removed.append(item)
+        if removed:
+            self.update_version()
+        return removed
+    
+    def restore_items(self, items: Iterable[MediaItem]):
+        """Volver a poner items (deshacer) con un solo incremento de versión"""
+        for item in items:
+            previous = self.items.get(item.id)
+            if previous:
+                self._unindex_item(previous)
+            self.items[item.id] = item
+            self._index_item(item)
+        self.update_version()
+    
     def update_item(self, item_id: str, updates: dict):
         """Actualizar item y versión"""
         if item_id in self.items:
             item_dict = self.items[item_id].model_dump()
             item_dict.update(updates)
-            self.items[item_id] = MediaItem(**item_dict)
+            # Validar antes de tocar los índices: si el valor es inválido el estado queda intacto
+            updated = create_media_item(**item_dict)
+            self._unindex_item(self.items[item_id])
+            self.items[item_id] = updated
+            self._index_item(updated)
             self.update_version()
     
+    def to_wire(self, item_ids: Optional[Iterable[str]] = None) -> dict:
+        """Estado compacto para sync_state (opcionalmente solo algunos items)"""
+        items = self.items if item_ids is None else {i: self.items[i] for i in item_ids if i in self.items}
+        return {
+            "items": {k: v.to_wire() for k, v in items.items()},
+            "version": self.version,
+            "checksum": self.checksum,
+            "last_modified": self.last_modified.isoformat() if self.last_modified else None
+        }
+    
     def clear(self):
         """Limpiar todos los items"""
         self.items.clear()
+        self._file_index.clear()
+        self._item_hashes.clear()
+        for bucket in range(DIGEST_BUCKETS):
+            self._bucket_members[bucket].clear()
+            self._bucket_digests[bucket] = None
         self.update_version()
 
 class OperationRequest(BaseModel):
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple
+from fastapi import WebSocket
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PreloadAsset(NamedTuple):
+    url: str
+    type: str
+    bytes: int
+
+class _HintedAsset:
+    __slots__ = ("bytes", "acked")
+
+    def __init__(self, size: int):
+        self.bytes = size
+        self.acked = False
+
+class PreloadTracker:
+    """Pistas de precarga por overlay, limitadas en bytes y sin duplicados.
+
+    Cada overlay que acepta pistas (`?preload=1`) tiene un registro de lo que ya se le
+    sugirió: pendiente hasta que confirma con `preload_ack`. El total sugerido no supera
+    `max_bytes`; para hacer lugar se olvidan primero las confirmadas más antiguas
+    (el navegador también las habrá desalojado de su caché), nunca las pendientes.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.connections: Dict[WebSocket, "OrderedDict[str, _HintedAsset]"] = {}
+        self.stats = {"hints": 0, "assets": 0, "bytes": 0, "duplicates": 0, "over_budget": 0, "acked": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def enable(self, websocket: WebSocket):
+        if self.enabled:
+            self.connections[websocket] = OrderedDict()
+
+    def forget(self, websocket: WebSocket):
+        self.connections.pop(websocket, None)
+
+    def accepts(self, websocket: WebSocket) -> bool:
+        return websocket in self.connections
+
+    def plan(self, websocket: WebSocket, assets: Iterable[PreloadAsset]) -> List[PreloadAsset]:
+        """Elegir (y reservar) las pistas que aún no se enviaron a este overlay"""
+        hinted = self.connections.get(websocket)
+        if hinted is None:
+            return []
+
+        total = sum(entry.bytes for entry in hinted.values())
+        selected = []
+        for asset in assets:
+            if asset.url in hinted:
+                self.stats["duplicates"] += 1
+                continue
+            # Hacer lugar olvidando las confirmadas más antiguas
+            for url in [url for url, entry in hinted.items() if entry.acked]:
+                if total + asset.bytes <= self.max_bytes:
+                    break
+                total -= hinted.pop(url).bytes
+            if total + asset.bytes > self.max_bytes:
+                self.stats["over_budget"] += 1
+                continue
+            hinted[asset.url] = _HintedAsset(asset.bytes)
+            total += asset.bytes
+            selected.append(asset)
+
+        if selected:
+            self.stats["hints"] += 1
+            self.stats["assets"] += len(selected)
+            self.stats["bytes"] += sum(asset.bytes for asset in selected)
+        return selected
+
+    def acknowledge(self, websocket: WebSocket, cached: Iterable[str], failed: Iterable[str] = ()):
+        """Registrar lo que el overlay confirmó tener en caché (o no pudo descargar)"""
+        hinted = self.connections.get(websocket)
+        if hinted is None:
+            return
+        for url in cached:
+            entry = hinted.get(url)
+            if entry and not entry.acked:
+                entry.acked = True
+                hinted.move_to_end(url)
+                self.stats["acked"] += 1
+        for url in failed:
+            # Liberar el presupuesto; se podrá volver a sugerir más adelante
+            if hinted.pop(url, None):
+                self.stats["failed"] += 1
+
+    def get_stats(self):
+        """Obtener pistas enviadas y bytes reservados por overlay"""
+        return {
+            "enabled": self.enabled,
+            "max_bytes": self.max_bytes,
+            "overlays": len(self.connections),
+            "pending_bytes": sum(e.bytes for hinted in self.connections.values() for e in hinted.values() if not e.acked),
+            "cached_bytes": sum(e.bytes for hinted in self.connections.values() for e in hinted.values() if e.acked),
+            **self.stats
+        }
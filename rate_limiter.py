@@ -0,0 +1,207 @@
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from fastapi import WebSocket
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Resultados de RateLimiter.check
+ALLOW = "allow"
+REJECT = "reject"
+COALESCE = "coalesce"
+
+class TokenBucket:
+    """Token bucket clásico: `rate` tokens por segundo con ráfagas de hasta `burst`"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self) -> bool:
+        """Consumir un token si hay disponible"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self) -> float:
+        """Segundos hasta que haya un token disponible"""
+        self._refill()
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class ClientLimits:
+    """Buckets, mensajes aplazados y contadores de una conexión"""
+
+    def __init__(self, client_type: str, client_ip: str, rate: float, burst: float):
+        self.client_type = client_type
+        self.client_ip = client_ip
+        self.bucket = TokenBucket(rate, burst)
+        self.action_buckets: Dict[str, TokenBucket] = {}
+        # Último mensaje pendiente por (acción, media_id, propiedad)
+        self.pending: Dict[Tuple, dict] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.counters = {"allowed": 0, "rejected": 0, "coalesced": 0}
+        self.rejected_by_action: Dict[str, int] = {}
+
+class RateLimiter:
+    """Limitar mensajes entrantes por conexión y por acción"""
+
+    def __init__(
+        self,
+        rate: float = 30.0,
+        burst: float = 60.0,
+        action_limits: Optional[Dict[str, Tuple[float, float]]] = None,
+        coalesce_actions: Tuple[str, ...] = ("update_property",)
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.action_limits = action_limits or {}
+        self.coalesce_actions = set(coalesce_actions)
+        self.clients: Dict[WebSocket, ClientLimits] = {}
+        self.totals = {"allowed": 0, "rejected": 0, "coalesced": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def register(self, websocket: WebSocket, client_type: str, client_ip: str):
+        """Registrar una conexión nueva"""
+        self.clients[websocket] = ClientLimits(client_type, client_ip, self.rate, self.burst)
+
+    def unregister(self, websocket: WebSocket):
+        """Olvidar una conexión y cancelar sus mensajes aplazados"""
+        client = self.clients.pop(websocket, None)
+        if client and client.flush_task:
+            client.flush_task.cancel()
+
+    def check(self, websocket: WebSocket, message: dict) -> str:
+        """Decidir si un mensaje se procesa, se rechaza o se fusiona con el siguiente"""
+        client = self.clients.get(websocket)
+        if client is None or not self.enabled:
+            return ALLOW
+
+        action = message.get("action", "")
+        action_bucket = self._action_bucket(client, action)
+
+        # Ya hay un valor aplazado para esta propiedad: el nuevo lo reemplaza en la cola,
+        # así no se aplica antes que el viejo (que terminaría pisándolo)
+        key = self._coalesce_key(message) if action in self.coalesce_actions else None
+        if key is not None and key in client.pending:
+            self._count(client, "coalesced")
+            return COALESCE
+
+        # Consumir del bucket de acción solo si el de conexión tiene tokens
+        if client.bucket.wait_time() == 0 and (action_bucket is None or action_bucket.try_consume()):
+            client.bucket.try_consume()
+            self._count(client, "allowed")
+            return ALLOW
+
+        if key is not None:
+            self._count(client, "coalesced")
+            return COALESCE
+
+        self._count(client, "rejected")
+        client.rejected_by_action[action] = client.rejected_by_action.get(action, 0) + 1
+        return REJECT
+
+    def retry_after(self, websocket: WebSocket, action: str = "") -> float:
+        """Segundos sugeridos antes de reenviar"""
+        client = self.clients.get(websocket)
+        if client is None:
+            return 0.0
+        action_bucket = client.action_buckets.get(action)
+        return max(client.bucket.wait_time(), action_bucket.wait_time() if action_bucket else 0.0)
+
+    def defer(
+        self,
+        websocket: WebSocket,
+        message: dict,
+        flush: Callable[[dict], Awaitable[None]]
+    ) -> Optional[dict]:
+        """Guardar el último valor de una propiedad para aplicarlo cuando haya tokens.
+
+        Retorna el mensaje anterior reemplazado (si lo había) para poder confirmarlo.
+        """
+        client = self.clients[websocket]
+        key = self._coalesce_key(message)
+        superseded = client.pending.pop(key, None)
+        client.pending[key] = message
+
+        if client.flush_task is None or client.flush_task.done():
+            client.flush_task = asyncio.create_task(self._flush_pending(websocket, client, flush))
+        return superseded
+
+    async def _flush_pending(self, websocket: WebSocket, client: ClientLimits, flush: Callable[[dict], Awaitable[None]]):
+        """Aplicar los valores aplazados a medida que se liberan tokens"""
+        while client.pending:
+            key = next(iter(client.pending))
+            action_bucket = self._action_bucket(client, key[0])
+            wait = max(client.bucket.wait_time(), action_bucket.wait_time() if action_bucket else 0.0)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            message = client.pending.pop(key, None)
+            if message is None:
+                continue
+            client.bucket.try_consume()
+            if action_bucket:
+                action_bucket.try_consume()
+            try:
+                await flush(message)
+            except Exception as e:
+                logger.error(f"❌ Error aplicando mensaje aplazado: {e}")
+
+    def _action_bucket(self, client: ClientLimits, action: str) -> Optional[TokenBucket]:
+        if action not in self.action_limits:
+            return None
+        bucket = client.action_buckets.get(action)
+        if bucket is None:
+            rate, burst = self.action_limits[action]
+            bucket = client.action_buckets[action] = TokenBucket(rate, burst)
+        return bucket
+
+    @staticmethod
+    def _coalesce_key(message: dict) -> Optional[Tuple]:
+        if "media_id" not in message or "property" not in message:
+            return None
+        return (message["action"], message["media_id"], message["property"])
+
+    def _count(self, client: ClientLimits, result: str):
+        client.counters[result] += 1
+        self.totals[result] += 1
+
+    def get_stats(self):
+        """Obtener contadores globales y de las conexiones limitadas"""
+        throttled = [
+            {
+                "client_type": client.client_type,
+                "client_ip": client.client_ip,
+                **client.counters,
+                "rejected_by_action": dict(client.rejected_by_action),
+                "pending": len(client.pending)
+            }
+            for client in self.clients.values()
+            if client.counters["rejected"] or client.counters["coalesced"]
+        ]
+        return {
+            "enabled": self.enabled,
+            "rate": self.rate,
+            "burst": self.burst,
+            "action_limits": {action: {"rate": r, "burst": b} for action, (r, b) in self.action_limits.items()},
+            **self.totals,
+            "throttled_clients": throttled
+        }
@@ -0,0 +1,226 @@
+from typing import Optional
+from models.media import MediaState, create_media_item, DIGEST_BUCKETS
+from connection_manager import ConnectionManager
+import asyncio
+import json
+import logging
+import time
+import websockets
+
+logger = logging.getLogger(__name__)
+
+# Acciones que modifican el estado; un relay las rechaza (las escrituras van al servidor principal)
+MUTATING_ACTIONS = {"add_media", "remove_media", "update_property", "clear_all", "undo", "redo"}
+
+def upstream_http_base(upstream_url: str) -> str:
+    """URL HTTP del servidor principal a partir de su URL WebSocket"""
+    if upstream_url.startswith("wss://"):
+        return "https://" + upstream_url[len("wss://"):]
+    if upstream_url.startswith("ws://"):
+        return "http://" + upstream_url[len("ws://"):]
+    return upstream_url
+
+class UpstreamRelay:
+    """Espejo de solo lectura del estado de un servidor principal.
+
+    Se suscribe a `/ws/overlay` del servidor principal, aplica sus broadcasts al
+    MediaState local (adoptando su versión) y los reenvía a los overlays locales.
+    La deriva se detecta comparando checksums y se corrige con el árbol de digests.
+    """
+
+    def __init__(
+        self,
+        upstream_url: str,
+        state: MediaState,
+        manager: ConnectionManager,
+        reconnect_delay: float = 2.0,
+        max_reconnect_delay: float = 30.0
+    ):
+        self.upstream_url = upstream_url.rstrip("/")
+        self.state = state
+        self.manager = manager
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.websocket = None
+        self.connected = False
+        self.synced = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._verifying = False
+
+        self.stats = {
+            "connects": 0,
+            "messages": 0,
+            "full_syncs": 0,
+            "partial_syncs": 0,
+            "drift_detected": 0,
+            "last_message_at": None
+        }
+
+    @property
+    def http_base(self) -> str:
+        return upstream_http_base(self.upstream_url)
+
+    # ------------------------------------------
+    # Ciclo de vida
+    # ------------------------------------------
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"🛰️ Modo relay: espejo de {self.upstream_url}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async with websockets.connect(f"{self.upstream_url}/ws/overlay", max_size=None) as websocket:
+                    self.websocket = websocket
+                    self.connected = True
+                    self.stats["connects"] += 1
+                    logger.info("🛰️ Conectado al servidor principal")
+                    delay = self.reconnect_delay
+                    async for raw in websocket:
+                        retry_after = await self._handle(json.loads(raw))
+                        if retry_after:
+                            delay = max(delay, retry_after)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Conexión con el servidor principal perdida: {e!r}")
+            finally:
+                self.websocket = None
+                self.connected = False
+                self.synced.clear()
+                self._verifying = False
+
+            logger.info(f"🔄 Reconectando al servidor principal en {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    # ------------------------------------------
+    # Mensajes del servidor principal
+    # ------------------------------------------
+
+    async def _handle(self, message: dict) -> Optional[float]:
+        """Aplicar un mensaje del servidor principal; retorna retry_after si fue rechazado"""
+        action = message.get("action")
+        self.stats["messages"] += 1
+        self.stats["last_message_at"] = time.time()
+
+        if action == "sync_state":
+            self._apply_full_sync(message)
+            # Los heartbeats de los overlays locales los envía este nodo, con su propio intervalo
+            message.pop("heartbeat_interval", None)
+            await self.manager.broadcast_to_overlays(message)
+
+        elif action in ("add_media", "remove_media", "update_property", "clear_all"):
+            if not self._apply_mutation(message):
+                # Mutación sobre un item desconocido: el espejo ya estaba desviado
+                await self._verify()
+                return None
+            self.state.adopt_version(message.get("version", self.state.version))
+            await self.manager.broadcast_to_overlays(message)
+            if message.get("checksum") and message["checksum"] != self.state.checksum:
+                await self._verify()
+
+        elif action == "heartbeat":
+            # Verificar de extremo a extremo; también mantiene activa la conexión
+            await self._verify(force=True)
+
+        elif action == "digest_match":
+            self._verifying = False
+            self.state.adopt_version(message["version"])
+
+        elif action == "digest_buckets":
+            local = self.state.bucket_digests()
+            diverged = [b for b in range(DIGEST_BUCKETS) if local[b] != message["buckets"][b]]
+            await self.websocket.send(json.dumps({
+                "action": "resync_buckets",
+                "buckets": {str(b): self.state.bucket_hashes(b) for b in diverged}
+            }))
+
+        elif action == "partial_sync":
+            await self._apply_partial_sync(message)
+
+        elif action == "connection_rejected":
+            logger.warning(f"🚫 Servidor principal rechazó el relay: {message.get('reason')}")
+            return float(message.get("retry_after", self.reconnect_delay))
+
+        return None
+
+    def _apply_full_sync(self, message: dict):
+        items = [create_media_item(**media) for media in message["state"].get("items", {}).values()]
+        self.state.clear()
+        self.state.restore_items(items)
+        self.state.adopt_version(message["version"])
+        self._verifying = False
+        self.synced.set()
+        self.stats["full_syncs"] += 1
+        logger.info(f"🛰️ Espejo sincronizado v{self.state.version}: {len(items)} items")
+
+    def _apply_mutation(self, message: dict) -> bool:
+        action = message["action"]
+        if action == "add_media":
+            self.state.add_item(create_media_item(**message["media"]))
+        elif action == "remove_media":
+            return self.state.remove_item(message["media_id"]) is not None
+        elif action == "update_property":
+            if message["media_id"] not in self.state.items:
+                return False
+            self.state.update_item(message["media_id"], {message["property"]: message["value"]})
+        else:
+            self.state.clear()
+        return True
+
+    async def _apply_partial_sync(self, message: dict):
+        items = [create_media_item(**media) for media in message.get("items", {}).values()]
+        removed = self.state.remove_items(message.get("removed", []))
+        if items:
+            self.state.restore_items(items)
+        self.state.adopt_version(message["version"])
+        self._verifying = False
+        self.stats["partial_syncs"] += 1
+
+        # Reenviar solo las diferencias a los overlays locales
+        stamp = {"version": self.state.version, "checksum": self.state.checksum}
+        for item in removed:
+            await self.manager.broadcast_to_overlays({"action": "remove_media", "media_id": item.id, **stamp})
+        for item in items:
+            await self.manager.broadcast_to_overlays({
+                "action": "add_media",
+                "media": item.to_wire(),
+                "item_hash": self.state.item_hash(item.id),
+                **stamp
+            })
+        logger.info(f"🌳 Espejo corregido v{self.state.version}: {len(items)} items, {len(removed)} eliminados")
+
+    async def _verify(self, force: bool = False):
+        """Pedir la comparación de digests (una a la vez salvo en heartbeats)"""
+        if self.websocket is None or (self._verifying and not force):
+            return
+        if not force:
+            self.stats["drift_detected"] += 1
+        self._verifying = True
+        await self.websocket.send(json.dumps({
+            "action": "verify_digest",
+            "root": self.state.checksum or self.state.calculate_checksum()
+        }))
+
+    def get_stats(self):
+        """Obtener estado de la conexión con el servidor principal"""
+        return {
+            "enabled": True,
+            "upstream": self.upstream_url,
+            "connected": self.connected,
+            "synced": self.synced.is_set(),
+            **self.stats
+        }
@@ -0,0 +1,185 @@
+# replay_session.py - Reproducir una grabación de session_recorder contra un servidor
+#
+#   python replay_session.py recordings/session-20240101-120000-0001.jsonl --url ws://localhost:8000
+#   python replay_session.py recordings/session-*.jsonl --speed 0 --lockstep
+#
+# --speed 1 respeta los tiempos originales, --speed 0 envía lo más rápido posible.
+# --lockstep espera la confirmación de cada operación antes de enviar la siguiente,
+# haciendo el orden de aplicación determinista entre conexiones.
+# Conviene desactivar el rate limiting del servidor destino (RATE_LIMIT_RATE=0).
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import websockets
+
+from session_recorder import OPEN, INBOUND, CLOSE, RECORDING_FORMAT
+
+def read_events(paths: List[Path]) -> Iterator[list]:
+    """Leer los eventos de uno o más archivos de grabación en orden"""
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # Última línea truncada si el proceso murió a mitad de escritura
+                    print(f"⚠️ {path.name}:{line_number} ilegible, se omite", file=sys.stderr)
+                    continue
+                if isinstance(event, dict):
+                    if event.get("format") != RECORDING_FORMAT:
+                        raise ValueError(f"{path} no es una grabación de sesión")
+                    continue
+                yield event
+
+class ReplayConnection:
+    """Conexión reproducida: envía los mensajes grabados y drena las respuestas"""
+
+    def __init__(self, websocket, client_type: str):
+        self.websocket = websocket
+        self.client_type = client_type
+        self.synced = asyncio.Event()
+        self.pending: Dict[str, float] = {}
+        self.acks: Dict[str, asyncio.Event] = {}
+        self.latencies: List[float] = []
+        self.received = 0
+        self.failed = 0
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for raw in self.websocket:
+                self.received += 1
+                message = json.loads(raw)
+                action = message.get("action")
+                if action == "sync_state":
+                    self.synced.set()
+                elif action == "operation_response":
+                    response = message["response"]
+                    sent_at = self.pending.pop(response["request_id"], None)
+                    if sent_at is not None:
+                        self.latencies.append(time.perf_counter() - sent_at)
+                    if not response["success"]:
+                        self.failed += 1
+                    ack = self.acks.pop(response["request_id"], None)
+                    if ack:
+                        ack.set()
+                elif action == "connection_rejected":
+                    print(f"🚫 Conexión {self.client_type} rechazada: {message.get('reason')}", file=sys.stderr)
+                    self.synced.set()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.synced.set()
+            for ack in self.acks.values():
+                ack.set()
+
+    async def send(self, message: dict, wait_ack: bool, timeout: float):
+        request_id = message.get("request_id")
+        ack = None
+        if request_id:
+            self.pending[request_id] = time.perf_counter()
+            if wait_ack:
+                ack = self.acks[request_id] = asyncio.Event()
+        await self.websocket.send(json.dumps(message))
+        if ack:
+            try:
+                await asyncio.wait_for(ack.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.acks.pop(request_id, None)
+                print(f"⏱️ Sin confirmación para {message.get('action')} ({request_id})", file=sys.stderr)
+
+    async def close(self):
+        await self.websocket.close()
+        await self.reader
+
+async def replay(paths: List[Path], url: str, speed: float, lockstep: bool, ack_timeout: float) -> dict:
+    connections: Dict[int, ReplayConnection] = {}
+    closed: List[ReplayConnection] = []
+    sent = 0
+    skipped = 0
+    start = time.perf_counter()
+    origin = None
+
+    for event in read_events(paths):
+        t, kind = event[0], event[1]
+        if origin is None:
+            origin = t
+
+        if speed > 0:
+            delay = (t - origin) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if kind == OPEN:
+            connection_id, client_type = event[2], event[3]
+            # La query decide la suscripción del overlay (grabaciones anteriores no la tienen)
+            query = event[4] if len(event) > 4 else ""
+            endpoint = f"{url}/ws/{client_type}" + (f"?{query}" if query else "")
+            websocket = await websockets.connect(endpoint, max_size=None)
+            connection = ReplayConnection(websocket, client_type)
+            connections[connection_id] = connection
+            # Igual que un cliente real: esperar el estado inicial antes de enviar
+            await asyncio.wait_for(connection.synced.wait(), ack_timeout)
+
+        elif kind == INBOUND:
+            connection = connections.get(event[2])
+            if connection is None:
+                # La conexión se abrió antes de que empezara la grabación (o antes de la rotación)
+                skipped += 1
+                continue
+            await connection.send(event[3], lockstep, ack_timeout)
+            sent += 1
+
+        elif kind == CLOSE:
+            connection = connections.pop(event[2], None)
+            if connection:
+                await connection.close()
+                closed.append(connection)
+
+    # Dar tiempo a las últimas confirmaciones antes de cerrar
+    remaining = list(connections.values())
+    deadline = time.perf_counter() + ack_timeout
+    while any(c.pending for c in remaining) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    for connection in remaining:
+        await connection.close()
+    elapsed = time.perf_counter() - start
+
+    every = closed + remaining
+    latencies = sorted(l for c in every for l in c.latencies)
+    return {
+        "connections": len(every),
+        "sent": sent,
+        "skipped": skipped,
+        "received": sum(c.received for c in every),
+        "failed": sum(c.failed for c in every),
+        "unacknowledged": sum(len(c.pending) for c in every),
+        "elapsed_s": round(elapsed, 3),
+        "sent_per_s": round(sent / elapsed, 1) if elapsed else 0,
+        "ack_p50_ms": round(statistics.median(latencies) * 1000, 2) if latencies else None,
+        "ack_p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2) if latencies else None
+    }
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Reproducir una sesión WebSocket grabada")
+    parser.add_argument("recordings", nargs="+", type=Path, help="Archivos session-*.jsonl en orden")
+    parser.add_argument("--url", default="ws://localhost:8000", help="URL base del servidor destino")
+    parser.add_argument("--speed", type=float, default=1.0, help="Multiplicador de velocidad (0 = lo más rápido posible)")
+    parser.add_argument("--lockstep", action="store_true", help="Esperar la confirmación de cada operación")
+    parser.add_argument("--ack-timeout", type=float, default=10.0, help="Segundos máximos de espera por confirmación")
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(replay(sorted(args.recordings), args.url.rstrip("/"), args.speed, args.lockstep, args.ack_timeout))
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
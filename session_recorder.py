@@ -0,0 +1,202 @@
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO
+from fastapi import WebSocket
+import asyncio
+import datetime
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Formato de grabación (una línea JSON por evento, append-only):
+#   cabecera: {"format": "obs-session", "version": 1, "started": <epoch>, "part": n}
+#   [t, "o", conn_id, client_type, query]   conexión abierta (query: suscripción, ?preload=1...)
+#   [t, "i", conn_id, mensaje]       mensaje entrante del cliente
+#   [t, "b", destino, mensaje]       broadcast saliente ("overlay" | "control")
+#   [t, "c", conn_id]                conexión cerrada
+# `t` son segundos desde el inicio de la sesión (comparten origen entre archivos rotados)
+RECORDING_FORMAT = "obs-session"
+RECORDING_VERSION = 1
+
+OPEN = "o"
+INBOUND = "i"
+BROADCAST = "b"
+CLOSE = "c"
+
+def encode_event(*fields) -> str:
+    """Serializar un evento en JSON compacto"""
+    return json.dumps(fields, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+class SessionRecorder:
+    """Grabar el tráfico WebSocket en archivos JSONL rotados sin bloquear el event loop"""
+
+    def __init__(
+        self,
+        directory: Path,
+        max_file_bytes: int = 20 * 1024 * 1024,
+        max_files: int = 10,
+        flush_interval: float = 1.0,
+        max_buffer_bytes: int = 4 * 1024 * 1024
+    ):
+        self.directory = Path(directory)
+        self.max_file_bytes = max_file_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes
+
+        self.started = time.time()
+        self._origin = time.monotonic()
+        self._buffer: List[str] = []
+        self._buffer_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        self._connection_ids: Dict[WebSocket, int] = {}
+        self._next_connection_id = 1
+
+        # Estado del archivo actual (solo lo usa el hilo de escritura)
+        self._file: Optional[TextIO] = None
+        self._file_bytes = 0
+        self._part = 0
+        self.current_path: Optional[Path] = None
+
+        self.stats = {"events": 0, "bytes_written": 0, "dropped": 0, "files": 0}
+
+    # ------------------------------------------
+    # Ciclo de vida
+    # ------------------------------------------
+
+    def start(self):
+        """Iniciar la tarea de escritura en segundo plano"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._writer_task = asyncio.create_task(self._writer_loop())
+        logger.info(f"⏺️ Grabación de sesión activa en {self.directory}")
+
+    async def stop(self):
+        """Vaciar el buffer pendiente y cerrar el archivo.
+
+        No se cancela la tarea de escritura: una escritura ya en curso en su hilo seguiría
+        corriendo. Se le pide terminar y se espera su último vaciado.
+        """
+        if self._writer_task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._writer_task
+            self._writer_task = None
+        else:
+            await self._flush()
+        await asyncio.to_thread(self._close_file)
+
+    # ------------------------------------------
+    # Registro de eventos (llamados desde el event loop, sin E/S)
+    # ------------------------------------------
+
+    def open(self, websocket: WebSocket, client_type: str):
+        connection_id = self._next_connection_id
+        self._next_connection_id += 1
+        self._connection_ids[websocket] = connection_id
+        self._append(OPEN, connection_id, client_type, websocket.url.query)
+
+    def close(self, websocket: WebSocket):
+        connection_id = self._connection_ids.pop(websocket, None)
+        if connection_id is not None:
+            self._append(CLOSE, connection_id)
+
+    def record_inbound(self, websocket: WebSocket, message: dict):
+        connection_id = self._connection_ids.get(websocket)
+        if connection_id is not None:
+            self._append(INBOUND, connection_id, message)
+
+    def record_broadcast(self, target: str, message: dict):
+        self._append(BROADCAST, target, message)
+
+    def _append(self, kind: str, *fields):
+        if self._buffer_bytes >= self.max_buffer_bytes:
+            # El disco no da abasto: descartar antes que crecer sin límite
+            self.stats["dropped"] += 1
+            return
+        line = encode_event(round(time.monotonic() - self._origin, 3), kind, *fields)
+        self._buffer.append(line)
+        self._buffer_bytes += len(line)
+        self.stats["events"] += 1
+        if self._buffer_bytes >= self.max_buffer_bytes // 4:
+            self._wakeup.set()
+
+    # ------------------------------------------
+    # Escritura
+    # ------------------------------------------
+
+    async def _writer_loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush()
+        # Lo registrado durante el último vaciado
+        await self._flush()
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        try:
+            await asyncio.to_thread(self._write_lines, lines)
+        except Exception as e:
+            self.stats["dropped"] += len(lines)
+            logger.error(f"❌ Error escribiendo grabación de sesión: {e}")
+
+    def _write_lines(self, lines: List[str]):
+        chunk = "".join(lines)
+        size = len(chunk.encode("utf-8"))
+        if self._file is None or (self._file_bytes and self._file_bytes + size > self.max_file_bytes):
+            self._rotate()
+        self._file.write(chunk)
+        self._file.flush()
+        self._file_bytes += size
+        self.stats["bytes_written"] += size
+
+    def _rotate(self):
+        self._close_file()
+        self._part += 1
+        stamp = datetime.datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S")
+        self.current_path = self.directory / f"session-{stamp}-{self._part:04d}.jsonl"
+        self._file = open(self.current_path, "a", encoding="utf-8")
+        header = json.dumps({
+            "format": RECORDING_FORMAT,
+            "version": RECORDING_VERSION,
+            "started": self.started,
+            "part": self._part
+        }, separators=(",", ":")) + "\n"
+        self._file.write(header)
+        self._file_bytes = len(header)
+        self.stats["files"] += 1
+        self._prune()
+
+    def _prune(self):
+        recordings = sorted(self.directory.glob("session-*.jsonl"))
+        for old in recordings[:-self.max_files] if self.max_files > 0 else []:
+            try:
+                old.unlink()
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo eliminar grabación antigua {old.name}: {e}")
+
+    def _close_file(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def get_stats(self):
+        """Obtener contadores de la grabación"""
+        return {
+            "enabled": True,
+            "path": str(self.current_path) if self.current_path else None,
+            "buffered_events": len(self._buffer),
+            "connections": len(self._connection_ids),
+            **self.stats
+        }
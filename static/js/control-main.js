@@ -51,6 +51,7 @@ class ControlPanel {
         // WebSocket events - mejorados con versionado
         this.wsManager.onConnectionChange(this.handleConnectionChange.bind(this));
         this.wsManager.onMessage('sync_state', this.handleSyncState.bind(this));
+        this.wsManager.onMessage('partial_sync', this.handlePartialSync.bind(this));
         this.wsManager.onMessage('property_updated', this.handlePropertyUpdated.bind(this));
         this.wsManager.onMessage('media_added', this.handleMediaAdded.bind(this));
         this.wsManager.onMessage('media_removed', this.handleMediaRemoved.bind(this));
@@ -68,6 +69,9 @@ class ControlPanel {
         this.uiManager.on('propertyChange', this.handlePropertyChange.bind(this));
         this.uiManager.on('filesSelected', this.handleFilesSelected.bind(this));
         this.uiManager.on('filesDropped', this.handleFilesDropped.bind(this));
+        
+        // Deshacer/rehacer: Ctrl+Z, Ctrl+Shift+Z, Ctrl+Y
+        document.addEventListener('keydown', this.handleHistoryShortcut.bind(this));
     }
 
     // WebSocket Event Handlers
@@ -106,6 +110,22 @@ class ControlPanel {
         }
     }
 
+    handlePartialSync(data) {
+        const items = Object.values(data.items || {});
+        const removed = data.removed || [];
+        console.log(`🌳 Resincronización parcial: ${items.length} items, ${removed.length} eliminados (v${data.version})`);
+        
+        removed.forEach(mediaId => this.mediaManager.removeActiveMedia(mediaId));
+        items.forEach(media => this.mediaManager.addActiveMedia(media));
+        
+        if (this.selectedItemId && removed.includes(this.selectedItemId)) {
+            this.selectedItemId = null;
+            this.uiManager.hideProperties();
+        }
+        
+        this.uiManager.updateActiveMedia(this.mediaManager.getActiveMedia());
+    }
+
     handlePropertyUpdated(data) {
         console.log(`🔧 Propiedad actualizada: ${data.media_id}.${data.property} (v${data.version})`);
         
@@ -252,10 +272,12 @@ class ControlPanel {
     async addToOverlay(media) {
         try {
             // Preparar datos del media con configuración por defecto
+            // (el tamaño de la biblioteca ya tiene la proporción real; info no viaja al estado)
+            const { info, ...libraryItem } = media;
             const mediaData = {
-                ...media,
+                ...libraryItem,
                 position: { x: 100, y: 100 },
-                size: { width: 200, height: 200 },
+                size: media.size ? { ...media.size } : { width: 200, height: 200 },
                 opacity: 1,
                 volume: 1,
                 visible: true,
@@ -421,6 +443,38 @@ class ControlPanel {
         }
     }
 
+    async applyHistory(action) {
+        try {
+            const response = await this.wsManager.sendWithConfirmation({ action });
+            
+            if (!response.data?.applied) {
+                this.uiManager.showNotification(action === 'undo' ? 'Nada que deshacer' : 'Nada que rehacer', 'info');
+            }
+            // Los cambios llegan como difusiones normales del servidor
+            
+        } catch (error) {
+            console.error(`❌ Error en ${action}:`, error);
+            this.uiManager.showNotification('Error al deshacer/rehacer', 'error');
+        }
+    }
+
+    handleHistoryShortcut(e) {
+        if (!(e.ctrlKey || e.metaKey)) return;
+        
+        // No interferir con el deshacer nativo de los campos de texto
+        const target = e.target;
+        if (target.isContentEditable || ['INPUT', 'TEXTAREA', 'SELECT'].includes(target.tagName)) return;
+        
+        const key = e.key.toLowerCase();
+        if (key === 'z' && !e.shiftKey) {
+            e.preventDefault();
+            this.applyHistory('undo');
+        } else if ((key === 'z' && e.shiftKey) || key === 'y') {
+            e.preventDefault();
+            this.applyHistory('redo');
+        }
+    }
+
     copyUrl() {
         const urlInput = document.getElementById('overlayUrl');
         if (urlInput) {
@@ -0,0 +1,55 @@
+// static/js/modules/media-defaults.js - VALORES POR DEFECTO DE MediaItem
+// El servidor omite los valores por defecto al serializar; deben coincidir con models/media.py
+
+const BASE_DEFAULTS = {
+    filename: '',
+    url: '',
+    position: { x: 100, y: 100 },
+    size: { width: 200, height: 200 },
+    opacity: 1.0,
+    visible: true,
+    z_index: 0,
+    group: null,
+    tags: []
+};
+
+const TYPE_DEFAULTS = {
+    video: {
+        volume: 1.0
+    },
+    text: {
+        text_content: null,
+        font_family: 'Arial',
+        font_size: 48,
+        font_weight: 'normal',
+        font_style: 'normal',
+        text_align: 'left',
+        text_color: '#ffffff',
+        text_shadow: false,
+        text_shadow_color: '#000000',
+        text_shadow_blur: 2,
+        text_shadow_offset: { x: 1, y: 1 },
+        background_color: null,
+        padding: { top: 10, right: 10, bottom: 10, left: 10 }
+    }
+};
+
+// Completar en el mismo objeto los campos omitidos (copiando los valores anidados)
+export function applyMediaDefaults(media) {
+    if (!media) return media;
+
+    const defaults = { ...BASE_DEFAULTS, ...(TYPE_DEFAULTS[media.type] || {}) };
+    Object.entries(defaults).forEach(([key, value]) => {
+        if (media[key] === undefined) {
+            media[key] = Array.isArray(value) ? [...value] : value && typeof value === 'object' ? { ...value } : value;
+        }
+    });
+    return media;
+}
+
+export function applyStateDefaults(state) {
+    if (state && state.items) {
+        Object.values(state.items).forEach(applyMediaDefaults);
+    }
+    return state;
+}
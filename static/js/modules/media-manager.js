@@ -35,20 +35,8 @@ class MediaManager {
     }
 
     async uploadFile(file, onProgress = null) {
-        const formData = new FormData();
-        formData.append('file', file);
-        
         try {
-            const response = await fetch('/api/media/upload', {
-                method: 'POST',
-                body: formData
-            });
-            
-            if (!response.ok) {
-                throw new Error(`HTTP ${response.status}: ${response.statusText}`);
-            }
-            
-            const data = await response.json();
+            const data = await this.uploadResumable(file, onProgress);
             
             if (data.error) {
                 throw new Error(data.error);
@@ -67,6 +55,129 @@ class MediaManager {
         }
     }
 
+    // Subida reanudable por trozos: tras un corte se consulta el offset del servidor
+    // y se continúa desde ahí, sin volver a enviar lo que ya llegó
+    async uploadResumable(file, onProgress = null) {
+        const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+        const sha256 = await this.hashFile(file);
+        let upload = await this.resumeUpload(resumeKey);
+        
+        if (!upload) {
+            const response = await fetch('/api/media/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    filename: file.name,
+                    size: file.size,
+                    content_type: file.type,
+                    sha256
+                })
+            });
+            upload = await response.json();
+            if (!response.ok) {
+                throw new Error(upload.detail || `HTTP ${response.status}`);
+            }
+            localStorage.setItem(resumeKey, JSON.stringify({ upload_id: upload.upload_id, chunk_size: upload.chunk_size }));
+        }
+        
+        const url = `/api/media/uploads/${upload.upload_id}`;
+        let offset = upload.offset;
+        let failures = 0;
+        
+        while (offset < file.size) {
+            const end = Math.min(offset + upload.chunk_size, file.size);
+            try {
+                const response = await fetch(url, {
+                    method: 'PATCH',
+                    headers: { 'Upload-Offset': String(offset) },
+                    body: file.slice(offset, end)
+                });
+                const result = await response.json();
+                if (response.status === 409) {
+                    // El servidor tiene otro offset (trozo parcial o reintento en curso)
+                    offset = result.offset;
+                    failures++;
+                } else if (!response.ok) {
+                    throw new Error(result.detail || `HTTP ${response.status}`);
+                } else {
+                    offset = result.offset;
+                    failures = 0;
+                }
+            } catch (error) {
+                if (error instanceof TypeError) {
+                    // Error de red: retomar desde lo que el servidor confirma tener
+                    failures++;
+                    offset = await this.queryUploadOffset(url, offset);
+                } else {
+                    throw error;
+                }
+            }
+            
+            if (failures > 5) {
+                throw new Error('Subida interrumpida: demasiados reintentos');
+            }
+            if (failures > 0) {
+                await new Promise(resolve => setTimeout(resolve, 500 * 2 ** failures));
+            }
+            if (onProgress) {
+                onProgress(offset / file.size);
+            }
+        }
+        
+        const response = await fetch(`${url}/finalize`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ sha256 })
+        });
+        const data = await response.json();
+        if (response.status !== 409) {
+            // Completada o descartada por el servidor: no hay nada que retomar
+            localStorage.removeItem(resumeKey);
+        }
+        if (!response.ok) {
+            throw new Error(data.detail || `HTTP ${response.status}`);
+        }
+        return data;
+    }
+
+    async resumeUpload(resumeKey) {
+        const saved = JSON.parse(localStorage.getItem(resumeKey) || 'null');
+        if (!saved) {
+            return null;
+        }
+        try {
+            const response = await fetch(`/api/media/uploads/${saved.upload_id}`);
+            if (response.ok) {
+                return { ...saved, ...(await response.json()) };
+            }
+        } catch (error) {
+            console.warn('No se pudo retomar la subida:', error);
+        }
+        localStorage.removeItem(resumeKey);
+        return null;
+    }
+
+    async queryUploadOffset(url, fallback) {
+        try {
+            const response = await fetch(url);
+            if (response.ok) {
+                return (await response.json()).offset;
+            }
+        } catch (error) {
+            // Sigue sin red: reintentar el mismo trozo
+        }
+        return fallback;
+    }
+
+    async hashFile(file) {
+        // crypto.subtle solo existe en contextos seguros (https o localhost)
+        if (!window.crypto || !window.crypto.subtle) {
+            return null;
+        }
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
     async uploadFiles(files) {
         const results = [];
         
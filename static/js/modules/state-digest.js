@@ -0,0 +1,79 @@
+// static/js/modules/state-digest.js - ÁRBOL DE DIGESTS DEL ESTADO
+// Debe coincidir con fnv1a/digest_bucket/bucket_digests de models/media.py
+
+export const DIGEST_BUCKETS = 16;
+
+const encoder = new TextEncoder();
+
+// FNV-1a de 32 bits en hex (8 caracteres)
+export function fnv1a(text) {
+    let h = 0x811c9dc5;
+    for (const byte of encoder.encode(text)) {
+        h = Math.imul(h ^ byte, 0x01000193) >>> 0;
+    }
+    return h.toString(16).padStart(8, '0');
+}
+
+export function digestBucket(mediaId) {
+    return parseInt(fnv1a(mediaId), 16) % DIGEST_BUCKETS;
+}
+
+// Hashes de items recibidos del servidor; raíz = fnv1a(digests de buckets)
+export class StateDigest {
+    constructor() {
+        this.hashes = new Map();
+    }
+
+    reset(hashes = {}) {
+        this.hashes = new Map(Object.entries(hashes));
+    }
+
+    set(mediaId, hash) {
+        if (hash === null || hash === undefined) {
+            this.hashes.delete(mediaId);
+        } else {
+            this.hashes.set(mediaId, hash);
+        }
+    }
+
+    apply(hashes = {}) {
+        Object.entries(hashes).forEach(([mediaId, hash]) => this.set(mediaId, hash));
+    }
+
+    clear() {
+        this.hashes.clear();
+    }
+
+    groupByBucket() {
+        const buckets = Array.from({ length: DIGEST_BUCKETS }, () => []);
+        this.hashes.forEach((hash, mediaId) => {
+            buckets[digestBucket(mediaId)].push(mediaId);
+        });
+        return buckets;
+    }
+
+    bucketDigests() {
+        // Orden por code point, igual que sorted() en Python
+        return this.groupByBucket().map(ids =>
+            fnv1a(ids.sort((a, b) => (a < b ? -1 : a > b ? 1 : 0))
+                .map(id => `${id}:${this.hashes.get(id)};`).join(''))
+        );
+    }
+
+    root() {
+        return fnv1a(this.bucketDigests().join(''));
+    }
+
+    // Hashes locales de los buckets que no coinciden con los del servidor
+    divergedBuckets(serverBuckets) {
+        const local = this.bucketDigests();
+        const groups = this.groupByBucket();
+        const diverged = {};
+        serverBuckets.forEach((digest, bucket) => {
+            if (digest !== local[bucket]) {
+                diverged[bucket] = Object.fromEntries(groups[bucket].map(id => [id, this.hashes.get(id)]));
+            }
+        });
+        return diverged;
+    }
+}
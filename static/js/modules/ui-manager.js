@@ -57,6 +57,8 @@ class UIManager {
             posY: document.getElementById('posY'),
             sizeWidth: document.getElementById('sizeWidth'),
             sizeHeight: document.getElementById('sizeHeight'),
+            mediaGroup: document.getElementById('mediaGroup'),
+            mediaTags: document.getElementById('mediaTags'),
             
             // Text properties
             textProperties: document.getElementById('textProperties'),
@@ -122,6 +124,16 @@ class UIManager {
                 this.debounce(this.handleSizeChange.bind(this), 100));
         }
         
+        if (this.elements.mediaGroup) {
+            this.elements.mediaGroup.addEventListener('change', 
+                this.handleGroupChange.bind(this));
+        }
+        
+        if (this.elements.mediaTags) {
+            this.elements.mediaTags.addEventListener('change', 
+                this.handleTagsChange.bind(this));
+        }
+        
         // Text property controls
         this.setupTextPropertyControls();
     }
@@ -513,6 +525,14 @@ class UIManager {
             this.elements.sizeHeight.value = Math.round(media.size.height);
         }
         
+        // Group / tags
+        if (this.elements.mediaGroup) {
+            this.elements.mediaGroup.value = media.group || '';
+        }
+        if (this.elements.mediaTags) {
+            this.elements.mediaTags.value = (media.tags || []).join(', ');
+        }
+        
         // Text properties (solo para elementos de texto)
         if (media.type === 'text') {
             this.showTextProperties(media);
@@ -664,6 +684,27 @@ class UIManager {
         });
     }
 
+    handleGroupChange() {
+        if (!this.state.selectedMediaId || !this.elements.mediaGroup) return;
+        
+        this.emit('propertyChange', {
+            mediaId: this.state.selectedMediaId,
+            property: 'group',
+            value: this.elements.mediaGroup.value.trim() || null
+        });
+    }
+
+    handleTagsChange() {
+        if (!this.state.selectedMediaId || !this.elements.mediaTags) return;
+        
+        const tags = this.elements.mediaTags.value.split(',').map(tag => tag.trim()).filter(Boolean);
+        this.emit('propertyChange', {
+            mediaId: this.state.selectedMediaId,
+            property: 'tags',
+            value: tags
+        });
+    }
+
     // Text property handlers
     handleTextContentChange() {
         if (!this.state.selectedMediaId || !this.elements.textContent) return;
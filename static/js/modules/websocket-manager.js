@@ -1,9 +1,13 @@
+import { applyMediaDefaults, applyStateDefaults } from './media-defaults.js';
+import { StateDigest } from './state-digest.js';
+
 class WebSocketManager {
     constructor() {
         this.ws = null;
         this.reconnectDelay = 2000;
         this.maxReconnectAttempts = 5;
         this.reconnectAttempts = 0;
+        this.retryAfterMs = null; // Sugerido por el servidor al rechazar la conexión
         this.connectionListeners = [];
         this.messageHandlers = {};
         this.isConnecting = false;
@@ -11,6 +15,7 @@ class WebSocketManager {
         // Estado versionado
         this.stateVersion = 0;
         this.stateChecksum = '';
+        this.digest = new StateDigest(); // Hashes de items para resincronización parcial
         
         // Cola de operaciones pendientes
         this.pendingOperations = new Map();
@@ -18,9 +23,11 @@ class WebSocketManager {
         this.retryQueue = [];
         this.maxRetries = 3;
         
-        // Verificación periódica
-        this.versionCheckInterval = null;
-        this.versionCheckPeriod = 30000; // 30 segundos
+        // Heartbeat del servidor: si no llega ningún mensaje en este tiempo
+        // se considera la conexión muerta y se fuerza la reconexión.
+        // Se fija con el intervalo que anuncia sync_state (null/0 = sin vigilancia)
+        this.heartbeatWatchdog = null;
+        this.heartbeatTimeout = null;
     }
 
     getWebSocketUrl(endpoint) {
@@ -48,8 +55,8 @@ class WebSocketManager {
                     this.reconnectAttempts = 0;
                     this.notifyConnectionChange(true);
                     
-                    // Iniciar verificación periódica de versión
-                    this.startVersionCheck();
+                    // Vigilar heartbeats del servidor
+                    this.resetHeartbeatWatchdog();
                     
                     // Procesar cola de reintentos
                     this.processRetryQueue();
@@ -58,6 +65,7 @@ class WebSocketManager {
                 };
                 
                 this.ws.onmessage = (event) => {
+                    this.resetHeartbeatWatchdog();
                     try {
                         const data = JSON.parse(event.data);
                         this.handleMessage(data);
@@ -70,7 +78,7 @@ class WebSocketManager {
                     console.error('❌ WebSocket error:', error);
                     this.isConnecting = false;
                     this.notifyConnectionChange(false);
-                    this.stopVersionCheck();
+                    this.stopHeartbeatWatchdog();
                     reject(error);
                 };
                 
@@ -78,7 +86,7 @@ class WebSocketManager {
                     console.log('🔌 WebSocket desconectado:', event.code, event.reason);
                     this.isConnecting = false;
                     this.notifyConnectionChange(false);
-                    this.stopVersionCheck();
+                    this.stopHeartbeatWatchdog();
                     
                     // Mover operaciones pendientes a cola de reintentos
                     this.moveOperationsToRetryQueue();
@@ -102,11 +110,13 @@ class WebSocketManager {
         }
 
         this.reconnectAttempts++;
-        console.log(`🔄 Reconectando en ${this.reconnectDelay}ms (intento ${this.reconnectAttempts})`);
+        const delay = this.retryAfterMs || this.reconnectDelay;
+        this.retryAfterMs = null;
+        console.log(`🔄 Reconectando en ${delay}ms (intento ${this.reconnectAttempts})`);
         
         setTimeout(() => {
             this.connect(endpoint);
-        }, this.reconnectDelay);
+        }, delay);
     }
 
     // Envío mejorado con confirmación
@@ -183,6 +193,25 @@ class WebSocketManager {
     }
 
     handleMessage(data) {
+        // El heartbeat se compara ANTES de adoptar su versión
+        if (data.action === 'heartbeat') {
+            this.handleHeartbeat(data);
+            return;
+        }
+
+        // Servidor lleno: respetar el tiempo de reintento sugerido
+        if (data.action === 'connection_rejected') {
+            console.warn(`🚫 Conexión rechazada (${data.reason}), reintento en ${data.retry_after}s`);
+            this.retryAfterMs = (data.retry_after || 0) * 1000;
+            return;
+        }
+
+        // Entre dos heartbeats pueden pasar hasta 2 intervalos: tolerar 3
+        if (data.heartbeat_interval !== undefined) {
+            this.heartbeatTimeout = data.heartbeat_interval > 0 ? data.heartbeat_interval * 3000 : null;
+            this.resetHeartbeatWatchdog();
+        }
+
         // Actualizar versión si viene en el mensaje
         if (data.version !== undefined) {
             this.stateVersion = data.version;
@@ -191,8 +220,39 @@ class WebSocketManager {
             this.stateChecksum = data.checksum;
         }
 
+        // Completar valores por defecto omitidos por el servidor
+        if (data.media) {
+            applyMediaDefaults(data.media);
+        }
+        if (data.state) {
+            applyStateDefaults(data.state);
+        }
+        if (data.action === 'partial_sync' && data.items) {
+            Object.values(data.items).forEach(applyMediaDefaults);
+        }
+
+        // Mantener los hashes de items (hojas del árbol de digests)
+        this.trackItemHashes(data);
+
+        // Árbol de digests: la raíz coincide o hay que bajar a los buckets
+        if (data.action === 'digest_match') {
+            return;
+        }
+        if (data.action === 'digest_buckets') {
+            this.handleDigestBuckets(data);
+            return;
+        }
+        if (data.action === 'partial_sync' && !this.messageHandlers.partial_sync) {
+            // Sin soporte de resincronización parcial: pedir el estado completo
+            this.send({ action: 'request_sync' });
+            return;
+        }
+
         // Manejar respuestas de operaciones
         if (data.action === 'operation_response' && data.response) {
+            if (data.response.data && data.response.data.media) {
+                applyMediaDefaults(data.response.data.media);
+            }
             this.handleOperationResponse(data.response);
             return;
         }
@@ -251,25 +311,93 @@ class WebSocketManager {
         }
     }
 
-    // Verificación periódica de versión
-    startVersionCheck() {
-        this.stopVersionCheck(); // Limpiar interval anterior si existe
-        
-        this.versionCheckInterval = setInterval(() => {
-            if (this.isConnected()) {
-                this.send({
-                    action: 'verify_version',
-                    client_version: this.stateVersion,
-                    client_checksum: this.stateChecksum
-                });
+    // Heartbeat empujado por el servidor: solo verificar si hay diferencia
+    handleHeartbeat(data) {
+        const localRoot = this.digest.root();
+        if (data.checksum === localRoot) {
+            // Mismo contenido: adoptar la versión aunque se haya perdido algún mensaje
+            this.stateVersion = data.version;
+            this.stateChecksum = data.checksum;
+            return;
+        }
+
+        console.warn(`⚠️ Heartbeat con estado distinto: cliente v${this.stateVersion} (${localRoot}) vs servidor v${data.version} (${data.checksum})`);
+        this.send({
+            action: 'verify_digest',
+            root: localRoot
+        });
+    }
+
+    handleDigestBuckets(data) {
+        const diverged = this.digest.divergedBuckets(data.buckets || []);
+        const count = Object.keys(diverged).length;
+        if (count === 0) return;
+
+        console.log(`🌳 ${count} buckets divergentes, solicitando solo esos items`);
+        this.send({
+            action: 'resync_buckets',
+            buckets: diverged
+        });
+    }
+
+    trackItemHashes(data) {
+        switch (data.action) {
+            case 'sync_state':
+                this.digest.reset(data.hashes || {});
+                break;
+            case 'add_media':
+            case 'media_added':
+                if (data.media && data.item_hash) {
+                    this.digest.set(data.media.id, data.item_hash);
+                }
+                break;
+            case 'update_property':
+            case 'property_updated':
+                if (data.item_hash) {
+                    this.digest.set(data.media_id, data.item_hash);
+                }
+                break;
+            case 'remove_media':
+            case 'media_removed':
+                this.digest.set(data.media_id, null);
+                break;
+            case 'clear_all':
+            case 'overlay_cleared':
+                this.digest.clear();
+                break;
+            case 'partial_sync':
+                (data.removed || []).forEach(mediaId => this.digest.set(mediaId, null));
+                this.digest.apply(data.hashes);
+                break;
+            case 'operation_response':
+                if (data.response && data.response.success) {
+                    if (data.response.action === 'clear_all') {
+                        this.digest.clear();
+                    }
+                    this.digest.apply(data.response.data?.hashes);
+                }
+                break;
+        }
+    }
+
+    resetHeartbeatWatchdog() {
+        this.stopHeartbeatWatchdog();
+        if (!this.heartbeatTimeout) {
+            return;
+        }
+
+        this.heartbeatWatchdog = setTimeout(() => {
+            if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+                console.warn('⚠️ Sin heartbeat del servidor, reconectando...');
+                this.ws.close(4000, 'heartbeat timeout');
             }
-        }, this.versionCheckPeriod);
+        }, this.heartbeatTimeout);
     }
 
-    stopVersionCheck() {
-        if (this.versionCheckInterval) {
-            clearInterval(this.versionCheckInterval);
-            this.versionCheckInterval = null;
+    stopHeartbeatWatchdog() {
+        if (this.heartbeatWatchdog) {
+            clearTimeout(this.heartbeatWatchdog);
+            this.heartbeatWatchdog = null;
         }
     }
 
@@ -375,7 +503,7 @@ class WebSocketManager {
     }
 
     disconnect() {
-        this.stopVersionCheck();
+        this.stopHeartbeatWatchdog();
         
         if (this.ws) {
             this.ws.close();
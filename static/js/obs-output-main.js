@@ -11,6 +11,12 @@ class OBSOutput {
         this.maxReconnectAttempts = 5;
         this.reconnectAttempts = 0;
         this.syncRequestPending = false;
+        this.retryAfterMs = null;
+        // Precarga sugerida por el servidor: URLs ya descargadas y cola pendiente
+        this.preloaded = new Set();
+        this.preloadQueue = [];
+        this.preloading = false;
+        this.preloadInFlight = null; // { url, controller } de la descarga en curso
     }
 
     init() {
@@ -47,7 +53,11 @@ class OBSOutput {
     connectWebSocket() {
         // IMPORTANTE: Usar el mismo endpoint que el overlay editor
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws/overlay`;
+        // La query de la página (?groups=..&tags=..&z=..&ids=..) se pasa como suscripción
+        const params = new URLSearchParams(window.location.search);
+        // Este cliente confirma lo que precarga: aceptar pistas de precarga
+        params.set('preload', '1');
+        const wsUrl = `${protocol}//${window.location.host}/ws/overlay?${params}`;
         
         console.log(`🔌 OBS Output conectando a WebSocket: ${wsUrl}`);
         this.ws = new WebSocket(wsUrl);
@@ -112,11 +122,13 @@ class OBSOutput {
         }
 
         this.reconnectAttempts++;
-        console.log(`🔄 OBS Output reconectando en ${this.reconnectDelay}ms (intento ${this.reconnectAttempts})`);
+        const delay = this.retryAfterMs || this.reconnectDelay;
+        this.retryAfterMs = null;
+        console.log(`🔄 OBS Output reconectando en ${delay}ms (intento ${this.reconnectAttempts})`);
         
         setTimeout(() => {
             this.connectWebSocket();
-        }, this.reconnectDelay);
+        }, delay);
     }
 
     handleMessage(data) {
@@ -137,6 +149,17 @@ class OBSOutput {
                 case 'clear_all':
                     this.handleClearAll();
                     break;
+                case 'preload':
+                    this.handlePreload(data);
+                    break;
+                case 'connection_rejected':
+                    this.retryAfterMs = (data.retry_after || 0) * 1000;
+                    break;
+                case 'heartbeat':
+                case 'version_check':
+                case 'digest_match':
+                case 'digest_buckets':
+                    break;
                 default:
                     console.warn('⚠️ OBS Output acción no reconocida:', data.action);
             }
@@ -178,6 +201,79 @@ class OBSOutput {
         this.clearAll();
     }
 
+    handlePreload(data) {
+        console.log(`📥 OBS Output precarga sugerida (${data.reason}):`, data.assets.length);
+        this.preloadQueue.push(...data.assets);
+        this.processPreloadQueue();
+    }
+
+    // Descargar de a uno para no competir con el stream; el servidor no repite lo confirmado
+    async processPreloadQueue() {
+        if (this.preloading) return;
+        this.preloading = true;
+        
+        while (this.preloadQueue.length > 0) {
+            const asset = this.preloadQueue.shift();
+            let cached = true;
+            
+            // Un elemento montado ya descarga su asset: confirmar sin pedirlo otra vez
+            if (!this.preloaded.has(asset.url) && !this.isMounted(asset.url)) {
+                const controller = new AbortController();
+                this.preloadInFlight = { url: asset.url, controller };
+                try {
+                    const response = await fetch(asset.url, { signal: controller.signal });
+                    if (!response.ok) {
+                        throw new Error(`HTTP ${response.status}`);
+                    }
+                    // Leer el cuerpo completo para que quede en la caché HTTP
+                    await response.blob();
+                    this.preloaded.add(asset.url);
+                } catch (error) {
+                    // Abortada porque el item se montó mientras tanto: lo descarga el elemento
+                    if (!controller.signal.aborted) {
+                        console.warn('⚠️ OBS Output no pudo precargar:', asset.url, error);
+                        cached = false;
+                    }
+                }
+                this.preloadInFlight = null;
+            }
+            
+            this.sendPreloadAck(asset.url, cached);
+        }
+        
+        this.preloading = false;
+    }
+
+    sendPreloadAck(url, cached) {
+        if (this.ws?.readyState === WebSocket.OPEN) {
+            this.ws.send(JSON.stringify({
+                action: 'preload_ack',
+                cached: cached ? [url] : [],
+                failed: cached ? [] : [url]
+            }));
+        }
+    }
+
+    isMounted(url) {
+        for (const { media } of this.activeMedia.values()) {
+            if (media.url === url) return true;
+        }
+        return false;
+    }
+
+    // Se montó un elemento con esta URL: no descargarla también desde la cola de precarga
+    settlePreload(url) {
+        if (!url) return;
+        if (this.preloadInFlight?.url === url) {
+            this.preloadInFlight.controller.abort();
+        }
+        const queued = this.preloadQueue.filter(asset => asset.url === url);
+        if (queued.length > 0) {
+            this.preloadQueue = this.preloadQueue.filter(asset => asset.url !== url);
+            this.sendPreloadAck(url, true);
+        }
+    }
+
     // Core Methods - MEJORADOS
     addMedia(media) {
         try {
@@ -194,6 +290,7 @@ class OBSOutput {
                 media: { ...media },
                 element: element
             });
+            this.settlePreload(media.url);
 
             console.log('✅ OBS Output media agregada:', media.filename || media.id);
             this.updateDebugCount();
@@ -236,7 +333,8 @@ class OBSOutput {
             video.loop = true;
             video.muted = false;
             video.volume = Math.max(0, Math.min(1, media.volume || 1.0));
-            video.preload = 'metadata';
+            // Precargado (en caché) u oculto (se mostrará pronto): bufferizar completo
+            video.preload = this.preloaded.has(media.url) || media.visible === false ? 'auto' : 'metadata';
             video.style.cssText = 'width: 100%; height: 100%; object-fit: contain; display: block;';
             
             video.onerror = () => {
@@ -261,8 +359,9 @@ class OBSOutput {
         // Aplicar estilos exactamente como en el overlay
         const styles = {
             position: 'absolute',
-            left: (media.position?.x || 0) + 'px',
-            top: (media.position?.y || 0) + 'px',
+            // El servidor omite los valores por defecto (posición 100,100)
+            left: (media.position?.x ?? 100) + 'px',
+            top: (media.position?.y ?? 100) + 'px',
             width: (media.size?.width || 200) + 'px',
             height: (media.size?.height || 200) + 'px',
             opacity: media.opacity !== undefined ? media.opacity : 1,
@@ -274,7 +373,8 @@ class OBSOutput {
         Object.assign(element.style, styles);
         
         // IMPORTANTE: No mostrar elementos fuera del área visible en OBS
-        element.style.display = 'block';
+        // (los items ocultos siguen en el DOM para que su asset ya esté cargado al mostrarse)
+        element.style.display = media.visible === false ? 'none' : 'block';
     }
 
     updateMediaComplete(media) {
@@ -77,6 +77,7 @@ class OverlayEditor {
         this.wsManager.onMessage('remove_media', this.handleRemoveMedia.bind(this));
         this.wsManager.onMessage('update_property', this.handleUpdateProperty.bind(this));
         this.wsManager.onMessage('sync_state', this.handleSyncState.bind(this));
+        this.wsManager.onMessage('partial_sync', this.handlePartialSync.bind(this));
         this.wsManager.onMessage('clear_all', this.handleClearAll.bind(this));
         this.wsManager.onMessage('operation_response', this.handleOperationResponse.bind(this));
         
@@ -101,6 +102,9 @@ class OverlayEditor {
         this.uiManager.on('filesDropped', this.handleFilesDropped.bind(this));
         this.uiManager.on('mediaDragStart', this.handleMediaDragStart.bind(this));
         this.uiManager.on('mediaDragEnd', this.handleMediaDragEnd.bind(this));
+        
+        // Deshacer/rehacer: Ctrl+Z, Ctrl+Shift+Z, Ctrl+Y
+        document.addEventListener('keydown', this.handleHistoryShortcut.bind(this));
     }
 
     // Limpieza de estado local
@@ -202,6 +206,28 @@ class OverlayEditor {
         }
     }
 
+    handlePartialSync(data) {
+        const items = Object.values(data.items || {});
+        const removed = data.removed || [];
+        console.log(`🌳 Resincronización parcial: ${items.length} items, ${removed.length} eliminados (v${data.version})`);
+        
+        removed.forEach(mediaId => {
+            this.mediaManager.removeActiveMedia(mediaId);
+            this.canvasManager.removeElement(mediaId);
+        });
+        
+        items.forEach(media => {
+            this.mediaManager.addActiveMedia(media);
+            if (this.canvasManager.getElement(media.id)) {
+                this.canvasManager.updateElement(media);
+            } else {
+                this.canvasManager.addElement(media);
+            }
+        });
+        
+        this.uiManager.updateActiveMedia(this.mediaManager.getActiveMedia());
+    }
+
     handleAddMedia(data) {
         const media = data.media;
         console.log(`➕ add_media recibido: ${media.filename || media.id} (v${data.version})`);
@@ -440,21 +466,25 @@ class OverlayEditor {
     // Core Methods con confirmaciones
     async addMediaToCanvas(media, x = null, y = null) {
         try {
+            // El servidor ya ajustó el tamaño a la proporción real del archivo (info = metadatos originales)
+            const { info, ...libraryItem } = media;
+            const size = media.size ? { ...media.size } : { width: 200, height: 200 };
+            
             // Calcular posición
             if (x === null || y === null) {
                 const randomOffset = () => (Math.random() - 0.5) * 100;
-                x = (1920 - 200) / 2 + randomOffset();
-                y = (1080 - 200) / 2 + randomOffset();
+                x = (1920 - size.width) / 2 + randomOffset();
+                y = (1080 - size.height) / 2 + randomOffset();
             }
             
             // Asegurar que esté dentro del canvas
-            x = Math.max(0, Math.min(1920 - 200, x));
-            y = Math.max(0, Math.min(1080 - 200, y));
+            x = Math.max(0, Math.min(1920 - size.width, x));
+            y = Math.max(0, Math.min(1080 - size.height, y));
             
             const mediaData = {
-                ...media,
+                ...libraryItem,
                 position: { x, y },
-                size: { width: 200, height: 200 },
+                size,
                 opacity: 1,
                 volume: 1,
                 visible: true,
@@ -556,6 +586,38 @@ class OverlayEditor {
         }
     }
 
+    async applyHistory(action) {
+        try {
+            const response = await this.wsManager.sendWithConfirmation({ action });
+            
+            if (!response.data?.applied) {
+                this.uiManager.showNotification(action === 'undo' ? 'Nada que deshacer' : 'Nada que rehacer', 'info');
+            }
+            // Los cambios llegan como difusiones normales del servidor
+            
+        } catch (error) {
+            console.error(`❌ Error en ${action}:`, error);
+            this.uiManager.showNotification('Error al deshacer/rehacer', 'error');
+        }
+    }
+
+    handleHistoryShortcut(e) {
+        if (!(e.ctrlKey || e.metaKey)) return;
+        
+        // No interferir con el deshacer nativo de los campos de texto
+        const target = e.target;
+        if (target.isContentEditable || ['INPUT', 'TEXTAREA', 'SELECT'].includes(target.tagName)) return;
+        
+        const key = e.key.toLowerCase();
+        if (key === 'z' && !e.shiftKey) {
+            e.preventDefault();
+            this.applyHistory('undo');
+        } else if ((key === 'z' && e.shiftKey) || key === 'y') {
+            e.preventDefault();
+            this.applyHistory('redo');
+        }
+    }
+
     async uploadFiles(files) {
         try {
             // Validar archivos
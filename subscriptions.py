@@ -0,0 +1,267 @@
+from typing import Callable, Dict, FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+from fastapi import WebSocket
+from models.media import MediaItem, subset_root
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Propiedades de un item que deciden a qué suscripciones pertenece
+ROUTING_PROPERTIES = {"tags", "group", "z_index"}
+
+def _split(value: Optional[str]) -> FrozenSet[str]:
+    return frozenset(part.strip() for part in (value or "").split(",") if part.strip())
+
+class RoutingAttrs(NamedTuple):
+    """Lo mínimo de un item que hace falta para enrutarlo"""
+    tags: FrozenSet[str]
+    group: Optional[str]
+    z_index: int
+
+    @classmethod
+    def from_item(cls, item: MediaItem) -> "RoutingAttrs":
+        return cls(frozenset(item.tags), item.group, item.z_index)
+
+    @classmethod
+    def from_wire(cls, media: dict) -> "RoutingAttrs":
+        # En el protocolo compacto los valores por defecto se omiten
+        return cls(frozenset(media.get("tags") or ()), media.get("group"), media.get("z_index", 0))
+
+    def with_property(self, property_name: str, value) -> "RoutingAttrs":
+        if property_name == "tags":
+            return self._replace(tags=frozenset(value or ()))
+        if property_name == "group":
+            return self._replace(group=value)
+        return self._replace(z_index=value)
+
+class SubscriptionFilter(NamedTuple):
+    """Filtro declarado por un overlay al conectarse.
+
+    Los criterios indicados se combinan con Y; dentro de cada criterio basta con
+    una coincidencia (p. ej. `groups=webcam,lower-third&z=10:20`).
+    """
+    tags: FrozenSet[str] = frozenset()
+    groups: FrozenSet[str] = frozenset()
+    z_min: Optional[int] = None
+    z_max: Optional[int] = None
+    ids: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def from_params(cls, params: Mapping[str, str]) -> Optional["SubscriptionFilter"]:
+        """Construir desde los parámetros de la URL; None si no hay ningún criterio"""
+        z_min = z_max = None
+        if params.get("z"):
+            # "5" = exactamente 5, "5:" = desde 5, ":5" = hasta 5, "0:10" = rango
+            low, separator, high = params["z"].partition(":")
+            z_min = int(low) if low.strip() else None
+            z_max = (int(high) if high.strip() else None) if separator else z_min
+        subscription = cls(
+            tags=_split(params.get("tags")),
+            groups=_split(params.get("groups")),
+            z_min=z_min,
+            z_max=z_max,
+            ids=_split(params.get("ids"))
+        )
+        return subscription if subscription != cls() else None
+
+    def matches(self, attrs: RoutingAttrs, media_id: str) -> bool:
+        if self.ids and media_id not in self.ids:
+            return False
+        if self.tags and not (self.tags & attrs.tags):
+            return False
+        if self.groups and attrs.group not in self.groups:
+            return False
+        if self.z_min is not None and attrs.z_index < self.z_min:
+            return False
+        if self.z_max is not None and attrs.z_index > self.z_max:
+            return False
+        return True
+
+    def describe(self) -> dict:
+        return {
+            "tags": sorted(self.tags),
+            "groups": sorted(self.groups),
+            "z_range": [self.z_min, self.z_max],
+            "ids": sorted(self.ids)
+        }
+
+# Entrega de un broadcast: mensaje y conexiones que deben recibirlo
+Delivery = Tuple[dict, List[WebSocket]]
+
+class SubscriptionIndex:
+    """Índice precalculado item -> suscripciones que lo incluyen.
+
+    Las conexiones con el mismo filtro comparten entrada, y el índice se mantiene
+    incrementalmente con cada mutación difundida: enrutar un mensaje cuesta una
+    búsqueda por item, no una evaluación de filtros por conexión.
+    """
+
+    def __init__(self):
+        self.by_connection: Dict[WebSocket, SubscriptionFilter] = {}
+        self.members: Dict[SubscriptionFilter, List[WebSocket]] = {}
+        self.filter_items: Dict[SubscriptionFilter, Set[str]] = {}
+        self.routes: Dict[str, Set[SubscriptionFilter]] = {}
+        # Atributos de enrutamiento de todos los items (solo mientras haya suscripciones)
+        self.attrs: Dict[str, RoutingAttrs] = {}
+
+    @property
+    def active(self) -> bool:
+        return bool(self.members)
+
+    def is_filtered(self, websocket: WebSocket) -> bool:
+        return websocket in self.by_connection
+
+    def filter_for(self, websocket: WebSocket) -> Optional[SubscriptionFilter]:
+        return self.by_connection.get(websocket)
+
+    def item_ids(self, subscription: SubscriptionFilter) -> Set[str]:
+        return self.filter_items.get(subscription, set())
+
+    def subscribe(self, websocket: WebSocket, subscription: SubscriptionFilter, items: Iterable[MediaItem]):
+        """Registrar el filtro de una conexión; un filtro nuevo se evalúa una vez contra el estado"""
+        if not self.members:
+            self.attrs = {item.id: RoutingAttrs.from_item(item) for item in items}
+
+        self.by_connection[websocket] = subscription
+        if subscription in self.members:
+            self.members[subscription].append(websocket)
+            return
+
+        self.members[subscription] = [websocket]
+        matching = {media_id for media_id, attrs in self.attrs.items() if subscription.matches(attrs, media_id)}
+        self.filter_items[subscription] = matching
+        for media_id in matching:
+            self.routes.setdefault(media_id, set()).add(subscription)
+
+    def unsubscribe(self, websocket: WebSocket):
+        subscription = self.by_connection.pop(websocket, None)
+        if subscription is None:
+            return
+        connections = self.members[subscription]
+        connections.remove(websocket)
+        if connections:
+            return
+
+        # Último suscriptor con este filtro: quitarlo del índice
+        del self.members[subscription]
+        for media_id in self.filter_items.pop(subscription, ()):
+            filters = self.routes.get(media_id)
+            if filters:
+                filters.discard(subscription)
+                if not filters:
+                    del self.routes[media_id]
+        if not self.members:
+            self.attrs.clear()
+            self.routes.clear()
+
+    # ------------------------------------------
+    # Enrutamiento
+    # ------------------------------------------
+
+    def route(self, message: dict, item_lookup: Callable[[str], Optional[dict]]) -> List[Delivery]:
+        """Actualizar el índice con una mutación y decidir qué recibe cada suscripción"""
+        action = message.get("action")
+
+        if action == "add_media":
+            media = message["media"]
+            return self._reroute(media["id"], RoutingAttrs.from_wire(media), message, lambda: media)
+
+        if action == "update_property":
+            media_id = message["media_id"]
+            if message.get("property") in ROUTING_PROPERTIES and media_id in self.attrs:
+                attrs = self.attrs[media_id].with_property(message["property"], message["value"])
+                return self._reroute(media_id, attrs, message, lambda: item_lookup(media_id))
+            return self._deliver(self.routes.get(media_id, ()), message)
+
+        if action == "remove_media":
+            media_id = message["media_id"]
+            self.attrs.pop(media_id, None)
+            filters = self.routes.pop(media_id, set())
+            for subscription in filters:
+                self.filter_items[subscription].discard(media_id)
+            return self._deliver(filters, message)
+
+        if action == "clear_all":
+            self.attrs.clear()
+            self.routes.clear()
+            for items in self.filter_items.values():
+                items.clear()
+            return self._deliver(self.members, message)
+
+        if action == "sync_state":
+            return self._route_sync_state(message)
+
+        # Mensajes que no dependen de un item
+        return self._deliver(self.members, message)
+
+    def _reroute(self, media_id: str, attrs: RoutingAttrs, message: dict, full_item: Callable[[], Optional[dict]]) -> List[Delivery]:
+        self.attrs[media_id] = attrs
+        previous = self.routes.get(media_id, set())
+        current = {s for s in self.members if s.matches(attrs, media_id)}
+
+        for subscription in previous - current:
+            self.filter_items[subscription].discard(media_id)
+        for subscription in current - previous:
+            self.filter_items[subscription].add(media_id)
+        if current:
+            self.routes[media_id] = current
+        else:
+            self.routes.pop(media_id, None)
+
+        stamp = {key: message[key] for key in ("version", "checksum") if key in message}
+        deliveries = self._deliver(previous & current, message)
+
+        # El item salió de una suscripción: eliminarlo allí
+        left = previous - current
+        if left:
+            deliveries += self._deliver(left, {"action": "remove_media", "media_id": media_id, **stamp})
+
+        # El item entró a una suscripción: esos overlays necesitan el item completo
+        entered = current - previous
+        if entered and message["action"] == "add_media":
+            deliveries += self._deliver(entered, message)
+        elif entered:
+            media = full_item()
+            if media is not None:
+                deliveries += self._deliver(entered, {
+                    "action": "add_media",
+                    "media": media,
+                    "item_hash": message.get("item_hash"),
+                    **stamp
+                })
+        return deliveries
+
+    def _route_sync_state(self, message: dict) -> List[Delivery]:
+        """Estado completo reenviado (modo relay): reconstruir el índice y filtrar por suscripción"""
+        items = message["state"].get("items", {})
+        self.attrs = {media_id: RoutingAttrs.from_wire(media) for media_id, media in items.items()}
+        self.routes.clear()
+        deliveries = []
+        hashes = message.get("hashes", {})
+        for subscription, connections in self.members.items():
+            matching = {media_id for media_id, attrs in self.attrs.items() if subscription.matches(attrs, media_id)}
+            self.filter_items[subscription] = matching
+            for media_id in matching:
+                self.routes.setdefault(media_id, set()).add(subscription)
+            subset_hashes = {media_id: hashes[media_id] for media_id in matching if media_id in hashes}
+            deliveries.append(({
+                **message,
+                "state": {**message["state"], "items": {media_id: items[media_id] for media_id in matching}},
+                "hashes": subset_hashes,
+                "checksum": subset_root(subset_hashes)
+            }, list(connections)))
+        return deliveries
+
+    def _deliver(self, filters: Iterable[SubscriptionFilter], message: dict) -> List[Delivery]:
+        connections = [conn for subscription in filters for conn in self.members.get(subscription, ())]
+        return [(message, connections)] if connections else []
+
+    def get_stats(self):
+        """Obtener filtros activos y cuántos items incluye cada uno"""
+        return [
+            {
+                **subscription.describe(),
+                "connections": len(connections),
+                "items": len(self.filter_items.get(subscription, ()))
+            }
+            for subscription, connections in self.members.items()
+        ]
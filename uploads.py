@@ -0,0 +1,292 @@
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+from pydantic import BaseModel
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Tipos aceptados tanto por la subida simple como por la reanudable
+ALLOWED_MEDIA_TYPES = {
+    'image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp',
+    'video/mp4', 'video/webm', 'video/ogg'
+}
+
+# Los trozos del cuerpo se acumulan hasta este tamaño antes de cada escritura a disco
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+class UploadCreate(BaseModel):
+    filename: str
+    size: int
+    content_type: str
+    sha256: Optional[str] = None
+
+class UploadFinalize(BaseModel):
+    sha256: Optional[str] = None
+
+class UploadError(Exception):
+    """Error del protocolo de subida; `offset` acompaña a los conflictos para que el cliente retome"""
+
+    def __init__(self, status_code: int, detail: str, offset: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.offset = offset
+
+class UploadSession:
+    """Subida en curso: metadatos en `<id>.json`, bytes recibidos en `<id>.part`"""
+
+    def __init__(self, upload_id: str, filename: str, size: int, content_type: str,
+                 sha256: Optional[str], directory: Path, created: Optional[float] = None):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.content_type = content_type
+        self.sha256 = sha256.lower() if sha256 else None
+        self.created = created or time.time()
+        self.part_path = directory / f"{upload_id}.part"
+        self.meta_path = directory / f"{upload_id}.json"
+        # El offset es siempre el tamaño del archivo de staging (sobrevive a reinicios)
+        self.offset = self.part_path.stat().st_size if self.part_path.exists() else 0
+        self.updated = time.time()
+        self.lock = asyncio.Lock()
+
+    def to_meta(self) -> dict:
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "size": self.size,
+            "content_type": self.content_type,
+            "sha256": self.sha256,
+            "created": self.created
+        }
+
+    def describe(self) -> dict:
+        return {"upload_id": self.upload_id, "offset": self.offset, "size": self.size}
+
+class UploadManager:
+    """Subidas reanudables por trozos escritos directamente a un archivo de staging.
+
+    Protocolo: crear → enviar trozos en su offset → (consultar offset tras un corte) → finalizar.
+    Reenviar un trozo ya recibido es inocuo: los bytes que el servidor ya tiene se descartan y
+    solo se escribe el resto. Al finalizar se verifica tamaño y SHA-256 antes de publicar el archivo.
+    """
+
+    def __init__(
+        self,
+        staging_path: Path,
+        media_path: Path,
+        max_file_size: int,
+        chunk_size: int = 4 * 1024 * 1024,
+        stale_after: float = 24 * 3600,
+        max_active: int = 20
+    ):
+        self.staging_path = Path(staging_path)
+        self.media_path = Path(media_path)
+        self.max_file_size = max_file_size
+        self.chunk_size = chunk_size
+        self.stale_after = stale_after
+        self.max_active = max_active
+        self.sessions: Dict[str, UploadSession] = {}
+        self.stats = {"created": 0, "completed": 0, "failed_checksum": 0, "collected": 0, "retried_bytes": 0}
+
+    # ------------------------------------------
+    # Ciclo de vida
+    # ------------------------------------------
+
+    def load(self):
+        """Recuperar las subidas a medio terminar de una ejecución anterior"""
+        self.staging_path.mkdir(parents=True, exist_ok=True)
+        for meta_path in self.staging_path.glob("*.json"):
+            try:
+                meta = json.loads(meta_path.read_text(encoding="utf-8"))
+                session = UploadSession(
+                    meta["upload_id"], meta["filename"], meta["size"], meta["content_type"],
+                    meta.get("sha256"), self.staging_path, created=meta.get("created")
+                )
+                session.updated = meta_path.stat().st_mtime
+                if session.part_path.exists():
+                    session.updated = max(session.updated, session.part_path.stat().st_mtime)
+                self.sessions[session.upload_id] = session
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"⚠️ Subida ilegible en staging {meta_path.name}: {e}")
+                meta_path.unlink(missing_ok=True)
+        if self.sessions:
+            logger.info(f"📤 {len(self.sessions)} subidas reanudables recuperadas")
+
+    async def gc_loop(self, interval: float):
+        """Eliminar periódicamente las subidas abandonadas"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.collect_stale()
+            except Exception as e:
+                logger.error(f"❌ Error limpiando subidas abandonadas: {e}")
+
+    async def collect_stale(self) -> int:
+        now = time.time()
+        stale = [s for s in self.sessions.values() if not s.lock.locked() and now - s.updated > self.stale_after]
+        for session in stale:
+            await self._discard(session)
+        # Archivos .part sin metadatos (p. ej. un proceso que murió al crear)
+        orphans = [
+            path for path in self.staging_path.glob("*.part")
+            if path.stem not in self.sessions and now - path.stat().st_mtime > self.stale_after
+        ]
+        for path in orphans:
+            path.unlink(missing_ok=True)
+        collected = len(stale) + len(orphans)
+        if collected:
+            self.stats["collected"] += collected
+            logger.info(f"🧹 {collected} subidas abandonadas eliminadas")
+        return collected
+
+    # ------------------------------------------
+    # Protocolo
+    # ------------------------------------------
+
+    async def create(self, request: UploadCreate) -> UploadSession:
+        if request.content_type not in ALLOWED_MEDIA_TYPES:
+            raise UploadError(400, f"Tipo de archivo no permitido: {request.content_type}")
+        if request.size <= 0:
+            raise UploadError(400, "Tamaño de archivo inválido")
+        if request.size > self.max_file_size:
+            raise UploadError(413, f"Archivo demasiado grande. Máximo: {self.max_file_size // (1024*1024)}MB")
+        if len(self.sessions) >= self.max_active:
+            raise UploadError(429, "Demasiadas subidas en curso")
+
+        session = UploadSession(
+            uuid.uuid4().hex, Path(request.filename).name, request.size,
+            request.content_type, request.sha256, self.staging_path
+        )
+        await asyncio.to_thread(self._create_files, session)
+        self.sessions[session.upload_id] = session
+        self.stats["created"] += 1
+        logger.info(f"📤 Subida reanudable creada: {session.filename} ({session.size} bytes)")
+        return session
+
+    def get(self, upload_id: str) -> UploadSession:
+        session = self.sessions.get(upload_id)
+        if session is None:
+            raise UploadError(404, "Subida no encontrada")
+        return session
+
+    async def append(self, upload_id: str, offset: int, body: AsyncIterator[bytes]) -> UploadSession:
+        """Escribir un trozo que empieza en `offset`; retorna la sesión con el offset nuevo"""
+        session = self.get(upload_id)
+        if session.lock.locked():
+            # Otra petición (quizá un reintento cuyo original sigue abierto) está escribiendo
+            raise UploadError(409, "La subida está recibiendo otro trozo", offset=session.offset)
+        async with session.lock:
+            if offset > session.offset or offset < 0:
+                raise UploadError(409, "Offset no coincide con lo recibido", offset=session.offset)
+
+            # Reintento de un trozo ya recibido (total o parcialmente): omitir lo que ya está en disco
+            skip = session.offset - offset
+            self.stats["retried_bytes"] += skip
+            f = await asyncio.to_thread(open, session.part_path, "ab")
+            try:
+                pending = []
+                pending_bytes = 0
+                async for data in body:
+                    if skip:
+                        dropped = min(skip, len(data))
+                        data = data[dropped:]
+                        skip -= dropped
+                        if not data:
+                            continue
+                    if session.offset + pending_bytes + len(data) > session.size:
+                        raise UploadError(413, "El trozo excede el tamaño declarado", offset=session.offset)
+                    pending.append(data)
+                    pending_bytes += len(data)
+                    if pending_bytes >= WRITE_BUFFER_BYTES:
+                        session.offset += await asyncio.to_thread(self._write, f, pending)
+                        pending, pending_bytes = [], 0
+                if pending:
+                    session.offset += await asyncio.to_thread(self._write, f, pending)
+            finally:
+                # Lo escrito antes de un corte cuenta: el cliente retoma desde el offset consultado
+                await asyncio.to_thread(f.close)
+                session.updated = time.time()
+        return session
+
+    async def finalize(self, upload_id: str, sha256: Optional[str] = None) -> str:
+        """Verificar y publicar el archivo en la carpeta de media; retorna el nombre guardado"""
+        session = self.get(upload_id)
+        if session.lock.locked():
+            raise UploadError(409, "La subida está recibiendo otro trozo", offset=session.offset)
+        async with session.lock:
+            if session.offset != session.size:
+                raise UploadError(409, "Subida incompleta", offset=session.offset)
+
+            expected = (sha256 or session.sha256 or "").lower() or None
+            if expected:
+                actual = await asyncio.to_thread(self._sha256, session.part_path)
+                if actual != expected:
+                    self.stats["failed_checksum"] += 1
+                    await self._discard(session)
+                    raise UploadError(422, "Checksum SHA-256 no coincide; la subida fue descartada")
+
+            stored_filename = f"{uuid.uuid4()}{Path(session.filename).suffix}"
+            await asyncio.to_thread(self._publish, session, self.media_path / stored_filename)
+            del self.sessions[session.upload_id]
+            self.stats["completed"] += 1
+            logger.info(f"📁 Subida reanudable completada: {session.filename} → {stored_filename}")
+            return stored_filename
+
+    async def cancel(self, upload_id: str):
+        session = self.get(upload_id)
+        async with session.lock:
+            await self._discard(session)
+
+    # ------------------------------------------
+    # Disco (se ejecuta en hilos)
+    # ------------------------------------------
+
+    def _create_files(self, session: UploadSession):
+        self.staging_path.mkdir(parents=True, exist_ok=True)
+        session.part_path.touch()
+        session.meta_path.write_text(json.dumps(session.to_meta()), encoding="utf-8")
+
+    @staticmethod
+    def _write(f, chunks) -> int:
+        data = b"".join(chunks)
+        f.write(data)
+        f.flush()
+        return len(data)
+
+    @staticmethod
+    def _sha256(path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(WRITE_BUFFER_BYTES), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _publish(session: UploadSession, destination: Path):
+        try:
+            os.replace(session.part_path, destination)
+        except OSError:
+            # Staging y media en distintos sistemas de archivos
+            shutil.move(str(session.part_path), str(destination))
+        session.meta_path.unlink(missing_ok=True)
+
+    async def _discard(self, session: UploadSession):
+        self.sessions.pop(session.upload_id, None)
+        await asyncio.to_thread(session.part_path.unlink, True)
+        await asyncio.to_thread(session.meta_path.unlink, True)
+
+    def get_stats(self):
+        """Obtener subidas en curso y contadores"""
+        return {
+            "active": len(self.sessions),
+            "staged_bytes": sum(s.offset for s in self.sessions.values()),
+            **self.stats
+        }